@@ -16,6 +16,8 @@ def main() -> int:
   parser.add_argument("config", default="config.yaml", nargs='?', help="The YAML configuration file")
   parser.add_argument("--update-config", action="store_true", help="(Re)generates the configuration file")
   parser.add_argument("--sync", action="store_true", help="Synchronises the commands for the bot. Dev feature.")
+  parser.add_argument("--split-guild", type=int, metavar="GUILD_ID",
+                      help="Copies the shared database into this server's own database, for when db.sqlite.guild_path has just been set, then exits")
 
   args = parser.parse_args()
 
@@ -34,7 +36,8 @@ def main() -> int:
       # If it exists, we try to load the existing configuration
       try:
         with open(args.config, "r+") as file:
-          config.load_config(file)
+          # The whole point is to fill in missing values, so don't complain about them
+          config.load_config(file, check=False)
           config.update_config()
           # Now that we're done, nuke the file...
           file.seek(0)
@@ -58,10 +61,23 @@ def main() -> int:
   except FileNotFoundError:
     print(f"The config file '{args.config}' was not found. Try using --update-config to create a new config file.")
     return 1
+  except config.BadConfig as exn:
+    print(f"{exn}. Try using --update-config to fill in missing values.")
+    return 1
 
   db.load_db()
 
-  client = bot.Client(do_sync=args.sync)
+  if args.split_guild is not None:
+    if db.guild_drivers is None:
+      print("db.sqlite.guild_path isn't set, so there is nothing to split.")
+      return 1
+    if not db.split_shared(args.split_guild):
+      print(f"Server {args.split_guild} already has its own database at '{db.guild_drivers.path(args.split_guild)}'. Nothing was copied.")
+      return 1
+    print(f"Copied '{config.typed.db.path}' to '{db.guild_drivers.path(args.split_guild)}'")
+    return 0
+
+  client = bot.Client(do_sync=args.sync, config_path=args.config)
   client.start_bot()
 
   return 0
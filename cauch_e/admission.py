@@ -0,0 +1,106 @@
+"""Admission control for commands
+
+On the first day of term, hundreds of people run /group find at once, and each one does DB work and may start a stir.
+Wrapping a command handler with `admitted` bounds how many copies of it run at once. Anyone else waits in a short queue,
+and is told so straight away (which also stops Discord giving up on the interaction), and once the queue is full, people
+are asked to try again later. Handlers behind a gate should reply with `cmd.common.respond`, as the interaction may
+already have been responded to by the time they run.
+"""
+import asyncio
+import functools
+from typing import Any, Callable, Coroutine, Dict
+
+import discord
+
+import cauch_e.cooldown
+import cauch_e.stats
+
+class Gate:
+  name: str
+  """The command this is in front of."""
+
+  limit: int
+  """How many can run at once."""
+
+  queue_size: int
+  """How many can wait for a turn before we start turning people away."""
+
+  semaphore: asyncio.Semaphore
+  running: int
+  """How many are running right now."""
+
+  waiting: int
+  """How many are waiting for a turn right now."""
+
+  admitted: int
+  """How many have been let in, straight away or after waiting."""
+
+  queued: int
+  """How many have had to wait."""
+
+  rejected: int
+  """How many have been turned away because the queue was full."""
+
+  def stats(self) -> Dict[str, Any]:
+    return {"running": self.running, "waiting": self.waiting, "admitted": self.admitted,
+            "queued": self.queued, "rejected": self.rejected}
+
+  def __init__(self, name: str, limit: int, queue_size: int):
+    self.name = name
+    self.limit = limit
+    self.queue_size = queue_size
+    # This doesn't belong to an event loop until something waits on it, so it is safe to make at import time
+    self.semaphore = asyncio.Semaphore(limit)
+    self.running = 0
+    self.waiting = 0
+    self.admitted = 0
+    self.queued = 0
+    self.rejected = 0
+
+gates: Dict[str, Gate] = {}
+"""Every gate, indexed by command name."""
+
+def _stats() -> Dict[str, Any]:
+  return {name: ", ".join(f"{key} {value}" for key, value in gate.stats().items()) for name, gate in gates.items()}
+
+cauch_e.stats.register("admission", _stats)
+
+def admitted(limit: int = 4, queue: int = 50) -> Callable[[Callable[..., Coroutine]], Callable[..., Coroutine]]:
+  """
+  Puts a command handler behind a gate. This must go directly above the `def`, below the other app_commands decorators.
+  :param limit: How many copies of the handler can run at once.
+  :param queue: How many can wait for a turn before we start turning people away.
+  """
+  def decorator(f: Callable[..., Coroutine]) -> Callable[..., Coroutine]:
+    gate = gates[f.__qualname__] = Gate(f.__qualname__, limit, queue)
+
+    @functools.wraps(f)
+    async def wrapper(self, interaction: discord.Interaction, *args, **kwargs):
+      if gate.semaphore.locked():
+        if gate.waiting >= gate.queue_size:
+          gate.rejected += 1
+          # Turning them away shouldn't count against their cooldown as well
+          cauch_e.cooldown.refund(interaction)
+          await interaction.response.send_message("Lots of people are using this right now, and the queue is full. Please try again in a minute!", ephemeral=True)
+          return
+        # Answer now, as Discord only waits 3 seconds for us. The handler follows up once it gets its turn
+        await interaction.response.send_message(f"Lots of people are using this right now, so you're queued (number {gate.waiting + 1} in line). "
+                                                "We'll get back to you here shortly.", ephemeral=True)
+        gate.queued += 1
+        gate.waiting += 1
+        try:
+          await gate.semaphore.acquire()
+        finally:
+          gate.waiting -= 1
+      else:
+        await gate.semaphore.acquire()
+
+      gate.admitted += 1
+      gate.running += 1
+      try:
+        return await f(self, interaction, *args, **kwargs)
+      finally:
+        gate.running -= 1
+        gate.semaphore.release()
+    return wrapper
+  return decorator
@@ -0,0 +1,101 @@
+"""Putting queued users into study groups
+
+This is the core of `/group stir`, kept apart from Discord so that `cauch_e.simulate` runs exactly the same logic over
+recorded or synthetic traces.
+"""
+import dataclasses
+from typing import List
+
+import cauch_e.matching
+from cauch_e.config import StudyGroupConfig
+from cauch_e.db import DatabaseDriver, StudyGroupInfo
+
+@dataclasses.dataclass
+class Allocation:
+  updated_groups: List[StudyGroupInfo] = dataclasses.field(default_factory=list)
+  """Every group that was created or gained members. A group appears once for each change."""
+
+  groups_created: int = 0
+  """How many brand new groups were made."""
+
+def allocate(db: DatabaseDriver, module_code: str, config: StudyGroupConfig, time_bound: int) -> Allocation:
+  """
+  Puts as many of a module's queued users into groups as the bounds allow.
+
+  This needs to not have someone jump in the DB and mess everything up, so it is not async.
+  :param db: The database the module is in.
+  :param module_code: The module to allocate.
+  :param config: The group bounds. Pass the same one for every module in a stir, so a config reload can't mix them up.
+  :param time_bound: Users queued at or before this unix time have waited max_time, so can go in undersized or oversized groups.
+  :return: What was changed.
+  """
+  ret = Allocation()
+
+  # Grab the whole queue up front, so that we can match people by when they're free.
+  # Most modules have nobody queued most of the time, so check this before loading the groups
+  queue = db.peek_queue_for_study_group(module_code, limit=None)
+  if len(queue) == 0:
+    return ret
+
+  groups = list(db.list_study_groups(module_code).values())
+  # Sort the groups from oldest to newest
+  groups.sort(key=lambda group: group.created)
+
+  availability = db.get_availability({i.member_id for i in queue}.union(*(group.members for group in groups)))
+  # Only users who have waited at least max_time can be put into undersized or oversized groups,
+  # or in with people they share less than min_overlap free hours with
+  waited = [i.queued <= time_bound for i in queue]
+  matcher = cauch_e.matching.Matcher([availability.get(i.member_id) for i in queue], config.min_overlap, waited)
+
+  def add_to_group(group: StudyGroupInfo, index: int):
+    member_id = queue[index].member_id
+    db.add_to_study_group(module_code, group.id, member_id)
+    # Do this separately, so we don't accidentally kick people off the queue because of an exception
+    db.unqueue_from_study_group(module_code, member_id)
+    group.members.append(member_id)
+    ret.updated_groups.append(group)
+
+  def create_group(indices: List[int]):
+    group_id = db.create_study_group(module_code, invite_only=False)
+    for i in indices:
+      db.add_to_study_group(module_code, group_id, queue[i].member_id)
+    # TODO: maybe be less lazy? I want to keep this resilient against updates of this struct tho...
+    ret.updated_groups.append(db.get_study_group(module_code, group_id))
+    # Do this separately, so we don't accidentally kick people off the queue because of an exception
+    for i in indices:
+      db.unqueue_from_study_group(module_code, queue[i].member_id)
+    ret.groups_created += 1
+
+  # Check for undersized groups, prioritising older groups who have had to suffer for longer
+  #
+  # FIXME: this means groups that people keep leaving will get priority, maybe bias against this?
+  for group in groups:
+    if len(group.members) >= config.target_size:
+      continue
+
+    if (index := matcher.take_best([availability.get(i) for i in group.members])) is None:
+      # Nobody left fits this group, but they may fit the next
+      continue
+    add_to_group(group, index)
+
+  # Try to create new groups
+  while (new_group := matcher.take_group(config.target_size)) is not None:
+    create_group(new_group)
+
+  # We've done all we can for queued users below max_time now.
+
+  # Try to pad groups, prioritising newer groups so that people aren't third wheeling
+  for group in reversed(groups):
+    # We don't make groups larger than upper_bound
+    if len(group.members) >= config.upper_bound:
+      continue
+    if (index := matcher.take_best([availability.get(i) for i in group.members], allowed=waited)) is None:
+      # Waiting that long means they fit anywhere, so there is nobody left
+      return ret
+    add_to_group(group, index)
+
+  # Last ditch effort: create undersized group. There are fewer than target_size left now, so this takes everyone who has waited long enough
+  if (remaining := matcher.remaining(allowed=waited)) >= config.lower_bound:
+    create_group(matcher.take_group(remaining, allowed=waited))
+
+  return ret
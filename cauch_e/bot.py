@@ -1,11 +1,19 @@
+import asyncio
 import urllib.parse
+from typing import Optional
 
 import discord
 from discord.ext import commands
 
 from cauch_e import config
-from cauch_e.cmd import groups, modules
+from cauch_e.cmd import debug, groups, jobs, maintenance, modules
+import cauch_e.cooldown
+import cauch_e.db
 import cauch_e.error
+import cauch_e.maintenance
+import cauch_e.provision
+import cauch_e.replica
+import cauch_e.watchdog
 
 
 # _start_callbacks = []
@@ -31,8 +39,18 @@ class OpenCommands(commands.Cog):
     self.bot = bot
     super().__init__()
 
+class Tree(discord.app_commands.CommandTree):
+  async def interaction_check(self, interaction: discord.Interaction) -> bool:
+    # Each interaction is handled in its own task, so naming it lets the watchdog say which command blocked the loop
+    if interaction.command is not None:
+      task = asyncio.current_task()
+      if task is not None:
+        task.set_name(f"command:{interaction.command.qualified_name}")
+    return True
+
 class Client(commands.Bot):
   do_sync: bool
+  config_path: Optional[str]
   # def command(self, *args, **kwargs):
   #   def inner(func):
   #
@@ -46,20 +64,40 @@ class Client(commands.Bot):
     # It's not a problem if it's just a command check
     if isinstance(error, discord.app_commands.CheckFailure):
       if isinstance(error, discord.app_commands.CommandOnCooldown):
-        await interaction.response.send_message(f"You can only use this command {error.cooldown.per} times every {error.cooldown.rate} seconds!", ephemeral=True)
+        await interaction.response.send_message(f"You can only use this command {error.cooldown.rate} times every {error.cooldown.per:g} seconds! "
+                                                f"Try again in {error.retry_after:.0f} seconds.", ephemeral=True)
       elif isinstance(error, discord.app_commands.CheckFailure):
         await interaction.response.send_message(f"You cannot use this command: either you are in DMs or are trying to use an admin command!", ephemeral=True)
       return
     await cauch_e.error.report_error(bot=self, interaction=interaction, message=f"Uncaught error: {error}", exn=error.__context__)
 
   def start_bot(self):
-    self.run(config.obj["discord"]["token"])
+    self.run(config.typed.discord.token)
 
   async def setup_hook(self):
     await self.add_cog(OpenCommands(self))
     await self.add_cog(groups.GroupCommands(self))
     await self.add_cog(modules.ModuleCommands(self))
+    await self.add_cog(jobs.JobCommands(self))
+    await self.add_cog(debug.DebugCommands(self))
+    await self.add_cog(maintenance.MaintenanceCommands(self))
     print("Added cogs")
+    cauch_e.watchdog.start()
+    asyncio.create_task(cauch_e.error.run_reporter(self))
+    cauch_e.provision.start(self)
+    cauch_e.maintenance.start(self)
+    cauch_e.replica.start(self)
+    cauch_e.cooldown.start()
+    if self.config_path is not None:
+      asyncio.create_task(config.watch_config(self.config_path))
+
+  async def close(self):
+    # Don't let anyone off their cooldowns just because we restarted
+    try:
+      cauch_e.cooldown.store.flush(cauch_e.db.driver)
+    except Exception as exn:
+      print(f"Failed to save cooldowns: {exn}")
+    await super().close()
 
   async def on_ready(self):
     if self.do_sync:
@@ -72,9 +110,10 @@ class Client(commands.Bot):
     self.tree.on_error = lambda *args, **kwargs: self.error_handler(*args, **kwargs)
     print("Ready")
 
-  def __init__(self, do_sync = False):
+  def __init__(self, do_sync = False, config_path: Optional[str] = None):
     self.do_sync = do_sync
+    self.config_path = config_path
     intents = discord.Intents.default()
     intents.message_content = True
     intents.members = True
-    super().__init__(command_prefix=config.obj["discord"]["prefix"], intents=intents)
+    super().__init__(command_prefix=config.typed.discord.prefix, intents=intents, tree_cls=Tree)
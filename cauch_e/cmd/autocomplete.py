@@ -0,0 +1,121 @@
+import bisect
+import collections
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+import discord
+
+import cauch_e.db
+from .common import normalise_module_code
+
+class ModuleIndex:
+  """An in-memory index of modules for autocomplete.
+
+  Codes are matched by prefix, and names (and codes, to catch typos) by shared trigrams.
+  This is kept up to date by listening to the database driver, so it never has to touch the DB after it is built.
+  """
+  names: Dict[str, str]
+  """Module names, indexed by code."""
+
+  codes: List[str]
+  """Every module code, sorted so that we can bisect for prefixes."""
+
+  trigrams: Dict[str, Set[str]]
+  """The codes of modules whose code or name contains each trigram."""
+
+  @staticmethod
+  def make_trigrams(text: str) -> Set[str]:
+    text = f"  {text.lower()} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+  def module_trigrams(self, code: str, name: str) -> Set[str]:
+    return self.make_trigrams(code) | self.make_trigrams(name)
+
+  def add(self, code: str, name: str) -> None:
+    if code in self.names:
+      self.remove(code)
+    self.names[code] = name
+    bisect.insort(self.codes, code)
+    for trigram in self.module_trigrams(code, name):
+      self.trigrams.setdefault(trigram, set()).add(code)
+
+  def remove(self, code: str) -> None:
+    name = self.names.pop(code, None)
+    if name is None:
+      return
+    del self.codes[bisect.bisect_left(self.codes, code)]
+    for trigram in self.module_trigrams(code, name):
+      codes = self.trigrams[trigram]
+      codes.discard(code)
+      if len(codes) == 0:
+        del self.trigrams[trigram]
+
+  def on_module_changed(self, code: str, module: Optional[cauch_e.db.ModuleInfo]) -> None:
+    if module is None:
+      self.remove(code)
+    else:
+      self.add(code, module.module_name)
+
+  def search(self, query: str, limit: int = 25) -> List[Tuple[str, str]]:
+    """
+    Finds the modules that best match what the user has typed so far.
+    :param query: The partial module code or name.
+    :param limit: The maximum number of results.
+    :return: (code, name) pairs, best match first.
+    """
+    code_prefix = normalise_module_code(query)
+    start = bisect.bisect_left(self.codes, code_prefix)
+    results: List[str] = []
+    for code in self.codes[start:start + limit]:
+      if not code.startswith(code_prefix):
+        break
+      results.append(code)
+
+    if len(results) < limit and len(query.strip()) > 0:
+      # Rank by the number of shared trigrams, so "linear algbra" still finds "Linear Algebra"
+      scores = collections.Counter()
+      for trigram in self.make_trigrams(query.strip()):
+        scores.update(self.trigrams.get(trigram, ()))
+      already = set(results)
+      for code, _ in sorted(scores.items(), key=lambda i: (-i[1], i[0])):
+        if len(results) >= limit:
+          break
+        if code not in already:
+          results.append(code)
+
+    return [(code, self.names[code]) for code in results]
+
+  def __init__(self, modules: Dict[str, cauch_e.db.ModuleInfo]):
+    self.names = {}
+    self.codes = []
+    self.trigrams = {}
+    for code, module in modules.items():
+      self.add(code, module.module_name)
+
+indexes: Dict[cauch_e.db.DatabaseDriver, ModuleIndex] = {}
+"""The module index for each database."""
+
+def get_index(db: cauch_e.db.DatabaseDriver) -> ModuleIndex:
+  """Gets the module index for a database, building it the first time."""
+  index = indexes.get(db)
+  if index is None:
+    index = ModuleIndex(db.list_modules())
+    db.module_listeners.append(index.on_module_changed)
+    indexes[db] = index
+  return index
+
+async def module_autocomplete(interaction: discord.Interaction, current: str) -> List[discord.app_commands.Choice[str]]:
+  # Discord only shows 25 choices, and names are limited to 100 characters
+  return [discord.app_commands.Choice(name=f"{code}: {name}"[:100], value=code) for code, name in get_index(cauch_e.db.for_guild(interaction.guild_id)).search(current, 25)]
+
+async def multi_module_autocomplete(interaction: discord.Interaction, current: str) -> List[discord.app_commands.Choice[str]]:
+  # Only complete the last of a comma separated list, keeping what's already been typed
+  *done, last = re.split(r"[,;]", current)
+  done = [code for i in done if (code := normalise_module_code(i))]
+  ret = []
+  for code, name in get_index(cauch_e.db.for_guild(interaction.guild_id)).search(last, 25):
+    value = ", ".join(done + [code])
+    # Both of these are limited to 100 characters, and we can't cut off the value
+    if len(value) <= 100:
+      ret.append(discord.app_commands.Choice(name=(value if done else f"{code}: {name}")[:100], value=value))
+  return ret
@@ -1,4 +1,4 @@
-from typing import Any, Optional
+from typing import Any, Callable, List, Optional, Tuple
 
 import discord
 import cauch_e.config
@@ -7,14 +7,120 @@ def normalise_module_code(module_code: str):
   return module_code.upper().replace(" ", "")
 
 def is_admin(interaction: discord.Interaction):
-  return cauch_e.config.obj["discord"]["admin_role"] in (i.id for i in interaction.user.roles)
+  return cauch_e.config.typed.discord.admin_role in (i.id for i in interaction.user.roles)
 
 def is_in_server(interaction: discord.Interaction):
   return interaction.guild is not None
 
+async def respond(interaction: discord.Interaction, content: Optional[str] = None, **kwargs) -> None:
+  """
+  Replies to an interaction, whether or not it has already been responded to (like by `admission.admitted`, or a defer).
+  :param content: The message.
+  :param kwargs: Anything else that both `send_message` and `followup.send` take, like ephemeral or file.
+  """
+  if interaction.response.is_done():
+    await interaction.followup.send(content, **kwargs)
+  else:
+    await interaction.response.send_message(content, **kwargs)
+
 async def admin_only_params(interaction: discord.Interaction, *params: Optional[Any]):
   # This way round is faster, because we don't need to query the remote roles
-  if any(param is not None for param in params) and (role := cauch_e.config.obj["discord"]["admin_role"]) not in (i.id for i in interaction.user.roles):
-    await interaction.response.send_message("You tried to use an admin command. Don't do that :)", ephemeral=True)
+  if any(param is not None for param in params) and (role := cauch_e.config.typed.discord.admin_role) not in (i.id for i in interaction.user.roles):
+    await respond(interaction, "You tried to use an admin command. Don't do that :)", ephemeral=True)
     raise discord.app_commands.MissingRole(role)
 
+
+PAGE_SIZE = 20
+"""How many lines a Paginator shows at once."""
+
+class Paginator(discord.ui.View):
+  """Flicks through a long listing with buttons, fetching just one page at a time.
+
+  Pages are fetched by keyset: `fetch(after, limit)` returns up to `limit` (key, line) pairs that come after `after`,
+  where `after` is None for the first page. We remember the key each page starts after, so we can go back.
+  """
+  title: str
+  fetch: Callable[[Optional[Any], int], List[Tuple[Any, str]]]
+  total: int
+  """How many items there are, for the page count."""
+
+  owner_id: int
+  """Only the person who asked can turn the pages."""
+
+  starts: List[Optional[Any]]
+  """The key that each page we have visited starts after."""
+
+  page: int
+  has_next: bool
+
+  def render(self) -> str:
+    # Fetch one more than a page, so that we know whether there is a next one
+    items = self.fetch(self.starts[self.page], PAGE_SIZE + 1)
+    self.has_next = len(items) > PAGE_SIZE
+    items = items[:PAGE_SIZE]
+    if self.has_next:
+      del self.starts[self.page + 1:]
+      self.starts.append(items[-1][0])
+
+    self.previous.disabled = self.page == 0
+    self.next.disabled = not self.has_next
+    pages = max(1, -(-self.total // PAGE_SIZE))
+    lines = [line for _, line in items] or ["Nothing here!"]
+    return f"**{self.title}** (page {self.page + 1} of {pages})\n" + "\n".join(lines)
+
+  async def send(self, interaction: discord.Interaction) -> None:
+    """Shows the first page, as the response to an interaction."""
+    self.interaction = interaction
+    content = self.render()
+    if not self.has_next:
+      # There's nothing to flick through, so don't bother with the buttons
+      await respond(interaction, content, ephemeral=True)
+      self.stop()
+    elif interaction.response.is_done():
+      # The original response is something else, so we need to keep hold of the message to take the buttons off later
+      self.message = await interaction.followup.send(content, view=self, ephemeral=True, wait=True)
+    else:
+      await interaction.response.send_message(content, view=self, ephemeral=True)
+
+  async def interaction_check(self, interaction: discord.Interaction) -> bool:
+    return interaction.user.id == self.owner_id
+
+  @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+  async def previous(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+    self.page = max(0, self.page - 1)
+    await interaction.response.edit_message(content=self.render(), view=self)
+
+  @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+  async def next(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+    if self.has_next:
+      self.page += 1
+    await interaction.response.edit_message(content=self.render(), view=self)
+
+  async def on_timeout(self) -> None:
+    self.previous.disabled = True
+    self.next.disabled = True
+    try:
+      if self.message is not None:
+        await self.message.edit(view=self)
+      else:
+        await self.interaction.edit_original_response(view=self)
+    except discord.HTTPException:
+      pass
+
+  def __init__(self, title: str, fetch: Callable[[Optional[Any], int], List[Tuple[Any, str]]], total: int, owner_id: int):
+    """
+    :param title: Shown above each page.
+    :param fetch: Gets up to `limit` (key, line) pairs after a key, or from the start if it is None.
+    :param total: How many items there are in total.
+    :param owner_id: The discord id of the user who can turn the pages.
+    """
+    super().__init__(timeout=5 * 60)
+    self.title = title
+    self.fetch = fetch
+    self.total = total
+    self.owner_id = owner_id
+    self.starts = [None]
+    self.page = 0
+    self.has_next = False
+    self.interaction = None
+    self.message = None
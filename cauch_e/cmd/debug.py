@@ -0,0 +1,33 @@
+import io
+
+import discord
+from discord.ext import commands
+
+import cauch_e.profiling
+import cauch_e.stats
+from .common import is_in_server, is_admin
+
+
+class DebugCommands(commands.GroupCog, name="debug"):
+  @discord.app_commands.command(name="profile", description="Profiles the bot for a while, and uploads the results. Admin only.")
+  @discord.app_commands.describe(seconds="How long to profile for")
+  @discord.app_commands.describe(memory="Whether to also trace memory allocations. This slows the bot down a lot while it runs!")
+  @discord.app_commands.check(is_in_server)
+  @discord.app_commands.check(is_admin)
+  async def profile(self, interaction: discord.Interaction, seconds: discord.app_commands.Range[int, 1, 300] = 10, memory: bool = False) -> None:
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    reports = await cauch_e.profiling.profile(seconds, trace_memory=memory)
+    files = [discord.File(io.BytesIO(content.encode()), filename=name) for name, content in reports.items()]
+    await interaction.followup.send(f"Profiled for {seconds} seconds. profile.collapsed can be loaded into speedscope or flamegraph.pl.",
+                                    files=files, ephemeral=True)
+
+  @discord.app_commands.command(name="stats", description="Shows the bot's runtime statistics, like event loop lag. Admin only.")
+  @discord.app_commands.check(is_in_server)
+  @discord.app_commands.check(is_admin)
+  async def stats(self, interaction: discord.Interaction) -> None:
+    text = cauch_e.stats.format_stats() or "No stats have been collected yet."
+    await interaction.response.send_message(f"```\n{text}\n```", ephemeral=True)
+
+  def __init__(self, bot: commands.Bot):
+    self.bot = bot
+    super().__init__()
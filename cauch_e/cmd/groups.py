@@ -1,19 +1,36 @@
 import asyncio
-import dataclasses
 import datetime
+import io
+import re
 import time
-from typing import Optional, Dict, List, Tuple, Awaitable
+from typing import Optional, Dict, List, Set, Tuple, Awaitable
 
 import discord
 from discord.ext import commands
 
+import cauch_e.allocation
 import cauch_e.db
 import cauch_e.error
 import cauch_e.config
-from .common import admin_only_params, normalise_module_code, is_in_server, is_admin
+import cauch_e.jobs
+from cauch_e.admission import admitted
+from cauch_e.cooldown import persistent_cooldown
+import cauch_e.matching
+import cauch_e.provision
+from .autocomplete import get_index, module_autocomplete, multi_module_autocomplete
+from .common import Paginator, admin_only_params, normalise_module_code, is_in_server, is_admin, respond
 
 
+FIND_STIR_DELAY = 5
+"""How long (in seconds) a stir started by /group find waits for others to queue, so they can be stirred together."""
+
 class GroupCommands(commands.GroupCog, name="group"):
+  pending_stirs: Dict[cauch_e.db.DatabaseDriver, Set[str]]
+  """The modules waiting for `stir_soon` to stir them, indexed by database."""
+
+  find_stir_jobs: Dict[cauch_e.db.DatabaseDriver, cauch_e.jobs.Job]
+  """The job running `stir_soon` for each database, if there is one."""
+
   # Throughout this class, ephemeral=True is set, meaning that only the invoking user can see the command + responses.
   # This is because some of the group stuff could be socially difficult, so loudly announcing someone is leaving a group
   # is suboptimal. These also work in DMs, but OOB stuff is usually bad UX.
@@ -21,9 +38,12 @@ class GroupCommands(commands.GroupCog, name="group"):
 
   @discord.app_commands.command(name="leave", description="Leaves a study group for a module")
   @discord.app_commands.describe(module="The module code for the study group")
+  @discord.app_commands.autocomplete(module=module_autocomplete)
   @discord.app_commands.describe(admin_only_target="The target user to update. Admin only!")
   @discord.app_commands.check(is_in_server)
+  @admitted(limit=8)
   async def leave(self, interaction: discord.Interaction, module: str, admin_only_target: Optional[discord.Member]):
+    db = cauch_e.db.for_guild(interaction.guild_id)
     await admin_only_params(interaction, admin_only_target)
     module = normalise_module_code(module)
     target_id = admin_only_target.id if admin_only_target is not None else interaction.user.id
@@ -33,64 +53,48 @@ class GroupCommands(commands.GroupCog, name="group"):
       #
       # Putting it in a function explicitly bars awaits
 
-      # Get all the groups for this module
-      groups = cauch_e.db.driver.list_study_groups(module)
-      # Filter out the ids for groups that our user is in
-      our_groups = [group_id for group_id, group_info in groups.items() if target_id in group_info.members]
+      # If they have somehow joined multiple groups, this only finds the oldest, and the consistency check sorts out the rest
+      group = db.find_member_study_group(module, target_id)
       # If they aren't in any modules, whinge
-      if len(our_groups) == 0:
-        return interaction.response.send_message("You are not in any groups for that module.", ephemeral=True)
+      if group is None:
+        return respond(interaction, "You are not in any groups for that module.", ephemeral=True)
 
-      ret: Optional[Awaitable] = None
-      # If they have somehow joined multiple groups, the DB is inconsistent, which is bad.
-      #
-      # We continue after this error, which is why we can't just deref `groups` earlier: we want to repair this inconsistency
-      if len(our_groups) > 1:
-        ret = cauch_e.error.report_error(bot=self.bot, interaction=interaction,
-                                         message=f"User {target_id} is in multiple study groups: {our_groups}")
-
-      for group_id in our_groups:
-        cauch_e.db.driver.remove_from_study_group(module_code=module, member=target_id, group_id=group_id)
-        # If this was the last member, clear up the study group
-        if len(groups[group_id].members) <= 1:
-          cauch_e.db.driver.delete_study_group(module_code=module, group_id=group_id)
-
-      async def final():
-        await interaction.response.send_message("Done.", ephemeral=True)
-        if ret: await ret
-      return final()
+      db.remove_from_study_group(module_code=module, member=target_id, group_id=group.id)
+      # If this was the last member, clear up the study group
+      if len(group.members) <= 1:
+        db.delete_study_group(module_code=module, group_id=group.id)
+        if cauch_e.provision.provisioner is not None:
+          cauch_e.provision.provisioner.sync_group(db, module, group.id)
+      elif cauch_e.provision.provisioner is not None:
+        cauch_e.provision.provisioner.remove_member(db, group.id, target_id)
+
+      return respond(interaction, "Done.", ephemeral=True)
 
     await check_crit()
 
 
   @discord.app_commands.command(name="invite", description="Leaves a study group for a module")
   @discord.app_commands.describe(module="The module code for the study group")
+  @discord.app_commands.autocomplete(module=module_autocomplete)
   @discord.app_commands.describe(invitee="The user you want to invite")
   @discord.app_commands.describe(admin_only_group_id="The target user to update. Admin only!")
   @discord.app_commands.check(is_in_server)
-  # @discord.app_commands.checks.cooldown(rate=10, per=60 * 10) # 10 invites in 10 mins should be more than enough
-  @discord.app_commands.checks.cooldown(rate=1, per=10)  # TODO: remove debug
+  # @persistent_cooldown(rate=10, per=60 * 10) # 10 invites in 10 mins should be more than enough
+  @persistent_cooldown(rate=1, per=10)  # TODO: remove debug
   async def invite(self, interaction: discord.Interaction, module: str, invitee: discord.Member, admin_only_group_id: Optional[str]):
+    db = cauch_e.db.for_guild(interaction.guild_id)
     await admin_only_params(interaction, admin_only_group_id)
     module = normalise_module_code(module)
 
     # See if we can skip using the lookup
     group_id = admin_only_group_id
     if group_id is None:
-      # Get all the groups for this module
-      groups = cauch_e.db.driver.list_study_groups(module)
-      # Filter out the ids for groups that our user is in
-      groups = [group_id for group_id, group_info in groups.items() if interaction.user.id in group_info.members]
+      group = db.find_member_study_group(module, interaction.user.id)
       # If they aren't in any modules, whinge
-      if len(groups) == 0:
+      if group is None:
         await interaction.response.send_message("You are not in any groups for that module.", ephemeral=True)
         return
-      if len(groups) > 1:
-        # If in multiple groups, we cannot just continue, as the DB is inconsistent and we wouldn't know which group to invite to anyway
-        await cauch_e.error.report_error(bot=self.bot, interaction=interaction,
-                                         message=f"User {interaction.user.id} is in multiple study groups: {groups}")
-        return
-      group_id = groups[0]
+      group_id = group.id
 
     invite_msg = await invitee.send(f"You have been invited to join a study group for {module} by {interaction.user.mention}. React with a :+1: to accept.\n\nIf you don't get a response when you accept, you should ask for another invite.")
     await invite_msg.add_reaction("👍")
@@ -106,13 +110,13 @@ class GroupCommands(commands.GroupCog, name="group"):
       #
       # Putting it in a function explicitly bars awaits
 
-      groups = cauch_e.db.driver.list_study_groups(module_code=module)
-      for group in groups.values():
-        if invitee_id in group.members:
-          return False
-      cauch_e.db.driver.add_to_study_group(module_code=module, group_id=group_id, member=invitee_id)
+      if db.find_member_study_group(module, invitee_id) is not None:
+        return False
+      db.add_to_study_group(module_code=module, group_id=group_id, member=invitee_id)
       # Clean up if they were looking for another group
-      cauch_e.db.driver.unqueue_from_study_group(module_code=module, member_id=invitee_id)
+      db.unqueue_from_study_group(module_code=module, member_id=invitee_id)
+      if cauch_e.provision.provisioner is not None:
+        cauch_e.provision.provisioner.sync_group(db, module, group_id)
       return True
 
     if not check_crit():
@@ -128,180 +132,334 @@ class GroupCommands(commands.GroupCog, name="group"):
   @discord.app_commands.command(name="create-invite-only",
                                 description="Create a group for your friends. Allow others to join with /group invite-only True")
   @discord.app_commands.describe(module="The module code")
+  @discord.app_commands.autocomplete(module=module_autocomplete)
   async def create_invite_only(self, interaction: discord.Interaction, module: str):
     user_id = interaction.user.id
+    db = cauch_e.db.for_guild(interaction.guild_id)
     def crit():
       for group in groups.values():
         if user_id in group.members:
-          return interaction.response.send_message("You are already in a group for that module.", ephemeral=True)
+          return respond(interaction, "You are already in a group for that module.", ephemeral=True)
 
-    groups = cauch_e.db.driver.list_study_groups(module)
+    groups = db.list_study_groups(module)
     if interaction.user in (i for i in groups.items()):
       pass
 
   @discord.app_commands.command(name="invite-only",
                                 description="Controls whether your group is invite-only, or if others can be assigned to it")
   @discord.app_commands.describe(module="The module code")
+  @discord.app_commands.autocomplete(module=module_autocomplete)
   @discord.app_commands.describe(on="Whether invite-only mode should be on")
+  @admitted(limit=8)
   async def invite_only(self, interaction: discord.Interaction, module: str, on: bool):
-    groups = cauch_e.db.driver.list_study_groups(module)
-    groups = [group_id for group_id, group_info in groups.items() if interaction.user.id in group_info.members]
-    if len(groups) == 0:
-      await interaction.response.send_message("You are not in any groups for that module.", ephemeral=True)
+    db = cauch_e.db.for_guild(interaction.guild_id)
+    group = db.find_member_study_group(module, interaction.user.id)
+    if group is None:
+      await respond(interaction, "You are not in any groups for that module.", ephemeral=True)
       return
-    if len(groups) > 1:
-      # If in multiple groups, we cannot just continue, as the DB is inconsistent and we wouldn't know which group to invite to anyway
-      await cauch_e.error.report_error(bot=self.bot, interaction=interaction,
-                                       message=f"User {interaction.user.id} is in multiple study groups: {groups}")
-      return
-    cauch_e.db.driver.modify_study_group(module_code=module, group_id=groups[0], invite_only=on)
+    db.modify_study_group(module_code=module, group_id=group.id, invite_only=on)
 
-    await interaction.response.send_message("Group modified.", ephemeral=True)
+    await respond(interaction, "Group modified.", ephemeral=True)
 
-  @discord.app_commands.command(name="find", description="Finds you a study group for a module")
+  @discord.app_commands.command(name="list", description="Lists the study groups for a module")
   @discord.app_commands.describe(module="The module code")
-  @discord.app_commands.check(is_in_server)
-  @discord.app_commands.checks.cooldown(rate=8, per=60*30) # This can trigger stir_groups, which is pretty heavy, so let's restrict this
-  async def find(self, interaction: discord.Interaction, module: str) -> None:
+  @discord.app_commands.autocomplete(module=module_autocomplete)
+  @admitted(limit=8)
+  async def list_groups(self, interaction: discord.Interaction, module: str) -> None:
+    db = cauch_e.db.for_guild(interaction.guild_id)
     module = normalise_module_code(module)
+    if db.get_module(module) is None:
+      await respond(interaction, "That module doesn't exist.", ephemeral=True)
+      return
 
-    # Expand out the user ids
-    user_id = interaction.user.id
-    def crit() -> Tuple[bool, Awaitable]:
-      # This is a critical section: any awaiting could cause mild db inconsistencies
-      #
-      # Putting it in a function explicitly bars awaits
+    def fetch(after: Optional[int], limit: int) -> List[Tuple[int, str]]:
+      return [(i.id, f"#{i.id}: {i.member_count} members" + (", invite only" if i.invite_only else "") + f", since {i.date_created:%Y-%m-%d}")
+              for i in db.iter_study_groups(module, after=after, limit=limit)]
+
+    paginator = Paginator(f"Study groups for {module}", fetch, db.count_study_groups(module), interaction.user.id)
+    await paginator.send(interaction)
+
+  @discord.app_commands.command(name="availability", description="Tells us when you're free each week, so we can find you a group that can actually meet")
+  @discord.app_commands.describe(times="When you're free, like 'mon-fri 9-17, sat 10-12'. Use 'clear' to forget. Leave empty to see your current times.")
+  @admitted(limit=8)
+  async def availability(self, interaction: discord.Interaction, times: Optional[str]) -> None:
+    db = cauch_e.db.for_guild(interaction.guild_id)
+    if times is None:
+      slots = db.get_availability([interaction.user.id]).get(interaction.user.id)
+      if slots is None:
+        await respond(interaction, "You haven't told us when you're free, so we assume you can make any time.", ephemeral=True)
+      else:
+        await respond(interaction, f"You are free: {cauch_e.matching.format_availability(slots)}", ephemeral=True)
+      return
 
-      study_groups = cauch_e.db.driver.list_study_groups(module)
-      # Check to see if the user is already in a study group
-      for group in study_groups.values():
-        if user_id in group.members:
-          return False, interaction.response.send_message("You are already in a study group for this module.", ephemeral=True)
+    if times.strip().lower() == "clear":
+      db.set_availability(interaction.user.id, None)
+      await respond(interaction, "Forgotten. We'll assume you can make any time.", ephemeral=True)
+      return
 
-      if not cauch_e.db.driver.queue_for_study_group(module_code=module, member_id=user_id):
-        return False, interaction.response.send_message("You are already searching for a study group for this module.", ephemeral=True)
+    try:
+      slots = cauch_e.matching.parse_availability(times)
+    except ValueError as exn:
+      await respond(interaction, str(exn), ephemeral=True)
+      return
+    db.set_availability(interaction.user.id, slots)
+    await respond(interaction, f"Saved. You are free: {cauch_e.matching.format_availability(slots)}. "
+                                            "This will be used the next time we look for a group for you.", ephemeral=True)
 
-      return True, interaction.response.send_message(f"Searching for study group. This may take up to {cauch_e.config.obj['study_group']['max_time']} hours, but if it takes longer, please contact the committee for manual group allocation.", ephemeral=True)
+  @discord.app_commands.command(name="find", description="Finds you study groups for one or more modules")
+  @discord.app_commands.describe(module="Module codes separated by commas, or 'all' for every module you have a role for")
+  @discord.app_commands.autocomplete(module=multi_module_autocomplete)
+  @discord.app_commands.check(is_in_server)
+  @persistent_cooldown(rate=8, per=60*30) # This can trigger stir_groups, which is pretty heavy, so let's restrict this
+  @admitted(limit=4)
+  async def find(self, interaction: discord.Interaction, module: str) -> None:
+    db = cauch_e.db.for_guild(interaction.guild_id)
+    if module.strip().lower() == "all":
+      # Module roles are named after their module codes
+      modules = [code for role in interaction.user.roles if (code := normalise_module_code(role.name)) in get_index(db).names]
+      if len(modules) == 0:
+        await respond(interaction, "You don't have any module roles. Try listing the module codes instead.", ephemeral=True)
+        return
+    else:
+      modules = list(dict.fromkeys(code for i in re.split(r"[,;]", module) if (code := normalise_module_code(i))))
+      if len(modules) == 0:
+        await respond(interaction, "You need to give at least one module code.", ephemeral=True)
+        return
 
-    should_stir, cont = crit()
-    await cont
-    if should_stir:
-      await self.stir_groups(module)
+    # Don't let typos queue people for modules that don't exist
+    unknown = [code for code in modules if code not in get_index(db).names]
+    if len(unknown) > 0:
+      lines = []
+      for code in unknown:
+        suggestions = ", ".join(i for i, _ in get_index(db).search(code, 3))
+        lines.append(f"Unknown module {code}." + (f" Did you mean: {suggestions}?" if suggestions else ""))
+      await respond(interaction, "\n".join(lines) + "\nNothing has been changed.", ephemeral=True)
+      return
+
+    # This does all the checks and queueing in one go, so there's no critical section for us to worry about here
+    results = db.queue_for_study_groups(modules, interaction.user.id)
+
+    lines = []
+    queued = [code for code, result in results.items() if result == cauch_e.db.QueueResult.QUEUED]
+    if len(queued) > 0:
+      lines.append(f"Searching for study groups for {', '.join(queued)}. This may take up to {cauch_e.config.typed.study_group.max_time} hours, but if it takes longer, please contact the committee for manual group allocation.")
+    for code, result in results.items():
+      match result:
+        case cauch_e.db.QueueResult.IN_GROUP:
+          lines.append(f"You are already in a study group for {code}.")
+        case cauch_e.db.QueueResult.ALREADY_QUEUED:
+          lines.append(f"You are already searching for a study group for {code}.")
+        case cauch_e.db.QueueResult.UNKNOWN_MODULE:
+          # Someone deleted it in the meantime
+          lines.append(f"Unknown module {code}.")
+    await respond(interaction, "\n".join(lines), ephemeral=True)
+
+    if len(queued) > 0:
+      # Run this in the background, so we give up our turn at the gate before sending everyone their DMs
+      self.stir_soon(db, *queued)
 
   @discord.app_commands.command(name="stir", description="Stirs all the groups. Admin only.")
   @discord.app_commands.check(is_in_server)
   @discord.app_commands.check(is_admin)
+  @admitted(limit=1, queue=5)
   async def stir(self, interaction: discord.Interaction) -> None:
-    start = datetime.datetime.now()
-    await self.stir_groups()
-    await interaction.response.send_message(f"Stirred all groups in {datetime.datetime.now() - start}", ephemeral=True)
+    # This can take far longer than Discord lets us wait before responding
+    if not interaction.response.is_done():
+      await interaction.response.defer(ephemeral=True, thinking=True)
+    db = cauch_e.db.for_guild(interaction.guild_id)
+    job = cauch_e.jobs.start_job("stir", lambda job: self.stir_groups(db, job=job), started_by=str(interaction.user))
+    await cauch_e.jobs.follow(interaction, job)
+
+  def stir_soon(self, db: cauch_e.db.DatabaseDriver, *modules: str) -> None:
+    """
+    Stirs some modules in the background, along with any others that are asked for in the meantime.
+
+    Each database has at most one of these jobs at a time, which waits FIND_STIR_DELAY seconds before each stir to gather
+    up more modules. A rush of /group find therefore makes a few stirs one after another, rather than one each all at once.
+    :param db: The database the modules are in.
+    :param modules: The modules to stir.
+    """
+    pending = self.pending_stirs.setdefault(db, set())
+    pending.update(modules)
+    if db in self.find_stir_jobs:
+      # It will get to these
+      return
 
-  async def stir_groups(self, *modules: str) -> None:
+    async def run(job: cauch_e.jobs.Job) -> None:
+      try:
+        while len(pending) > 0:
+          await asyncio.sleep(FIND_STIR_DELAY)
+          batch = sorted(pending)
+          pending.clear()
+          await self.stir_groups(db, *batch, job=job)
+      finally:
+        # If this failed, whatever is left is stirred with the next /group find, or the next scheduled stir
+        del self.find_stir_jobs[db]
+    self.find_stir_jobs[db] = cauch_e.jobs.start_job("stir after /group find", run)
+
+  async def stir_groups(self, db: cauch_e.db.DatabaseDriver, *modules: str, job: Optional[cauch_e.jobs.Job] = None) -> None:
     """Tries to create groups.
 
     While adding new users can of course create new groups, so can the passage of time,
     so this should be run periodically.
 
+    :param db: The database to stir. Stirs of different databases don't get in each other's way, so can run at once.
     :param modules: The modules to update. Defaults to all.
+    :param job: If set, progress is recorded here.
     :return: A list of all the updated groups
     """
     # Report that we're stirring
     print("Stirring")
     start = datetime.datetime.now()
 
-    time_bound = start - datetime.timedelta(hours=cauch_e.config.obj['study_group']['max_time'])
-    lower_bound = cauch_e.config.obj['study_group']['lower_bound']
-    upper_bound = cauch_e.config.obj['study_group']['upper_bound']
-    target_size = cauch_e.config.obj['study_group']['target_size']
-
-    @dataclasses.dataclass
-    class ReportInfo:
-      module_code: str
-      members_ids: List[int]
+    # Grab this once, so that a config reload halfway through doesn't give us an inconsistent set of bounds
+    study_group_config = cauch_e.config.typed.study_group
+    # Queue times are unix times, so compare against one rather than the local wall clock
+    time_bound = int(time.time()) - study_group_config.max_time * 3600
 
     # We keep track of all the modified groups so that we can tell the members who's in it.
     updated_groups: List[cauch_e.db.StudyGroupInfo] = []
 
-    # Literal cringers decided to have literally no way of doing nested flow control in loops, because there is only 1 dimension
-    #
-    # smh
-    def grumble_pep3136(module_code: str):
-      # This function needs to not have someone jump in the DB and mess everything up, so it is not async.
-
-      groups = list(cauch_e.db.driver.list_study_groups(module).values())
-      # Sort the groups from oldest to newest
-      groups.sort(key=lambda group: group.date_created)
-
-      # FIXME: while pop is convenient, it does mean than spooky exceptions will unqueue people randomly
-
-      # Check for undersized groups, prioritising older groups who have had to suffer for longer
-      #
-      # FIXME: this means groups that people keep leaving will get priority, maybe bias against this?
-      for group in groups:
-        if len(group.members) >= target_size:
-          continue
-
-        if (member := cauch_e.db.driver.pop_queue_for_study_group(module_code)) is None:
-          return
-        cauch_e.db.driver.add_to_study_group(module_code, group.id, member.member_id)
-        group.members.add(member.member_id)
-        updated_groups.append(group)
-
-      # Try to create a new group
-      while len(new_group := cauch_e.db.driver.peek_queue_for_study_group(module_code, target_size)) == target_size:
-        group_id = cauch_e.db.driver.create_study_group(module_code, invite_only=False)
-        for i in new_group:
-          cauch_e.db.driver.add_to_study_group(module_code, group_id, i.member_id)
-        # TODO: maybe be less lazy? I want to keep this resilient against updates of this struct tho...
-        updated_groups.append(cauch_e.db.driver.get_study_group(module_code, group_id))
-        # Do this separately, so we don't accidentally kick people off the queue because of an exception
-        for i in new_group:
-          cauch_e.db.driver.unqueue_from_study_group(module_code, i.member_id)
-
-      # We've done all we can for queued users below max_time now.
-
-      # Try to pad groups, prioritising newer groups so that people aren't third wheeling
-      for group in reversed(groups):
-        # We don't make groups larger than upper_bound
-        if len(group.members) >= upper_bound:
-          continue
-        if (member := cauch_e.db.driver.pop_queue_for_study_group(module_code, time_bound)) is None:
-          return
-        cauch_e.db.driver.add_to_study_group(module_code, group.id, member.member_id)
-        group.members.add(member.member_id)
-        updated_groups.append(group)
-
-      # Last ditch effort: create undersized group
-      new_group = [i for i in cauch_e.db.driver.peek_queue_for_study_group(module_code, target_size) if i.time <= time_bound]
-      if len(new_group) >= lower_bound:
-        group_id = cauch_e.db.driver.create_study_group(module_code, invite_only=False)
-        for i in new_group:
-          cauch_e.db.driver.add_to_study_group(module_code, group_id, i.member_id)
-        # TODO: maybe be less lazy? I want to keep this resilient against updates of this struct tho...
-        updated_groups.append(cauch_e.db.driver.get_study_group(module_code, group_id))
-        # Do this separately, so we don't accidentally kick people off the queue because of an exception
-        for i in new_group:
-          cauch_e.db.driver.unqueue_from_study_group(module_code, i.member_id)
-
     if len(modules) == 0:
-      modules = cauch_e.db.driver.list_modules().keys()
+      modules = [i.module_code for i in db.iter_modules()]
+    if job is not None:
+      job.totals["modules"] = len(modules)
+      job.progress["modules"] = 0
 
     for module in modules:
-      grumble_pep3136(module)
-
+      allocation = cauch_e.allocation.allocate(db, module, study_group_config, time_bound)
+      updated_groups += allocation.updated_groups
+      if job is not None:
+        if allocation.groups_created > 0:
+          job.increment("groups created", allocation.groups_created)
+        job.increment("modules")
+      # Each module is its own critical section, so let everything else have a go in between
+      await asyncio.sleep(0)
+
+    # The threads are made in the background, as there may be far too many to wait for
+    if cauch_e.provision.provisioner is not None:
+      for group in updated_groups:
+        cauch_e.provision.provisioner.sync_group(db, group.module_code, group.id)
+
+    if job is not None:
+      job.totals["groups updated"] = len(updated_groups)
+      job.progress["groups updated"] = 0
     for group in updated_groups:
       members = await asyncio.gather(*[self.bot.fetch_user(member_id) for member_id in group.members])
       tag_str = ", ".join(member.mention for member in members)
       await asyncio.gather(*[member.send(f"Your group for {group.module_code} is now {tag_str}") for member in members])
+      if job is not None:
+        job.increment("groups updated")
+        job.increment("DMs sent", len(members))
     print(f"Stirring took {datetime.datetime.now() - start}")
 
+  @discord.app_commands.command(name="stats", description="Shows queue and group statistics. Admin only.")
+  @discord.app_commands.describe(module="The module code. Defaults to all modules.")
+  @discord.app_commands.autocomplete(module=module_autocomplete)
+  @discord.app_commands.check(is_in_server)
+  @discord.app_commands.check(is_admin)
+  @admitted(limit=2, queue=10)
+  async def stats(self, interaction: discord.Interaction, module: Optional[str]) -> None:
+    # These add up every module, and a few minutes out of date doesn't matter, so keep out of the way of the writes
+    db = cauch_e.db.for_guild(interaction.guild_id).replica()
+    if module is not None:
+      module = normalise_module_code(module)
+    stats = db.get_module_stats(module)
+    if len(stats) == 0:
+      await respond(interaction, "No such module.", ephemeral=True)
+      return
+
+    def hours(seconds: Optional[float]) -> str:
+      return "-" if seconds is None else f"{seconds / 3600:.1f}h"
+
+    target_size = cauch_e.config.typed.study_group.target_size
+    lines = [f"{'Module':<10} {'Queued':>6} {'Median wait':>11} {'Groups':>6} {'Members':>7} {'Fill':>5} {'Mean wait':>9}"]
+    # Show the busiest modules first
+    for i in sorted(stats.values(), key=lambda i: (-i.queue_length, -i.group_count, i.module_code)):
+      fill_rate = i.fill_rate(target_size)
+      lines.append(f"{i.module_code:<10} {i.queue_length:>6} {hours(i.median_wait):>11} {i.group_count:>6} {i.member_count:>7} "
+                   f"{'-' if fill_rate is None else f'{fill_rate:.0%}':>5} {hours(i.mean_allocated_wait()):>9}")
+    table = "\n".join(lines)
+
+    # Hundreds of modules won't fit in a message, so send them as a file instead
+    if len(table) > 1900:
+      await respond(interaction, f"Stats for {len(stats)} modules:", ephemeral=True,
+                                              file=discord.File(io.BytesIO(table.encode()), filename="stats.txt"))
+    else:
+      await respond(interaction, f"```\n{table}\n```", ephemeral=True)
+
+  @discord.app_commands.command(name="provision", description="Makes every study group's thread match its members. Admin only.")
+  @discord.app_commands.check(is_in_server)
+  @discord.app_commands.check(is_admin)
+  @admitted(limit=1, queue=5)
+  async def provision(self, interaction: discord.Interaction) -> None:
+    if cauch_e.provision.provisioner is None or cauch_e.provision.provisioner.channel() is None:
+      await respond(interaction, "Study group threads are turned off. Set study_group.thread_channel in the config to turn them on.", ephemeral=True)
+      return
+    if not interaction.response.is_done():
+      await interaction.response.defer(ephemeral=True, thinking=True)
+    job = cauch_e.jobs.start_job("reconcile threads", cauch_e.provision.provisioner.reconcile, started_by=str(interaction.user))
+    await cauch_e.jobs.follow(interaction, job)
+
+  @discord.app_commands.command(name="check", description="Checks the study groups for inconsistencies, and repairs them. Admin only.")
+  @discord.app_commands.check(is_in_server)
+  @discord.app_commands.check(is_admin)
+  @admitted(limit=1, queue=5)
+  async def check(self, interaction: discord.Interaction) -> None:
+    report = self.check_consistency(cauch_e.db.for_guild(interaction.guild_id))
+    await respond(interaction, report.summary(), ephemeral=True)
+
+  def check_consistency(self, db: cauch_e.db.DatabaseDriver, use_replica: bool = False) -> cauch_e.db.ConsistencyReport:
+    """Finds and repairs inconsistencies in the study groups, reporting any that are found.
+
+    The command handlers don't go out of their way to detect these, so this should be run periodically.
+    :param db: The database to check.
+    :param use_replica: If set, look in the database's replica first, and only lock the database itself if anything turns up there.
+                        Problems newer than the replica are then left for the next check.
+    """
+    start = datetime.datetime.now()
+    upper_bound = cauch_e.config.typed.study_group.upper_bound
+    if use_replica and (replica := db.replica()) is not db:
+      # Just looking doesn't lock anything, and most of the time there is nothing to find
+      if replica.check_consistency(upper_bound=upper_bound, repair=False).is_clean():
+        print(f"Consistency check of replica took {datetime.datetime.now() - start}: no inconsistencies found")
+        return cauch_e.db.ConsistencyReport()
+    report = db.check_consistency(upper_bound=upper_bound)
+    print(f"Consistency check took {datetime.datetime.now() - start}: {report.summary()}")
+    if not report.is_clean():
+      # Something has gone wrong somewhere to let this happen, so make sure someone hears about it
+      asyncio.create_task(cauch_e.error.report_error(bot=self.bot, interaction=None, message=f"Repaired DB inconsistencies:\n{report.summary()}"))
+    return report
+
+  async def consistency_loop(self):
+    await asyncio.sleep(5 * 60) # Keep out of the way of the first stir
+    await self.bot.wait_until_ready()
+    while True:
+      for guild_id, db in cauch_e.db.partitions(i.id for i in self.bot.guilds).items():
+        try:
+          self.check_consistency(db, use_replica=True)
+        except Exception as exn:
+          await cauch_e.error.report_error(bot=self.bot, interaction=None, message=f"Consistency check failed for server {guild_id}", exn=exn)
+        # Each check is synchronous, so let everything else have a go in between
+        await asyncio.sleep(0)
+      await asyncio.sleep(60 * 60)
+
   async def stir_loop(self):
     await asyncio.sleep(60) # Do first stir 60 seconds after start
+    await self.bot.wait_until_ready()
     while True:
-      await self.stir_groups()
+      # Each server's database is separate, so their stirs interleave without waiting on each other's locks
+      stir_jobs = [cauch_e.jobs.start_job("scheduled stir" + (f" for server {guild_id}" if guild_id is not None else ""),
+                                          lambda job, db=db: self.stir_groups(db, job=job))
+                   for guild_id, db in cauch_e.db.partitions(i.id for i in self.bot.guilds).items()]
+      # The jobs report their own errors, and we want to try again next time either way
+      await asyncio.gather(*(job.task for job in stir_jobs))
       await asyncio.sleep(60 * 60)
 
   def __init__(self, bot: commands.Bot):
+    self.pending_stirs = {}
+    self.find_stir_jobs = {}
     asyncio.run_coroutine_threadsafe(self.stir_loop(), asyncio.get_running_loop())
+    asyncio.run_coroutine_threadsafe(self.consistency_loop(), asyncio.get_running_loop())
     self.bot = bot
     super().__init__()
\ No newline at end of file
@@ -0,0 +1,28 @@
+import discord
+from discord.ext import commands
+
+import cauch_e.jobs
+from .common import is_in_server, is_admin
+
+
+class JobCommands(commands.Cog):
+  @discord.app_commands.command(name="jobs", description="Lists running and recently finished background jobs. Admin only.")
+  @discord.app_commands.check(is_in_server)
+  @discord.app_commands.check(is_admin)
+  async def jobs(self, interaction: discord.Interaction) -> None:
+    if len(cauch_e.jobs.jobs) == 0:
+      await interaction.response.send_message("No jobs have run yet.", ephemeral=True)
+      return
+    # Running jobs first, then the most recent
+    jobs = sorted(cauch_e.jobs.jobs.values(), key=lambda job: (job.finished is not None, -job.id))
+    text = ""
+    for job in jobs:
+      line = job.describe() + "\n"
+      if len(text) + len(line) > 1900:
+        break
+      text += line
+    await interaction.response.send_message(text, ephemeral=True)
+
+  def __init__(self, bot: commands.Bot):
+    self.bot = bot
+    super().__init__()
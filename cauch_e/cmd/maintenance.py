@@ -0,0 +1,50 @@
+import datetime
+from typing import Optional
+
+import discord
+from discord.ext import commands
+
+import cauch_e.db
+import cauch_e.jobs
+import cauch_e.maintenance
+from .common import is_in_server, is_admin
+
+
+class MaintenanceCommands(commands.GroupCog, name="maintenance"):
+  @discord.app_commands.command(name="run", description="Tidies up this server's database now, rather than waiting for the night. Admin only.")
+  @discord.app_commands.check(is_in_server)
+  @discord.app_commands.check(is_admin)
+  async def run(self, interaction: discord.Interaction) -> None:
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    dbs = {interaction.guild_id: cauch_e.db.for_guild(interaction.guild_id)}
+    job = cauch_e.jobs.start_job("database maintenance", lambda job: cauch_e.maintenance.maintain(dbs, job), started_by=str(interaction.user))
+    await cauch_e.jobs.follow(interaction, job)
+
+  @discord.app_commands.command(name="end-of-term", description="Archives old study groups and queue entries. Admin only!")
+  @discord.app_commands.describe(before="Archive everything from before this date, like 2024-06-30. Defaults to now.")
+  @discord.app_commands.describe(confirm="Set this to True to actually archive. Groups that are archived are gone for good from the bot!")
+  @discord.app_commands.check(is_in_server)
+  @discord.app_commands.check(is_admin)
+  async def end_of_term(self, interaction: discord.Interaction, before: Optional[str] = None, confirm: bool = False) -> None:
+    if before is None:
+      cutoff = datetime.datetime.now()
+    else:
+      try:
+        cutoff = datetime.datetime.fromisoformat(before.strip())
+      except ValueError:
+        await interaction.response.send_message("That isn't a date. Try something like 2024-06-30.", ephemeral=True)
+        return
+    if not confirm:
+      await interaction.response.send_message(f"This will archive every study group created, and take everyone off the queue who joined it, "
+                                              f"before {cutoff:%Y-%m-%d %H:%M}. Run this again with confirm: True if you're sure.", ephemeral=True)
+      return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    db = cauch_e.db.for_guild(interaction.guild_id)
+    job = cauch_e.jobs.start_job("end of term", lambda job: cauch_e.maintenance.end_of_term(db, int(cutoff.timestamp()), job),
+                                 started_by=str(interaction.user))
+    await cauch_e.jobs.follow(interaction, job)
+
+  def __init__(self, bot: commands.Bot):
+    self.bot = bot
+    super().__init__()
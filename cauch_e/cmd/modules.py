@@ -1,3 +1,4 @@
+import asyncio
 from typing import Optional, List, Tuple
 
 import discord
@@ -6,7 +7,12 @@ from discord.ext import commands
 
 import cauch_e.db
 import cauch_e.error
-from .common import admin_only_params, normalise_module_code, is_in_server, is_admin
+import cauch_e.jobs
+import cauch_e.provision
+import cauch_e.stats
+from cauch_e.scheduler import Scheduler
+from .autocomplete import module_autocomplete
+from .common import Paginator, admin_only_params, normalise_module_code, is_in_server, is_admin
 
 
 class ModuleCommands(commands.GroupCog, name="module"):
@@ -15,24 +21,37 @@ class ModuleCommands(commands.GroupCog, name="module"):
   @discord.app_commands.check(is_in_server)
   @discord.app_commands.check(is_admin)
   async def create_all(self, interaction: discord.Interaction, spec: discord.Attachment):
+    # Downloading and adding thousands of modules can take longer than Discord lets us wait before responding
+    await interaction.response.defer(ephemeral=True, thinking=True)
     spec = await spec.read()
     obj : dict = yaml.safe_load(spec)
     if type(obj) != dict:
-      await interaction.response.send_message("Invalid spec: must be an object", ephemeral=True)
+      await interaction.followup.send("Invalid spec: must be an object", ephemeral=True)
       return
     for code, info in obj.items():
       if type(code) != str:
-        await interaction.response.send_message(f"Invalid spec: properties need to be indexed by strings", ephemeral=True)
+        await interaction.followup.send(f"Invalid spec: properties need to be indexed by strings", ephemeral=True)
         return
-      if type(info.get("title")) != str:
-        await interaction.response.send_message(f"Invalid spec: property {code} has missing or invalid title", ephemeral=True)
+      if type(info) != dict or type(info.get("title")) != str:
+        await interaction.followup.send(f"Invalid spec: property {code} has missing or invalid title", ephemeral=True)
         return
 
     # Now we have validated, any exceptions are our fault
-    for code, info in obj.items():
-      mod = cauch_e.db.ModuleInfo(module_code=normalise_module_code(code), module_name=info["title"])
-      cauch_e.db.driver.add_module(mod, overwrite=True)
-    await interaction.response.send_message(f"Now have {len(cauch_e.db.driver.list_modules())} modules", ephemeral=True)
+    db = cauch_e.db.for_guild(interaction.guild_id)
+    async def create(job: cauch_e.jobs.Job):
+      job.totals["modules"] = len(obj)
+      job.progress["modules"] = 0
+      for code, info in obj.items():
+        mod = cauch_e.db.ModuleInfo(module_code=normalise_module_code(code), module_name=info["title"])
+        db.add_module(mod, overwrite=True)
+        job.increment("modules")
+        # Don't hog the event loop for the whole spec
+        if job.progress["modules"] % 50 == 0:
+          await asyncio.sleep(0)
+      job.progress["total modules in DB"] = db.count_modules()
+
+    job = cauch_e.jobs.start_job("create modules", create, started_by=str(interaction.user))
+    await cauch_e.jobs.follow(interaction, job)
 
   @discord.app_commands.command(name="create", description="Creates a single module.")
   @discord.app_commands.describe(code="The module code")
@@ -42,19 +61,73 @@ class ModuleCommands(commands.GroupCog, name="module"):
   @discord.app_commands.check(is_admin)
   async def create(self, interaction: discord.Interaction, code: str, name: str, overwrite: bool):
     code = normalise_module_code(code)
-    if cauch_e.db.driver.add_module(cauch_e.db.ModuleInfo(module_code=code, module_name=name), overwrite=overwrite):
+    if cauch_e.db.for_guild(interaction.guild_id).add_module(cauch_e.db.ModuleInfo(module_code=code, module_name=name), overwrite=overwrite):
       await interaction.response.send_message(f"Module created", ephemeral=True)
     else:
       await interaction.response.send_message(f"Module already exists. Use /module update if you really want to do this", ephemeral=True)
 
   @discord.app_commands.command(name="delete", description="Deletes a single module.")
   @discord.app_commands.describe(code="The module code")
+  @discord.app_commands.autocomplete(code=module_autocomplete)
   @discord.app_commands.check(is_in_server)
   @discord.app_commands.check(is_admin)
   async def delete(self, interaction: discord.Interaction, code: str):
     code = normalise_module_code(code)
-    cauch_e.db.driver.delete_module(code)
-    await interaction.response.send_message(f"Done", ephemeral=True)
+    db = cauch_e.db.for_guild(interaction.guild_id)
+    cascade = db.delete_module(code)
+    if cascade is None:
+      await interaction.response.send_message("That module doesn't exist.", ephemeral=True)
+      return
+    self.after_cascade(db, code, cascade, f"The module {code} has been removed from the study group bot, "
+                                    "so your study group or place in the queue for it has gone too.")
+    await interaction.response.send_message(f"Deleted {code}, along with {len(cascade.group_ids)} study groups. "
+                                            f"{len(cascade.members)} people will be told.", ephemeral=True)
+
+  @discord.app_commands.command(name="rename", description="Changes a module's code, keeping its study groups and queue.")
+  @discord.app_commands.describe(code="The current module code")
+  @discord.app_commands.describe(new_code="The new module code")
+  @discord.app_commands.autocomplete(code=module_autocomplete)
+  @discord.app_commands.check(is_in_server)
+  @discord.app_commands.check(is_admin)
+  async def rename(self, interaction: discord.Interaction, code: str, new_code: str):
+    code = normalise_module_code(code)
+    new_code = normalise_module_code(new_code)
+    db = cauch_e.db.for_guild(interaction.guild_id)
+    cascade = db.rename_module(code, new_code)
+    if cascade is None:
+      await interaction.response.send_message(f"Either {code} doesn't exist, or {new_code} already does.", ephemeral=True)
+      return
+    self.after_cascade(db, new_code, cascade, f"The module {code} is now called {new_code}. Your study group or place in the queue has moved with it.")
+    await interaction.response.send_message(f"Renamed {code} to {new_code}, along with {len(cascade.group_ids)} study groups. "
+                                            f"{len(cascade.members)} people will be told.", ephemeral=True)
+
+  def after_cascade(self, db: cauch_e.db.DatabaseDriver, module_code: str, cascade: cauch_e.db.ModuleCascade, message: str) -> None:
+    """
+    Brings the threads of the affected groups up to date, and tells everyone affected, in the background.
+    :param module_code: The code the groups are under now. Deleted groups aren't found under any code, so their threads are archived.
+    """
+    if cauch_e.provision.provisioner is not None:
+      for group_id in cascade.group_ids:
+        cauch_e.provision.provisioner.sync_group(db, module_code, group_id)
+    for member_id in cascade.members:
+      self.notifier.submit(("notify", member_id, message), lambda member_id=member_id: self.notify(member_id, message))
+
+  async def notify(self, member_id: int, message: str) -> None:
+    user = self.bot.get_user(member_id) or await self.notifier.call(lambda: self.bot.fetch_user(member_id))
+    try:
+      await self.notifier.call(lambda: user.send(message))
+    except discord.Forbidden:
+      # They don't accept DMs from us, and there's nothing we can do about that
+      pass
+
+  @discord.app_commands.command(name="list", description="Lists the modules")
+  async def list_modules(self, interaction: discord.Interaction) -> None:
+    db = cauch_e.db.for_guild(interaction.guild_id)
+    def fetch(after: Optional[str], limit: int) -> List[Tuple[str, str]]:
+      return [(i.module_code, f"{i.module_code}: {i.module_name}") for i in db.iter_modules(after=after, limit=limit)]
+
+    paginator = Paginator("Modules", fetch, db.count_modules(), interaction.user.id)
+    await paginator.send(interaction)
 
 # @discord.app_commands.command(name="join", description="Gives access for some module")
   # @discord.app_commands.describe(module="The module code")
@@ -101,4 +174,8 @@ class ModuleCommands(commands.GroupCog, name="module"):
   #
   def __init__(self, bot: commands.Bot):
     self.bot = bot
+    # Deleting a popular module can affect hundreds of people, so the DMs are paced to stay clear of the rate limits
+    self.notifier = Scheduler()
+    self.notifier.start()
+    cauch_e.stats.register("module notifications", lambda: {"pending": len(self.notifier.pending), "failures": self.notifier.failures})
     super().__init__()
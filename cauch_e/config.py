@@ -2,7 +2,11 @@
 
 Please, PLEASE do not just pile every tweakable here; adding new items is easy, renaming/deleting them is **hard**
 """
+import asyncio
+import dataclasses
+import os
 import re
+import signal
 from typing import TextIO, Optional, Any
 
 import yaml
@@ -16,6 +20,153 @@ obj: Optional[dict] = None
 class BadConfig(Exception):
   pass
 
+@dataclasses.dataclass(frozen=True)
+class StudyGroupConfig:
+  lower_bound: int
+  """The smallest group we will create, and only then for users who have waited max_time."""
+
+  target_size: int
+  """The size of group we try to create."""
+
+  upper_bound: int
+  """The largest we will let a group grow by padding."""
+
+  max_time: int
+  """How long (in hours) a user can wait before we settle for an undersized group."""
+
+  min_overlap: int = 2
+  """How many free hours a week a user must share with a group to be put in it, until they have waited max_time. Optional."""
+
+  thread_channel: Optional[int] = None
+  """If set, each study group gets a private thread in this channel. Optional."""
+
+@dataclasses.dataclass(frozen=True)
+class DiscordConfig:
+  token: str
+  """The bot token. Changing this needs a restart."""
+
+  prefix: str
+  """The prefix for text commands. Changing this needs a restart."""
+
+  admin_role: int
+  """The id of the role allowed to use admin commands."""
+
+  report_channel: int
+  """The id of the channel that critical errors are posted in."""
+
+@dataclasses.dataclass(frozen=True)
+class DbConfig:
+  driver: str
+  """The name of the database driver. Changing this needs a restart."""
+
+  path: str
+  """The path to the database (sqlite only). Changing this needs a restart."""
+
+  guild_path: Optional[str] = None
+  """If set, each server gets its own database at this path, with {guild_id} replaced by the server's id (sqlite only).
+  Otherwise, every server shares `path`. Changing this needs a restart. Setting it doesn't move anything out of `path`:
+  run `python -m cauch_e --split-guild <server id>` for that. Optional."""
+
+  max_open: int = 32
+  """How many per-server databases can be open at once. Optional."""
+
+@dataclasses.dataclass(frozen=True)
+class DebugConfig:
+  lag_threshold: float = 0.5
+  """How long (in seconds) the event loop can be blocked before we log what is blocking it. Optional."""
+
+@dataclasses.dataclass(frozen=True)
+class Config:
+  """A validated, read-only view of `obj`.
+
+  Prefer this over indexing `obj` directly: it is checked once when loaded, rather than on every access.
+  """
+  study_group: StudyGroupConfig
+  discord: DiscordConfig
+  db: DbConfig
+  debug: DebugConfig = dataclasses.field(default_factory=DebugConfig)
+
+# XXX: like `obj`, this will *not* be initialised until main() is called
+typed: Optional[Config] = None
+
+def _get(block: Any, path: str, key: str, kind: type) -> Any:
+  if not isinstance(block, dict):
+    raise BadConfig(f"Invalid config: '{path}' must be a mapping")
+  if key not in block:
+    raise BadConfig(f"Invalid config: missing '{path}.{key}'")
+  value = block[key]
+  # Let people write whole numbers without a trailing .0
+  if kind is float and isinstance(value, int) and not isinstance(value, bool):
+    value = float(value)
+  # bool is a subclass of int, and "yes" is not a valid size
+  if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+    raise BadConfig(f"Invalid config: '{path}.{key}' must be of type {kind.__name__}")
+  return value
+
+def _get_optional(block: Any, path: str, key: str, kind: type, default: Any = None) -> Any:
+  if isinstance(block, dict) and block.get(key) is None:
+    return default
+  return _get(block, path, key, kind)
+
+def validate(raw: Any) -> Config:
+  """
+  Checks a raw config object, and converts it into its typed form
+  :param raw: The object loaded from the YAML file.
+  :returns: The typed config.
+  :raises BadConfig: if anything is missing or malformed.
+  """
+  if not isinstance(raw, dict):
+    raise BadConfig("Invalid config: the top level must be a mapping")
+
+  raw_study_group = raw.get("study_group")
+  study_group = StudyGroupConfig(
+    lower_bound=_get(raw_study_group, "study_group", "lower_bound", int),
+    target_size=_get(raw_study_group, "study_group", "target_size", int),
+    upper_bound=_get(raw_study_group, "study_group", "upper_bound", int),
+    max_time=_get(raw_study_group, "study_group", "max_time", int),
+    min_overlap=_get_optional(raw_study_group, "study_group", "min_overlap", int, StudyGroupConfig.min_overlap),
+    thread_channel=_get_optional(raw_study_group, "study_group", "thread_channel", int),
+  )
+  if not 1 <= study_group.lower_bound <= study_group.target_size <= study_group.upper_bound:
+    raise BadConfig("Invalid config: need 1 <= study_group.lower_bound <= study_group.target_size <= study_group.upper_bound")
+  if study_group.max_time < 0:
+    raise BadConfig("Invalid config: study_group.max_time cannot be negative")
+  if not 0 <= study_group.min_overlap <= 7 * 24:
+    raise BadConfig("Invalid config: study_group.min_overlap must be between 0 and 168 (the hours in a week)")
+
+  raw_discord = raw.get("discord")
+  discord = DiscordConfig(
+    token=_get(raw_discord, "discord", "token", str),
+    prefix=_get(raw_discord, "discord", "prefix", str),
+    admin_role=_get(raw_discord, "discord", "admin_role", int),
+    report_channel=_get(raw_discord, "discord", "report_channel", int),
+  )
+
+  raw_db = raw.get("db")
+  if not isinstance(raw_db, dict) or len(raw_db) != 1:
+    raise BadConfig("Invalid config: there must be exactly one database driver specified")
+  driver_name = next(iter(raw_db))
+  match driver_name:
+    case "sqlite":
+      db = DbConfig(driver=driver_name, path=_get(raw_db[driver_name], "db.sqlite", "path", str),
+                    guild_path=_get_optional(raw_db[driver_name], "db.sqlite", "guild_path", str),
+                    max_open=_get_optional(raw_db[driver_name], "db.sqlite", "max_open", int, DbConfig.max_open))
+      if db.guild_path is not None and "{guild_id}" not in db.guild_path:
+        raise BadConfig("Invalid config: db.sqlite.guild_path must contain {guild_id}")
+      if db.max_open < 1:
+        raise BadConfig("Invalid config: db.sqlite.max_open must be at least 1")
+    case _:
+      raise BadConfig(f"Invalid config: unknown database driver {driver_name}")
+
+  raw_debug = raw.get("debug") or {}
+  debug = DebugConfig(
+    lag_threshold=_get_optional(raw_debug, "debug", "lag_threshold", float, DebugConfig.lag_threshold),
+  )
+  if debug.lag_threshold <= 0:
+    raise BadConfig("Invalid config: debug.lag_threshold must be positive")
+
+  return Config(study_group=study_group, discord=discord, db=db, debug=debug)
+
 # Please note that you do not need to put every option here, just the bare minimum needed to work
 def update_config() -> None:
   """
@@ -72,17 +223,80 @@ def update_config() -> None:
     case _:
       raise NotImplementedError(f"Unknown driver {obj_db_driver}")
 
-def load_config(file: TextIO):
+def load_config(file: TextIO, check: bool = True):
   """
-  A weaving maze of menus to create a basic config file
+  Loads (and by default validates) the config file
   :param file: The stream to read the config from
+  :param check: Whether to validate the config and populate `typed`. Turned off when updating a half-written config.
+  :raises BadConfig: if `check` is set and the config is invalid. Neither `obj` nor `typed` are modified in this case.
   """
-  global obj
-  obj = yaml.load(file, yaml.SafeLoader)
+  global obj, typed
+  new_obj = yaml.load(file, yaml.SafeLoader)
+  if check:
+    typed = validate(new_obj)
+  obj = new_obj
+
+def reload_config(path: str) -> bool:
+  """
+  Reloads the config from disk, keeping the old config if the new one is invalid.
+
+  Things that are read once at startup (the token, prefix and database) are not affected until the bot restarts.
+  :param path: The path of the config file.
+  :returns: Whether the new config was loaded.
+  """
+  old = typed
+  try:
+    with open(path, "r") as file:
+      load_config(file)
+  except (OSError, yaml.YAMLError, BadConfig) as exn:
+    print(f"Failed to reload config '{path}', keeping the old one: {exn}")
+    return False
+
+  if old is not None and (old.discord.token, old.discord.prefix, old.db) != (typed.discord.token, typed.discord.prefix, typed.db):
+    print("Config reloaded, but the token, prefix or database changed: these need a restart to take effect")
+  else:
+    print("Config reloaded")
+
+  return True
+
+async def watch_config(path: str, interval: float = 5):
+  """
+  Reloads the config whenever the file changes on disk, or when the process gets a SIGHUP.
+
+  Runs forever, so should be started as a task on the bot's event loop.
+  :param path: The path of the config file.
+  :param interval: How often (in seconds) to check the file's modification time.
+  """
+  def mtime() -> Optional[int]:
+    try:
+      return os.stat(path).st_mtime_ns
+    except OSError:
+      return None
+
+  last_mtime = mtime()
+  hangup = asyncio.Event()
+  try:
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, hangup.set)
+  except (NotImplementedError, AttributeError, RuntimeError):
+    # No SIGHUP on windows, and no signal handlers outside the main thread
+    pass
+
+  while True:
+    try:
+      await asyncio.wait_for(hangup.wait(), timeout=interval)
+      print("Got SIGHUP")
+    except asyncio.TimeoutError:
+      pass
+
+    current_mtime = mtime()
+    if hangup.is_set() or (current_mtime is not None and current_mtime != last_mtime):
+      hangup.clear()
+      last_mtime = current_mtime
+      reload_config(path)
 
 def save_config(file: TextIO):
   """
-  A weaving maze of menus to create a basic config file
+  Saves the config file
   :param file: The stream to dump the config into
   """
   global obj
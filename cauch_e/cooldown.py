@@ -0,0 +1,157 @@
+"""Command cooldowns that survive restarts, and are shared between processes
+
+discord.py's cooldowns only live in memory, so restarting the bot lets everyone straight back in. `persistent_cooldown`
+plugs into `app_commands.checks.dynamic_cooldown`, but keeps its buckets in `store`, which is merged with the database
+every FLUSH_INTERVAL seconds. Checks never touch the database themselves.
+
+Each bucket is a token bucket stored as a single number: the time it will be full again (its "theoretical arrival time").
+Each use pushes that back by per / rate seconds, and a use is only allowed if that doesn't put it more than `per` seconds
+away. This is the same as a bucket of `rate` tokens that refills continuously over `per` seconds.
+"""
+import asyncio
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import discord
+
+import cauch_e.db
+import cauch_e.stats
+
+FLUSH_INTERVAL = 30
+"""How often (in seconds) the buckets are merged with the database. Other processes see our uses at most this late."""
+
+class CooldownStore:
+  tats: Dict[str, float]
+  """When each bucket will be full again, indexed by bucket."""
+
+  added: Dict[str, float]
+  """How much each bucket's time has been pushed back since it was last merged with the database."""
+
+  rejected: int
+  """How many uses have been refused, for stats."""
+
+  def take(self, bucket: str, rate: int, per: float, now: float, tokens: int = 1) -> Optional[float]:
+    """
+    Uses a bucket, if it isn't empty.
+    :param bucket: The bucket, like "group find:1234".
+    :param rate: How many uses are allowed...
+    :param per: ...every this many seconds.
+    :param now: The current unix time.
+    :param tokens: How many uses this counts as.
+    :return: None if the use is allowed, otherwise how many seconds until it would be.
+    """
+    cost = per / rate * tokens
+    new_tat = max(self.tats.get(bucket, now), now) + cost
+    if new_tat - now > per:
+      self.rejected += 1
+      return new_tat - now - per
+    self.tats[bucket] = new_tat
+    self.added[bucket] = self.added.get(bucket, 0) + cost
+    return None
+
+  def tokens(self, bucket: str, rate: int, per: float, now: float) -> int:
+    """How many uses a bucket has left."""
+    return max(0, int((per - max(0.0, self.tats.get(bucket, now) - now)) * rate / per))
+
+  def refund(self, bucket: str, rate: int, per: float, tokens: int = 1) -> None:
+    """Gives back uses that `take` allowed, for when the command didn't run after all."""
+    if bucket not in self.tats:
+      return
+    cost = per / rate * tokens
+    self.tats[bucket] -= cost
+    self.added[bucket] = self.added.get(bucket, 0) - cost
+
+  def reset(self, bucket: str) -> None:
+    self.tats.pop(bucket, None)
+    self.added.pop(bucket, None)
+
+  def load(self, db: cauch_e.db.DatabaseDriver) -> None:
+    """Picks up where we left off before a restart, and anything other processes have done since."""
+    for bucket, tat in db.load_cooldowns(time.time()).items():
+      self.tats[bucket] = max(self.tats.get(bucket, tat), tat)
+
+  def flush(self, db: cauch_e.db.DatabaseDriver) -> None:
+    """Merges the buckets we have used with the database, picking up anything other processes have done to them."""
+    now = time.time()
+    changed = {bucket: (self.tats[bucket], added) for bucket, added in self.added.items() if bucket in self.tats}
+    if len(changed) > 0:
+      self.tats.update(db.merge_cooldowns(changed, now))
+    self.added = {}
+    # Only the buckets that are still running down are stored, so there aren't many to read
+    self.load(db)
+    # Full buckets are the same as no bucket at all
+    self.tats = {bucket: tat for bucket, tat in self.tats.items() if tat > now}
+
+  def stats(self) -> Dict[str, Any]:
+    return {"buckets": len(self.tats), "unflushed": len(self.added), "rejected": self.rejected}
+
+  def __init__(self):
+    self.tats = {}
+    self.added = {}
+    self.rejected = 0
+
+store = CooldownStore()
+cauch_e.stats.register("cooldowns", store.stats)
+
+class PersistentCooldown(discord.app_commands.Cooldown):
+  """A view of one of `store`'s buckets, in the shape that discord.py's cooldown checks expect."""
+  __slots__ = ("bucket",)
+
+  def get_tokens(self, current: Optional[float] = None) -> int:
+    return store.tokens(self.bucket, self.rate, self.per, current or time.time())
+
+  def get_retry_after(self, current: Optional[float] = None) -> float:
+    current = current or time.time()
+    return max(0.0, store.tats.get(self.bucket, current) - current - self.per + self.per / self.rate)
+
+  def update_rate_limit(self, current: Optional[float] = None, *, tokens: int = 1) -> Optional[float]:
+    current = current or time.time()
+    # discord.py forgets about us a while after this, which doesn't matter, as the bucket itself is in the store
+    self._last = current
+    return store.take(self.bucket, self.rate, self.per, current, tokens)
+
+  def reset(self) -> None:
+    store.reset(self.bucket)
+
+  def copy(self) -> "PersistentCooldown":
+    return PersistentCooldown(self.bucket, self.rate, self.per)
+
+  def __init__(self, bucket: str, rate: int, per: float):
+    super().__init__(rate, per)
+    self.bucket = bucket
+
+def persistent_cooldown(rate: int, per: float, key: Callable[[discord.Interaction], Hashable] = lambda interaction: interaction.user.id):
+  """
+  Like `app_commands.checks.cooldown`, but it survives restarts and is shared between processes using the same database.
+  :param rate: How many uses are allowed...
+  :param per: ...every this many seconds.
+  :param key: What the cooldown is per. Defaults to per user.
+  """
+  def factory(interaction: discord.Interaction) -> PersistentCooldown:
+    return PersistentCooldown(f"{interaction.command.qualified_name}:{key(interaction)}", rate, per)
+
+  def record_key(interaction: discord.Interaction) -> Hashable:
+    # discord.py only calls the factory the first time it sees a key, but this runs every time, so remember what to refund here
+    ret = key(interaction)
+    interaction.extras["cooldown"] = (f"{interaction.command.qualified_name}:{ret}", rate, per)
+    return ret
+  return discord.app_commands.checks.dynamic_cooldown(factory, key=record_key)
+
+def refund(interaction: discord.Interaction) -> None:
+  """Gives back the use that a `persistent_cooldown` took from an interaction, if it had one, as the command didn't run."""
+  if (used := interaction.extras.pop("cooldown", None)) is not None:
+    store.refund(*used)
+
+async def flush_loop() -> None:
+  while True:
+    await asyncio.sleep(FLUSH_INTERVAL)
+    try:
+      store.flush(cauch_e.db.driver)
+    except Exception as exn:
+      # We'll have another go next time, and the buckets still work in the meantime
+      print(f"Failed to save cooldowns: {exn}")
+
+def start() -> None:
+  """Loads the saved cooldowns, and starts saving them periodically on the running event loop."""
+  store.load(cauch_e.db.driver)
+  asyncio.create_task(flush_loop())
@@ -1,10 +1,17 @@
 import abc
+import collections
 import dataclasses
 import datetime
+import enum
+import glob
+import json
+import os
+import pathlib
 import sqlite3
 import time
+from array import array
 from contextlib import closing
-from typing import Optional, List, Set, Dict
+from typing import Optional, List, Set, Dict, Tuple, Callable, Iterable, Iterator
 
 import cauch_e.config
 
@@ -22,7 +29,9 @@ class ModuleInfo:
   # channel_id: int
   """The id of the corresponding Discord channel"""
 
-@dataclasses.dataclass
+# Stirring a big module reads every group and queue entry in it, so these are kept small, and only make datetimes if asked
+
+@dataclasses.dataclass(slots=True)
 class StudyGroupInfo:
   id: int
   """The unique ID of the study group."""
@@ -30,17 +39,21 @@ class StudyGroupInfo:
   module_code: str
   """The code of the module the study group is for."""
 
-  date_created: datetime.datetime
+  created: int
   """The unix time this group was created."""
 
   # If you change the datatype of this, PLEASE make sure that we can safely split by commas
-  members: Set[int]
-  """A list of the members in this study group."""
+  members: array
+  """The discord ids of the members in this study group, as an array('q'). There are never any duplicates."""
 
   invite_only: bool
   """Whether or not anyone can join this group"""
 
-@dataclasses.dataclass
+  @property
+  def date_created(self) -> datetime.datetime:
+    return datetime.datetime.utcfromtimestamp(self.created)
+
+@dataclasses.dataclass(slots=True)
 class QueuedStudyGroupInfo:
   module_code: str
   """The code of the module the user wants a study group for."""
@@ -48,10 +61,245 @@ class QueuedStudyGroupInfo:
   member_id: int
   """The discord id of the user"""
 
-  time: datetime.datetime
-  """When the user requested to join the study group."""
+  queued: int
+  """The unix time the user requested to join the study group."""
+
+  @property
+  def time(self) -> datetime.datetime:
+    return datetime.datetime.utcfromtimestamp(self.queued)
+
+class ModuleRow:
+  """A module, as streamed by `iter_modules`. This is lighter than ModuleInfo, as there can be a lot of them."""
+  __slots__ = ("module_code", "module_name")
+
+  def to_info(self) -> ModuleInfo:
+    return ModuleInfo(module_code=self.module_code, module_name=self.module_name)
+
+  def __init__(self, module_code: str, module_name: str):
+    self.module_code = module_code
+    self.module_name = module_name
+
+class StudyGroupRow:
+  """A study group, as streamed by `iter_study_groups`.
+
+  The members are only split up if they are actually used, so listing groups (and counting their members) is cheap.
+  """
+  __slots__ = ("id", "module_code", "created", "member_count", "invite_only", "_members")
+
+  id: int
+  module_code: str
+
+  created: int
+  """The unix time this group was created."""
+
+  member_count: int
+  invite_only: bool
+
+  @property
+  def date_created(self) -> datetime.datetime:
+    return datetime.datetime.utcfromtimestamp(self.created)
+
+  @property
+  def members(self) -> array:
+    if isinstance(self._members, str):
+      self._members = SqliteDatabaseDriver.deserialise_members(self._members)
+    return self._members
+
+  def to_info(self) -> StudyGroupInfo:
+    return StudyGroupInfo(id=self.id, module_code=self.module_code, created=self.created, members=self.members,
+                          invite_only=self.invite_only)
+
+  def __init__(self, id: int, module_code: str, created: int, members: str, member_count: int, invite_only: bool):
+    self.id = id
+    self.module_code = module_code
+    self.created = created
+    self.member_count = member_count
+    self.invite_only = bool(invite_only)
+    self._members = members
+
+class JournalOp(enum.IntEnum):
+  """The kinds of change recorded in the journal. These are stored as integers, so NEVER renumber them."""
+  MODULE_ADDED = 1
+  """arg is the module name. Also used when a module is overwritten."""
+  MODULE_DELETED = 2
+  GROUP_CREATED = 3
+  """arg is invite_only."""
+  GROUP_DELETED = 4
+  MEMBER_ADDED = 5
+  MEMBER_REMOVED = 6
+  GROUP_MODIFIED = 7
+  """arg is invite_only."""
+  QUEUED = 8
+  UNQUEUED = 9
+  GROUP_ARCHIVED = 10
+  """The group was moved to the archive at the end of term."""
+  QUEUE_ARCHIVED = 11
+  """The queue entry was moved to the archive at the end of term."""
+  MODULE_RENAMED = 12
+  """module_code is the old code, and arg is the new one. The module's groups and queue entries move with it."""
+
+@dataclasses.dataclass
+class JournalEntry:
+  seq: int
+  """The position of this entry in the journal. Strictly increasing."""
+
+  time: int
+  """The unix time of the change."""
+
+  op: JournalOp
+  """What happened."""
+
+  module_code: Optional[str]
+  """The module the change was for."""
+
+  group_id: Optional[int]
+  """The group the change was for, if any."""
+
+  member_id: Optional[int]
+  """The user the change was for, if any."""
+
+  arg: Optional[str]
+  """Any extra information, depending on `op`."""
+
+class QueueResult(enum.Enum):
+  QUEUED = enum.auto()
+  ALREADY_QUEUED = enum.auto()
+  IN_GROUP = enum.auto()
+  """The user is already in a study group for the module."""
+  UNKNOWN_MODULE = enum.auto()
+
+@dataclasses.dataclass
+class ModuleStats:
+  module_code: str
+  """The code of the module."""
+
+  queue_length: int
+  """How many users are waiting for a group."""
+
+  group_count: int
+  """How many study groups there are."""
+
+  member_count: int
+  """How many users are in study groups."""
+
+  allocations: int
+  """How many times a queued user has been put into a group."""
+
+  total_wait: int
+  """The total number of seconds that allocated users waited in the queue."""
+
+  median_wait: Optional[int]
+  """How long (in seconds) the median user currently in the queue has been waiting, or None if the queue is empty."""
+
+  def mean_allocated_wait(self) -> Optional[float]:
+    """How long (in seconds) allocated users waited on average, or None if no one has been allocated."""
+    return self.total_wait / self.allocations if self.allocations > 0 else None
+
+  def fill_rate(self, target_size: int) -> Optional[float]:
+    """How full the groups are, relative to target_size, or None if there are no groups."""
+    return self.member_count / (self.group_count * target_size) if self.group_count > 0 else None
+
+@dataclasses.dataclass
+class ConsistencyReport:
+  duplicate_members: List[Tuple[str, int, List[int]]] = dataclasses.field(default_factory=list)
+  """(module code, member, group ids) for members in more than one group for a module. They are kept in the oldest group."""
+
+  empty_groups: List[int] = dataclasses.field(default_factory=list)
+  """Ids of groups with no members, which are deleted."""
+
+  queued_members_in_groups: List[Tuple[str, int]] = dataclasses.field(default_factory=list)
+  """(module code, member) for queued members who already have a group for that module, who are unqueued."""
+
+  orphaned_queue_entries: int = 0
+  """The number of queue entries for modules that no longer exist, which are deleted."""
+
+  orphaned_groups: List[int] = dataclasses.field(default_factory=list)
+  """Ids of groups for modules that no longer exist, which are deleted."""
+
+  oversized_groups: List[Tuple[str, int, int]] = dataclasses.field(default_factory=list)
+  """(module code, group id, size) for groups over the upper bound. These are only reported: we can't pick who to kick out."""
+
+  def is_clean(self) -> bool:
+    return not (self.duplicate_members or self.empty_groups or self.queued_members_in_groups or
+                self.orphaned_queue_entries or self.orphaned_groups or self.oversized_groups)
+
+  def summary(self) -> str:
+    if self.is_clean():
+      return "No inconsistencies found."
+    lines = []
+    if self.duplicate_members:
+      lines.append(f"{len(self.duplicate_members)} members in multiple groups: " +
+                   ", ".join(f"{member} in {module_code} groups {group_ids}" for module_code, member, group_ids in self.duplicate_members[:10]))
+    if self.empty_groups:
+      lines.append(f"{len(self.empty_groups)} empty groups: {self.empty_groups[:10]}")
+    if self.queued_members_in_groups:
+      lines.append(f"{len(self.queued_members_in_groups)} queued members already in groups: " +
+                   ", ".join(f"{member} for {module_code}" for module_code, member in self.queued_members_in_groups[:10]))
+    if self.orphaned_queue_entries:
+      lines.append(f"{self.orphaned_queue_entries} queue entries for deleted modules")
+    if self.orphaned_groups:
+      lines.append(f"{len(self.orphaned_groups)} groups for deleted modules: {self.orphaned_groups[:10]}")
+    if self.oversized_groups:
+      lines.append(f"{len(self.oversized_groups)} oversized groups (not repaired): " +
+                   ", ".join(f"{module_code} group {group_id} has {size}" for module_code, group_id, size in self.oversized_groups[:10]))
+    return "\n".join(lines)
+
+@dataclasses.dataclass
+class ModuleCascade:
+  """What was affected by deleting or renaming a module."""
+  group_ids: List[int] = dataclasses.field(default_factory=list)
+  """The module's groups, which are deleted or moved along with it."""
+
+  members: Set[int] = dataclasses.field(default_factory=set)
+  """Everyone who was in one of those groups, or queued for the module."""
+
+@dataclasses.dataclass
+class MaintenanceReport:
+  checkpointed_pages: int = 0
+  """How many pages were copied from the write-ahead log into the database."""
+
+  checkpoint_blocked: bool = False
+  """Whether the checkpoint couldn't finish because something was reading, in which case it is retried next time."""
+
+  freed_pages: int = 0
+  """How many unused pages were given back to the file system."""
+
+  free_pages: int = 0
+  """How many unused pages are left in the file."""
+
+  def summary(self) -> str:
+    return (f"Checkpointed {self.checkpointed_pages} pages" + (" (blocked by a reader)" if self.checkpoint_blocked else "") +
+            f", freed {self.freed_pages} pages, {self.free_pages} unused pages left.")
 
 class DatabaseDriver(abc.ABC):
+  module_listeners: List[Callable[[str, Optional[ModuleInfo]], None]]
+  """Called with (code, info) after a module is added or changed, and (code, None) after it is deleted."""
+
+  def close(self) -> None:
+    """Releases the connection to the database, if there is one. It is opened again if the driver is used afterwards."""
+    pass
+
+  def replica(self) -> "DatabaseDriver":
+    """
+    Gets a read-only view of a recent snapshot of the database, for reports that would otherwise hold up the bot's writes.
+    :return: A driver for the snapshot, or this driver if there isn't one (yet).
+    """
+    return self
+
+  def refresh_replica(self) -> bool:
+    """
+    Brings the snapshot that `replica` reads up to date. This must be safe to call from another thread.
+    :return: Whether anything was copied.
+    """
+    return False
+
+  def notify_module_changed(self, module_code: str, module: Optional[ModuleInfo]) -> None:
+    for f in self.module_listeners:
+      try:
+        f(module_code, module)
+      except Exception as exn:
+        print(f"Module listener failed: {exn}")
+
   @abc.abstractmethod
   def add_module(self, module: ModuleInfo, overwrite: bool = False) -> bool:
     """
@@ -80,10 +328,37 @@ class DatabaseDriver(abc.ABC):
     pass
 
   @abc.abstractmethod
-  def delete_module(self, module_code: str) -> None:
+  def iter_modules(self, after: Optional[str] = None, limit: Optional[int] = None) -> Iterator[ModuleRow]:
+    """
+    Streams modules in order of code, a page at a time if you like.
+
+    This holds a cursor open until it is exhausted or closed, so don't keep it across an await without a limit.
+    :param after: If set, only modules with codes after this are returned. Pass the last code of the previous page to get the next one.
+    :param limit: The most modules to return, or None for all of them.
+    """
+    pass
+
+  @abc.abstractmethod
+  def count_modules(self) -> int:
+    """:return: How many modules there are."""
+    pass
+
+  @abc.abstractmethod
+  def delete_module(self, module_code: str) -> Optional[ModuleCascade]:
     """
-    Deletes a module from the database.
+    Deletes a module from the database, along with its study groups and queue, all at once.
     :param module_code: The code of the module to be deleted.
+    :return: The groups and people affected, or None if there was no such module.
+    """
+    pass
+
+  @abc.abstractmethod
+  def rename_module(self, module_code: str, new_code: str) -> Optional[ModuleCascade]:
+    """
+    Changes a module's code, moving its study groups and queue along with it, all at once.
+    :param module_code: The current code of the module.
+    :param new_code: The code to change it to.
+    :return: The groups and people affected, or None if there was no such module or the new code is already taken.
     """
     pass
 
@@ -116,6 +391,34 @@ class DatabaseDriver(abc.ABC):
     """
     pass
 
+  @abc.abstractmethod
+  def iter_study_groups(self, module_code: str, after: Optional[int] = None, limit: Optional[int] = None) -> Iterator[StudyGroupRow]:
+    """
+    Streams the study groups for a module in order of id, a page at a time if you like.
+
+    This holds a cursor open until it is exhausted or closed, so don't keep it across an await without a limit.
+    :param module_code: The module that the groups are for.
+    :param after: If set, only groups with ids after this are returned. Pass the last id of the previous page to get the next one.
+    :param limit: The most groups to return, or None for all of them.
+    """
+    pass
+
+  @abc.abstractmethod
+  def count_study_groups(self, module_code: str) -> int:
+    """:return: How many study groups there are for a module."""
+    pass
+
+  @abc.abstractmethod
+  def find_member_study_group(self, module_code: str, member_id: int) -> Optional[StudyGroupInfo]:
+    """
+    Finds the study group a user is in for a module.
+    :param module_code: The module that the group is for.
+    :param member_id: The discord id of the user.
+    :return: The user's study group if they are in one, None otherwise.
+             If the DB is inconsistent and they are in several, the oldest is returned; `check_consistency` cleans up the rest.
+    """
+    pass
+
   @abc.abstractmethod
   def delete_study_group(self, module_code: str, group_id: int) -> None:
     """
@@ -173,6 +476,15 @@ class DatabaseDriver(abc.ABC):
     :return: Whether or not the queuing was successful.
     """
 
+  @abc.abstractmethod
+  def queue_for_study_groups(self, module_codes: Iterable[str], member_id: int) -> Dict[str, QueueResult]:
+    """
+    Atomically queues a user for several modules, skipping any they are already in a group or queued for.
+    :param module_codes: The modules that the user wants to join.
+    :param member_id: The discord id of the user.
+    :return: What happened for each module.
+    """
+
   @abc.abstractmethod
   def unqueue_from_study_group(self, module_code: str, member_id: int) -> None:
     """
@@ -182,24 +494,129 @@ class DatabaseDriver(abc.ABC):
     """
 
   @abc.abstractmethod
-  def peek_queue_for_study_group(self, module_code: str, limit: int = 1) -> List[QueuedStudyGroupInfo]:
+  def peek_queue_for_study_group(self, module_code: str, limit: Optional[int] = 1) -> List[QueuedStudyGroupInfo]:
     """
     Gets the longest-waiting users for a module, but does not unqueue them.
     :param module_code: The module to get users for.
-    :param limit: The maximum number of users to get.
+    :param limit: The maximum number of users to get. None gets the whole queue.
     :return: The longest-waiting user for the given module. If less than `limit` values are returned, you can assume that those are the last.
     """
 
-  def pop_queue_for_study_group(self, module_code: str, time_bound: Optional[datetime.datetime] = None) -> Optional[QueuedStudyGroupInfo]:
+  @abc.abstractmethod
+  def set_availability(self, member_id: int, slots: Optional[bytes]) -> None:
+    """
+    Sets when a user is free each week, for matching them with others.
+    :param member_id: The discord id of the user.
+    :param slots: The availability mask (see cauch_e.matching), or None to forget it.
+    """
+
+  @abc.abstractmethod
+  def get_availability(self, member_ids: Iterable[int]) -> Dict[int, bytes]:
+    """
+    Gets when users are free each week.
+    :param member_ids: The discord ids of the users.
+    :return: The availability masks, indexed by id. Users who haven't set one are left out.
+    """
+
+  @abc.abstractmethod
+  def get_group_threads(self) -> Dict[int, int]:
+    """
+    Gets the Discord threads that have been made for study groups.
+    :return: Thread ids, indexed by group id. This may include groups that have since been deleted.
+    """
+
+  @abc.abstractmethod
+  def get_group_thread(self, group_id: int) -> Optional[int]:
+    """
+    Gets the Discord thread that has been made for a study group.
+    :param group_id: The id of the group.
+    :return: The id of the thread, or None if it doesn't have one.
+    """
+
+  @abc.abstractmethod
+  def set_group_thread(self, group_id: int, thread_id: Optional[int]) -> None:
+    """
+    Records the Discord thread for a study group.
+    :param group_id: The id of the group.
+    :param thread_id: The id of the thread, or None to forget it.
+    """
+
+  @abc.abstractmethod
+  def load_cooldowns(self, now: float) -> Dict[str, float]:
+    """
+    Gets the command cooldowns that haven't run out yet.
+    :param now: The current unix time. Buckets that are full again by then are left out.
+    :return: When each bucket will be full again, indexed by bucket.
+    """
+    pass
+
+  @abc.abstractmethod
+  def merge_cooldowns(self, buckets: Dict[str, Tuple[float, float]], now: float) -> Dict[str, float]:
+    """
+    Merges cooldowns into the stored ones, so that uses in other processes (or before a restart) all count.
+    Buckets that are full again by `now` are forgotten.
+    :param buckets: (when the bucket will be full again, how much was added to that since the last merge), indexed by bucket.
+    :param now: The current unix time.
+    :return: When each of the given buckets will be full again, now that they are merged.
+    """
+    pass
+
+  @abc.abstractmethod
+  def check_consistency(self, upper_bound: int, repair: bool = True) -> ConsistencyReport:
+    """
+    Scans every module for inconsistencies, and atomically repairs them.
+    :param upper_bound: The maximum size of a study group.
+    :param repair: If False, only report what would be repaired, without writing anything, so this works on a `replica`.
+                   Problems that one repair would have fixed along the way may then be reported twice.
+    :return: What was found (and repaired).
+    """
+
+  @abc.abstractmethod
+  def read_journal(self, after_seq: int = 0, until: Optional[int] = None) -> List[JournalEntry]:
+    """
+    Reads the journal of changes to the database, oldest first.
+    :param after_seq: Only return entries after this sequence number.
+    :param until: If set, only return entries up to (and including) this unix time.
+    :return: The journal entries.
+    """
+
+  @abc.abstractmethod
+  def get_module_stats(self, module_code: Optional[str] = None) -> Dict[str, ModuleStats]:
+    """
+    Gets the statistics for modules. These are kept up to date as the database changes, so this is cheap.
+    :param module_code: If set, only get the stats for this module.
+    :return: The stats, indexed by module code.
+    """
+
+  @abc.abstractmethod
+  def maintain(self) -> MaintenanceReport:
+    """
+    Keeps the database quick: refreshes the query planner's statistics, and tidies up the files on disk.
+    This locks the database for a moment, so should be run when it is quiet.
+    """
+    pass
+
+  @abc.abstractmethod
+  def archive_batch(self, before: int, limit: int = 500) -> Tuple[int, int]:
+    """
+    Moves some groups created before a time, and queue entries made before it, out into the archive.
+    Each batch is its own transaction, so call this repeatedly (giving everything else a go in between) until it returns (0, 0).
+    :param before: The unix time to archive things from before.
+    :param limit: The most groups, and the most queue entries, to move in this batch.
+    :return: How many groups and queue entries were moved.
+    """
+    pass
+
+  def pop_queue_for_study_group(self, module_code: str, time_bound: Optional[int] = None) -> Optional[QueuedStudyGroupInfo]:
     """
     Gets the longest-waiting user for a module, and removes them from the queue.
     :param module_code: The module to get users for.
-    :param time_bound: If this is set, then users that joined after `time_bound` will be ignored
+    :param time_bound: If this is set, then users that joined after this unix time will be ignored
     :return: The longest-waiting user for the given module
     """
     users = self.peek_queue_for_study_group(module_code, 1)
     if len(users) == 1:
-      if time_bound is not None and users[0].time > time_bound:
+      if time_bound is not None and users[0].queued > time_bound:
         return None
       self.unqueue_from_study_group(module_code, users[0].member_id)
       return users[0]
@@ -207,15 +624,136 @@ class DatabaseDriver(abc.ABC):
       return None
 
 class SqliteDatabaseDriver(DatabaseDriver):
-  db : sqlite3.Connection
+  path: str
+  _db: Optional[sqlite3.Connection]
+
+  on_use: Optional[Callable[[], None]]
+  """Called whenever the connection is used, so that `GuildDrivers` knows which databases are still in use."""
+
+  clock: Callable[[], float]
+  """Gives the current unix time. Everything the driver timestamps goes through this, so the simulator can fast forward."""
+
+  read_only: bool
+  """Whether this is a driver for a replica, which is opened read-only and never initialised."""
+
+  _replica: Optional["SqliteDatabaseDriver"]
+  _replica_copied: Optional[float]
+  """When (in unix time) the last copy into the replica started."""
+
+  _replica_replaced: bool
+  """Whether `refresh_replica` has swapped in a new copy since `_replica` connected, so it still reads the old one."""
+
+  @property
+  def db(self) -> sqlite3.Connection:
+    if self.on_use is not None:
+      self.on_use()
+    if self._db is None:
+      self._db = self.connect()
+    return self._db
+
+  def connect(self) -> sqlite3.Connection:
+    if self.read_only:
+      # Only `refresh_replica` writes to a replica, and it has its own connection
+      # as_uri escapes anything in the path that would otherwise be read as part of the URI, like ? and #
+      return sqlite3.connect(f"{pathlib.Path(self.path).resolve().as_uri()}?mode=ro", uri=True)
+    db = sqlite3.connect(self.path)
+    cur: sqlite3.Cursor
+    with closing(db.cursor()) as cur:
+      cur.execute("PRAGMA foreign_keys = ON")
+      # This only sticks for brand new databases, and has to come before anything is written. Older ones are migrated
+      cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+      # Readers and the writer don't block each other, and `maintain` checkpoints the log
+      cur.execute("PRAGMA journal_mode = WAL")
+    return db
+
+  def close(self) -> None:
+    if self._db is not None:
+      self._db.close()
+      self._db = None
+    if self._replica is not None:
+      self._replica.close()
+
+  @property
+  def replica_path(self) -> str:
+    return self.path + ".replica"
+
+  def replica(self) -> DatabaseDriver:
+    if self.read_only or not os.path.exists(self.replica_path):
+      return self
+    if self._replica is None:
+      # Share our on_use, so that using the replica keeps this server's databases open
+      self._replica = SqliteDatabaseDriver(self.replica_path, on_use=self.on_use, read_only=True)
+    elif self._replica_replaced:
+      # Reconnect here rather than in `refresh_replica`, as only the thread that opened a connection can close it.
+      # Anyone still holding the old driver carries on reading the old copy until they next ask for one
+      self._replica.close()
+    self._replica_replaced = False
+    return self._replica
+
+  def refresh_replica(self) -> bool:
+    # In-memory databases (like the simulator's) can't be opened from another connection, and replicas don't have replicas
+    if self.read_only or self.path == ":memory:":
+      return False
+
+    # Nothing to do if every write (which lands in the WAL until a checkpoint) was well before the last copy started, as
+    # the copy has them all. The margin is for filesystems that only keep modification times to the second
+    if self._replica_copied is not None and os.path.exists(self.replica_path) and \
+        all(not os.path.exists(i) or os.path.getmtime(i) < self._replica_copied - 1 for i in (self.path, self.path + "-wal")):
+      return False
+
+    started = time.time()
+    # Copy to the side and swap it in, so a long copy never locks out reports reading the current replica
+    copy_path = self.replica_path + ".new"
+    try:
+      # Our own connections, as sqlite connections can't be shared between threads. Readers don't block the writer in WAL
+      # mode, so the bot carries on as normal while this copies
+      source = sqlite3.connect(self.path)
+      target = sqlite3.connect(copy_path)
+      with closing(source), closing(target):
+        source.backup(target)
+        # The copy comes out in WAL mode, which read-only connections can't open without the WAL's index file
+        target.execute("PRAGMA journal_mode = DELETE")
+      os.replace(copy_path, self.replica_path)
+    except:
+      if os.path.exists(copy_path):
+        os.remove(copy_path)
+      raise
+    self._replica_copied = started
+    self._replica_replaced = True
+    return True
+
+  def copy_to(self, path: str) -> None:
+    """Copies the whole database into a new file. This uses sqlite's online backup, so writes can carry on meanwhile."""
+    source = sqlite3.connect(self.path)
+    target = sqlite3.connect(path)
+    with closing(source), closing(target):
+      source.backup(target)
 
   @staticmethod
-  def serialise_members(members: Set[int]) -> str:
+  def serialise_members(members: Iterable[int]) -> str:
     return ','.join(str(i) for i in members)
 
   @staticmethod
-  def deserialise_members(members: str) -> Set[int]:
-    return {int(i) for i in filter(None, members.split(','))}
+  def deserialise_members(members: str) -> array:
+    # Snowflakes fit in 64 bits, so this is one small buffer rather than a set and an object per member
+    return array('q', map(int, members.split(','))) if members else array('q')
+
+  # Members are stored comma separated, so wrapping them in brackets gives a JSON array that sqlite can split up for us.
+  #
+  # Use with `{MEMBERSHIP_CTE} SELECT ... FROM membership`
+  MEMBERSHIP_CTE = ("WITH membership(group_id, module_code, member_id) AS ("
+                    "SELECT g.id, g.module_code, CAST(m.value AS INTEGER) FROM study_groups g, json_each('[' || g.members || ']') m"
+                    ")")
+
+  @classmethod
+  def study_group_from_row(cls, row: tuple) -> StudyGroupInfo:
+    return StudyGroupInfo(id = row[0], module_code=row[1], created=row[2], members=cls.deserialise_members(row[3]), invite_only=row[4])
+
+  def write_journal(self, cur: sqlite3.Cursor, op: JournalOp, module_code: Optional[str] = None, group_id: Optional[int] = None,
+                    member_id: Optional[int] = None, arg: Optional[str] = None) -> None:
+    """Records a change in the journal. This MUST use the same cursor as the change, so that they are committed together."""
+    cur.execute("INSERT INTO journal(time, op, module_code, group_id, member_id, arg) VALUES (?, ?, ?, ?, ?, ?)",
+                (int(self.clock()), int(op), module_code, group_id, member_id, arg))
 
   def add_module(self, module: ModuleInfo, overwrite: bool = False) -> bool:
     cur: sqlite3.Cursor
@@ -223,16 +761,17 @@ class SqliteDatabaseDriver(DatabaseDriver):
     # MAKE SURE THAT THIS IS A STATIC STRING!!! WE DO NOT WANT SQLi
     overwrite_sql = " ON CONFLICT(code) DO UPDATE SET name=excluded.name" if overwrite else "" # role_id=excluded.role_id, channel_id=excluded.
 
-    with closing(self.db.cursor()) as cur:
-      try:
+    try:
+      with self.db, closing(self.db.cursor()) as cur:
         cur.execute("INSERT INTO modules(code, name) VALUES (?, ?)" + overwrite_sql,# , role_id, channel_id
                     (module.module_code, module.module_name)) # , module.role_id, module.channel_id
-        self.db.commit()
-        return True
-      except sqlite3.Error as exn:
-        if exn.sqlite_errorcode != sqlite3.SQLITE_CONSTRAINT_UNIQUE:
-          raise
-        return False
+        self.write_journal(cur, JournalOp.MODULE_ADDED, module_code=module.module_code, arg=module.module_name)
+      self.notify_module_changed(module.module_code, module)
+      return True
+    except sqlite3.Error as exn:
+      if exn.sqlite_errorcode not in (sqlite3.SQLITE_CONSTRAINT_UNIQUE, sqlite3.SQLITE_CONSTRAINT_PRIMARYKEY):
+        raise
+      return False
 
   def get_module(self, module_code: str) -> Optional[ModuleInfo]:
     cur: sqlite3.Cursor
@@ -251,18 +790,83 @@ class SqliteDatabaseDriver(DatabaseDriver):
       res = cur.fetchall()
     return {i[0]: ModuleInfo(module_code=i[0], module_name=i[1]) for i in res} # , role_id=i[2], channel_id=i[3]
 
-  def delete_module(self, module_code: str) -> None:
+  def iter_modules(self, after: Optional[str] = None, limit: Optional[int] = None) -> Iterator[ModuleRow]:
+    cur: sqlite3.Cursor
+    with closing(self.db.cursor()) as cur:
+      # Keyset pagination: the primary key index takes us straight to the page, however far in it is
+      cur.execute("SELECT code, name FROM modules WHERE code > ? ORDER BY code LIMIT ?",
+                  (after if after is not None else "", limit if limit is not None else -1))
+      for i in cur:
+        yield ModuleRow(module_code=i[0], module_name=i[1])
+
+  def count_modules(self) -> int:
+    cur: sqlite3.Cursor
     with closing(self.db.cursor()) as cur:
+      cur.execute("SELECT COUNT(*) FROM modules")
+      return cur.fetchone()[0]
+
+  def module_cascade(self, cur: sqlite3.Cursor, module_code: str) -> ModuleCascade:
+    """Finds what deleting or renaming a module would affect. Use this in the same transaction as the change."""
+    cur.execute("SELECT id FROM study_groups WHERE module_code=? ORDER BY id", (module_code,))
+    group_ids = [i[0] for i in cur.fetchall()]
+    cur.execute(f"{self.MEMBERSHIP_CTE} SELECT member_id FROM membership WHERE module_code=? "
+                "UNION SELECT member_id FROM study_group_queue WHERE module_code=?", (module_code, module_code))
+    return ModuleCascade(group_ids=group_ids, members={i[0] for i in cur.fetchall()})
+
+  def delete_module(self, module_code: str) -> Optional[ModuleCascade]:
+    cur: sqlite3.Cursor
+    with self.db, closing(self.db.cursor()) as cur:
+      cur.execute("BEGIN IMMEDIATE")
+      cur.execute("SELECT EXISTS (SELECT 1 FROM modules WHERE code=?)", (module_code,))
+      if not cur.fetchone()[0]:
+        return None
+      cascade = self.module_cascade(cur, module_code)
+
+      # The journal has to say what happened to everything, so that replaying it doesn't leave groups for a missing module
+      cur.execute("INSERT INTO journal(time, op, module_code, group_id) SELECT ?, ?, module_code, id FROM study_groups WHERE module_code=?",
+                  (int(self.clock()), int(JournalOp.GROUP_DELETED), module_code))
+      cur.execute("INSERT INTO journal(time, op, module_code, member_id) SELECT ?, ?, module_code, member_id FROM study_group_queue WHERE module_code=?",
+                  (int(self.clock()), int(JournalOp.UNQUEUED), module_code))
+      # Everything that refers to the module has to go first, or the foreign keys stop us
+      cur.execute("DELETE FROM study_group_queue WHERE module_code=?", (module_code,))
+      cur.execute("DELETE FROM study_groups WHERE module_code=?", (module_code,))
       cur.execute("DELETE FROM modules WHERE code=?", (module_code,))
-      self.db.commit()
+      self.write_journal(cur, JournalOp.MODULE_DELETED, module_code=module_code)
+    self.notify_module_changed(module_code, None)
+    return cascade
+
+  def rename_module(self, module_code: str, new_code: str) -> Optional[ModuleCascade]:
+    cur: sqlite3.Cursor
+    with self.db, closing(self.db.cursor()) as cur:
+      cur.execute("BEGIN IMMEDIATE")
+      cur.execute("SELECT name FROM modules WHERE code=?", (module_code,))
+      res = cur.fetchone()
+      cur.execute("SELECT EXISTS (SELECT 1 FROM modules WHERE code=?)", (new_code,))
+      if res is None or cur.fetchone()[0]:
+        return None
+      name = res[0]
+      cascade = self.module_cascade(cur, module_code)
+
+      # The foreign keys can't follow a change of code, so add the new module, move everything over, then drop the old one.
+      # The triggers move the counts in module_stats over as we go, apart from the wait times, which we copy ourselves
+      cur.execute("INSERT INTO modules(code, name) VALUES (?, ?)", (new_code, name))
+      cur.execute("UPDATE module_stats SET (allocations, total_wait) = (SELECT allocations, total_wait FROM module_stats WHERE module_code=?) "
+                  "WHERE module_code=?", (module_code, new_code))
+      cur.execute("UPDATE study_groups SET module_code=? WHERE module_code=?", (new_code, module_code))
+      cur.execute("UPDATE study_group_queue SET module_code=? WHERE module_code=?", (new_code, module_code))
+      cur.execute("DELETE FROM modules WHERE code=?", (module_code,))
+      self.write_journal(cur, JournalOp.MODULE_RENAMED, module_code=module_code, arg=new_code)
+    self.notify_module_changed(module_code, None)
+    self.notify_module_changed(new_code, ModuleInfo(module_code=new_code, module_name=name))
+    return cascade
 
   def create_study_group(self, module_code: str, invite_only: bool) -> int:
     cur: sqlite3.Cursor
-    with closing(self.db.cursor()) as cur:
+    with self.db, closing(self.db.cursor()) as cur:
       cur.execute("INSERT INTO study_groups(module_code, date_created, members, invite_only) VALUES (?, ?, ?, ?) RETURNING id",
-                  (module_code, int(time.time()), "", invite_only))
+                  (module_code, int(self.clock()), "", invite_only))
       res = cur.fetchone()[0]
-      self.db.commit()
+      self.write_journal(cur, JournalOp.GROUP_CREATED, module_code=module_code, group_id=res, arg=str(int(invite_only)))
       return res
 
   def get_study_group(self, module_code: str, group_id: int) -> Optional[StudyGroupInfo]:
@@ -274,7 +878,7 @@ class SqliteDatabaseDriver(DatabaseDriver):
     if res is None:
       return None
     else:
-      return StudyGroupInfo(id = res[0], module_code=res[1], date_created=datetime.datetime.utcfromtimestamp(res[2]), members=self.deserialise_members(res[3]), invite_only=res[4])
+      return self.study_group_from_row(res)
 
   def list_study_groups(self, module_code: str) -> Dict[int, StudyGroupInfo]:
     cur: sqlite3.Cursor
@@ -282,35 +886,71 @@ class SqliteDatabaseDriver(DatabaseDriver):
       cur.execute("SELECT id, module_code, date_created, members, invite_only FROM study_groups WHERE module_code=?",
                   (module_code,))
       res = cur.fetchall()
-    return {i[0]: StudyGroupInfo(id = i[0], module_code=i[1], date_created=datetime.datetime.utcfromtimestamp(i[2]), members=self.deserialise_members(i[3]), invite_only=i[4]) for i in res}
+    return {i[0]: self.study_group_from_row(i) for i in res}
 
-  def delete_study_group(self, module_code: str, group_id: int) -> None:
+  def iter_study_groups(self, module_code: str, after: Optional[int] = None, limit: Optional[int] = None) -> Iterator[StudyGroupRow]:
+    cur: sqlite3.Cursor
     with closing(self.db.cursor()) as cur:
-      cur.execute("DELETE FROM study_groups WHERE module_code=? AND group_id=?", (module_code, group_id))
-      self.db.commit()
+      cur.execute(f"SELECT id, module_code, date_created, members, {self.MEMBER_COUNT_SQL.format('members')}, invite_only FROM study_groups "
+                  "WHERE module_code=? AND id > ? ORDER BY id LIMIT ?",
+                  (module_code, after if after is not None else -1, limit if limit is not None else -1))
+      for i in cur:
+        yield StudyGroupRow(id=i[0], module_code=i[1], created=i[2], members=i[3], member_count=i[4], invite_only=i[5])
 
-  def delete_all_study_groups(self, module_code: str) -> None:
+  def count_study_groups(self, module_code: str) -> int:
+    cur: sqlite3.Cursor
     with closing(self.db.cursor()) as cur:
+      # Kept up to date by triggers, so we don't need to count
+      cur.execute("SELECT group_count FROM module_stats WHERE module_code=?", (module_code,))
+      res = cur.fetchone()
+      return res[0] if res is not None else 0
+
+  def find_member_study_group(self, module_code: str, member_id: int) -> Optional[StudyGroupInfo]:
+    cur: sqlite3.Cursor
+    with closing(self.db.cursor()) as cur:
+      cur.execute("SELECT id, module_code, date_created, members, invite_only FROM study_groups WHERE module_code=? "
+                  "AND EXISTS (SELECT 1 FROM json_each('[' || members || ']') WHERE value=?) ORDER BY id LIMIT 1",
+                  (module_code, member_id))
+      res = cur.fetchone()
+    if res is None:
+      return None
+    else:
+      return self.study_group_from_row(res)
+
+  def delete_study_group(self, module_code: str, group_id: int) -> None:
+    with self.db, closing(self.db.cursor()) as cur:
+      cur.execute("DELETE FROM study_groups WHERE module_code=? AND id=?", (module_code, group_id))
+      if cur.rowcount > 0:
+        self.write_journal(cur, JournalOp.GROUP_DELETED, module_code=module_code, group_id=group_id)
+
+  def delete_all_study_groups(self, module_code: str) -> None:
+    with self.db, closing(self.db.cursor()) as cur:
+      cur.execute("INSERT INTO journal(time, op, module_code, group_id) SELECT ?, ?, module_code, id FROM study_groups WHERE module_code=?",
+                  (int(self.clock()), int(JournalOp.GROUP_DELETED), module_code))
       cur.execute("DELETE FROM study_groups WHERE module_code=?", (module_code,))
-      self.db.commit()
 
   def add_to_study_group(self, module_code: str, group_id: int, member: int) -> None:
     cur: sqlite3.Cursor
-    with closing(self.db.cursor()) as cur:
+    with self.db, closing(self.db.cursor()) as cur:
       # This needs to be atomic, so we lock the entire db because sqlite doesn't have per-row/per-table locks
       # cur.execute("BEGIN EXCLUSIVE")
       cur.execute("SELECT members FROM study_groups WHERE module_code=? AND id=? LIMIT 1", (module_code, group_id))
       res = cur.fetchone()
       if res is not None:
         members = self.deserialise_members(res[0])
-        members.add(member)
+        if member not in members:
+          members.append(member)
         cur.execute("UPDATE study_groups SET members=? WHERE module_code=? AND id=?", (self.serialise_members(members), module_code, group_id))
-        self.db.commit()
+        self.write_journal(cur, JournalOp.MEMBER_ADDED, module_code=module_code, group_id=group_id, member_id=member)
+        # Users are unqueued after they are allocated, so if they are still queued, this is the end of their wait
+        cur.execute("UPDATE module_stats SET allocations=allocations+1, total_wait=total_wait+max(0, ?-q.time) "
+                    "FROM (SELECT time FROM study_group_queue WHERE module_code=? AND member_id=?) AS q WHERE module_code=?",
+                    (int(self.clock()), module_code, member, module_code))
       # cur.execute("COMMIT")
 
   def remove_from_study_group(self, module_code: str, group_id: int, member: int) -> None:
     cur: sqlite3.Cursor
-    with closing(self.db.cursor()) as cur:
+    with self.db, closing(self.db.cursor()) as cur:
       # This needs to be atomic, so we lock the entire db because sqlite doesn't have per-row/per-table locks
       # cur.execute("BEGIN EXCLUSIVE")
       cur.execute("SELECT members FROM study_groups WHERE module_code=? AND id=? LIMIT 1", (module_code, group_id))
@@ -319,46 +959,412 @@ class SqliteDatabaseDriver(DatabaseDriver):
         members = self.deserialise_members(res[0])
         members.remove(member)
         cur.execute("UPDATE study_groups SET members=? WHERE module_code=? AND id=?", (self.serialise_members(members), module_code, group_id))
-        self.db.commit()
+        self.write_journal(cur, JournalOp.MEMBER_REMOVED, module_code=module_code, group_id=group_id, member_id=member)
       # cur.execute("COMMIT")
 
 
   def modify_study_group(self, module_code: str, group_id: int, invite_only: Optional[bool] = None) -> None:
-    ur: sqlite3.Cursor
-    with closing(self.db.cursor()) as cur:
+    cur: sqlite3.Cursor
+    with self.db, closing(self.db.cursor()) as cur:
       if invite_only is not None:
-        cur.execute("UPDATE invite_only SET members=? WHERE module_code=? AND id=?",
+        cur.execute("UPDATE study_groups SET invite_only=? WHERE module_code=? AND id=?",
                     (invite_only, module_code, group_id))
-
-        self.db.commit()
+        if cur.rowcount > 0:
+          self.write_journal(cur, JournalOp.GROUP_MODIFIED, module_code=module_code, group_id=group_id, arg=str(int(invite_only)))
 
   def queue_for_study_group(self, module_code: str, member_id: int) -> bool:
     cur: sqlite3.Cursor
     try:
-      with closing(self.db.cursor()) as cur:
-        cur.execute("INSERT INTO study_group_queue(module_code, member_id, time) VALUES (?, ?, ?)", (module_code, member_id, time.time()))
-        self.db.commit()
+      with self.db, closing(self.db.cursor()) as cur:
+        cur.execute("INSERT INTO study_group_queue(module_code, member_id, time) VALUES (?, ?, ?)", (module_code, member_id, int(self.clock())))
+        self.write_journal(cur, JournalOp.QUEUED, module_code=module_code, member_id=member_id)
       return True
     except sqlite3.Error as exn:
       if exn.sqlite_errorcode != sqlite3.SQLITE_CONSTRAINT_UNIQUE:
         raise
       return False
 
+  def queue_for_study_groups(self, module_codes: Iterable[str], member_id: int) -> Dict[str, QueueResult]:
+    ret: Dict[str, QueueResult] = {}
+    cur: sqlite3.Cursor
+    with self.db, closing(self.db.cursor()) as cur:
+      # Take the write lock now, so nobody can slip in between the checks and the inserts
+      cur.execute("BEGIN IMMEDIATE")
+      for module_code in dict.fromkeys(module_codes):
+        cur.execute("SELECT EXISTS (SELECT 1 FROM modules WHERE code=?), "
+                    "EXISTS (SELECT 1 FROM study_groups WHERE module_code=? AND EXISTS (SELECT 1 FROM json_each('[' || members || ']') WHERE value=?))",
+                    (module_code, module_code, member_id))
+        module_exists, in_group = cur.fetchone()
+        if not module_exists:
+          ret[module_code] = QueueResult.UNKNOWN_MODULE
+          continue
+        if in_group:
+          ret[module_code] = QueueResult.IN_GROUP
+          continue
+        cur.execute("INSERT INTO study_group_queue(module_code, member_id, time) VALUES (?, ?, ?) ON CONFLICT DO NOTHING",
+                    (module_code, member_id, int(self.clock())))
+        if cur.rowcount == 0:
+          ret[module_code] = QueueResult.ALREADY_QUEUED
+          continue
+        self.write_journal(cur, JournalOp.QUEUED, module_code=module_code, member_id=member_id)
+        ret[module_code] = QueueResult.QUEUED
+    return ret
+
   def unqueue_from_study_group(self, module_code: str, member_id: int) -> None:
     cur: sqlite3.Cursor
-    with closing(self.db.cursor()) as cur:
+    with self.db, closing(self.db.cursor()) as cur:
       cur.execute("DELETE FROM study_group_queue WHERE module_code=? AND member_id=?", (module_code, member_id))
+      if cur.rowcount > 0:
+        self.write_journal(cur, JournalOp.UNQUEUED, module_code=module_code, member_id=member_id)
+
+  def peek_queue_for_study_group(self, module_code: str, limit: Optional[int] = 1) -> List[QueuedStudyGroupInfo]:
+    cur: sqlite3.Cursor
+    with closing(self.db.cursor()) as cur:
+      # A negative limit means no limit in sqlite
+      cur.execute("SELECT module_code, member_id, time FROM study_group_queue WHERE module_code=? ORDER BY time, id LIMIT ?",
+                  (module_code, limit if limit is not None else -1))
+      return [QueuedStudyGroupInfo(module_code = res[0], member_id=res[1], queued=res[2]) for res in cur.fetchall()]
+
+  def check_consistency(self, upper_bound: int, repair: bool = True) -> ConsistencyReport:
+    report = ConsistencyReport()
+    cur: sqlite3.Cursor
+    with closing(self.db.cursor()) as cur:
+      # Take the write lock up front, so that nothing changes between finding problems and fixing them.
+      # Just looking only needs a consistent snapshot, which doesn't hold anyone up
+      cur.execute("BEGIN IMMEDIATE" if repair else "BEGIN")
+      try:
+        # Groups for deleted modules go first, so we don't bother fixing anything else about them
+        cur.execute("SELECT id FROM study_groups WHERE module_code NOT IN (SELECT code FROM modules)")
+        report.orphaned_groups = [i[0] for i in cur.fetchall()]
+        cur.execute("SELECT count(*) FROM study_group_queue WHERE module_code NOT IN (SELECT code FROM modules)")
+        report.orphaned_queue_entries = cur.fetchone()[0]
+        if repair:
+          cur.execute("INSERT INTO journal(time, op, module_code, group_id) SELECT ?, ?, module_code, id FROM study_groups "
+                      "WHERE module_code NOT IN (SELECT code FROM modules)", (int(self.clock()), int(JournalOp.GROUP_DELETED)))
+          cur.execute("DELETE FROM study_groups WHERE module_code NOT IN (SELECT code FROM modules)")
+
+          cur.execute("INSERT INTO journal(time, op, module_code, member_id) SELECT ?, ?, module_code, member_id FROM study_group_queue "
+                      "WHERE module_code NOT IN (SELECT code FROM modules)", (int(self.clock()), int(JournalOp.UNQUEUED)))
+          cur.execute("DELETE FROM study_group_queue WHERE module_code NOT IN (SELECT code FROM modules)")
+
+        cur.execute(f"{self.MEMBERSHIP_CTE} SELECT module_code, member_id, group_concat(group_id) FROM membership "
+                    "GROUP BY module_code, member_id HAVING count(*) > 1")
+        report.duplicate_members = [(i[0], i[1], sorted(int(j) for j in i[2].split(','))) for i in cur.fetchall()]
+        # Keep everyone in their oldest group, and take them out of the rest.
+        #
+        # There should only be a handful of these, so it's fine to rewrite them one by one
+        if repair:
+          for module_code, member, group_ids in report.duplicate_members:
+            for group_id in group_ids[1:]:
+              cur.execute("SELECT members FROM study_groups WHERE id=?", (group_id,))
+              members = self.deserialise_members(cur.fetchone()[0])
+              if member in members:
+                members.remove(member)
+              cur.execute("UPDATE study_groups SET members=? WHERE id=?", (self.serialise_members(members), group_id))
+              self.write_journal(cur, JournalOp.MEMBER_REMOVED, module_code=module_code, group_id=group_id, member_id=member)
+
+        cur.execute("SELECT id FROM study_groups WHERE members=''")
+        report.empty_groups = [i[0] for i in cur.fetchall()]
+        if repair:
+          cur.execute("INSERT INTO journal(time, op, module_code, group_id) SELECT ?, ?, module_code, id FROM study_groups WHERE members=''",
+                      (int(self.clock()), int(JournalOp.GROUP_DELETED)))
+          cur.execute("DELETE FROM study_groups WHERE members=''")
+
+        cur.execute(f"{self.MEMBERSHIP_CTE} SELECT q.module_code, q.member_id FROM study_group_queue q "
+                    "WHERE EXISTS (SELECT 1 FROM membership m WHERE m.module_code=q.module_code AND m.member_id=q.member_id)")
+        report.queued_members_in_groups = [(i[0], i[1]) for i in cur.fetchall()]
+        if repair:
+          cur.executemany("DELETE FROM study_group_queue WHERE module_code=? AND member_id=?", report.queued_members_in_groups)
+          for module_code, member in report.queued_members_in_groups:
+            self.write_journal(cur, JournalOp.UNQUEUED, module_code=module_code, member_id=member)
+
+        cur.execute(f"{self.MEMBERSHIP_CTE} SELECT module_code, group_id, count(*) FROM membership "
+                    "GROUP BY group_id HAVING count(*) > ?", (upper_bound,))
+        report.oversized_groups = [(i[0], i[1], i[2]) for i in cur.fetchall()]
+        if repair and not report.is_clean():
+          self.rebuild_stats(cur)
+      except:
+        self.db.rollback()
+        raise
+      if repair:
+        self.db.commit()
+      else:
+        self.db.rollback()
+    return report
+
+  def set_availability(self, member_id: int, slots: Optional[bytes]) -> None:
+    with self.db, closing(self.db.cursor()) as cur:
+      if slots is None:
+        cur.execute("DELETE FROM availability WHERE member_id=?", (member_id,))
+      else:
+        cur.execute("INSERT INTO availability(member_id, slots) VALUES (?, ?) ON CONFLICT(member_id) DO UPDATE SET slots=excluded.slots",
+                    (member_id, slots))
+
+  def get_availability(self, member_ids: Iterable[int]) -> Dict[int, bytes]:
+    member_ids = [int(i) for i in member_ids]
+    ret: Dict[int, bytes] = {}
+    cur: sqlite3.Cursor
+    with closing(self.db.cursor()) as cur:
+      # Stay under sqlite's limit on the number of parameters
+      for start in range(0, len(member_ids), 500):
+        chunk = member_ids[start:start + 500]
+        cur.execute(f"SELECT member_id, slots FROM availability WHERE member_id IN ({','.join('?' * len(chunk))})", chunk)
+        ret.update((i[0], i[1]) for i in cur.fetchall())
+    return ret
+
+  def get_group_threads(self) -> Dict[int, int]:
+    cur: sqlite3.Cursor
+    with closing(self.db.cursor()) as cur:
+      cur.execute("SELECT group_id, thread_id FROM group_threads")
+      return {i[0]: i[1] for i in cur.fetchall()}
+
+  def get_group_thread(self, group_id: int) -> Optional[int]:
+    cur: sqlite3.Cursor
+    with closing(self.db.cursor()) as cur:
+      cur.execute("SELECT thread_id FROM group_threads WHERE group_id=?", (group_id,))
+      res = cur.fetchone()
+      return res[0] if res is not None else None
+
+  def set_group_thread(self, group_id: int, thread_id: Optional[int]) -> None:
+    with self.db, closing(self.db.cursor()) as cur:
+      if thread_id is None:
+        cur.execute("DELETE FROM group_threads WHERE group_id=?", (group_id,))
+      else:
+        cur.execute("INSERT INTO group_threads(group_id, thread_id) VALUES (?, ?) ON CONFLICT(group_id) DO UPDATE SET thread_id=excluded.thread_id",
+                    (group_id, thread_id))
+
+  def load_cooldowns(self, now: float) -> Dict[str, float]:
+    cur: sqlite3.Cursor
+    with closing(self.db.cursor()) as cur:
+      cur.execute("SELECT bucket, tat FROM cooldowns WHERE tat > ?", (now,))
+      return {i[0]: i[1] for i in cur.fetchall()}
+
+  def merge_cooldowns(self, buckets: Dict[str, Tuple[float, float]], now: float) -> Dict[str, float]:
+    cur: sqlite3.Cursor
+    ret: Dict[str, float] = {}
+    with self.db, closing(self.db.cursor()) as cur:
+      for bucket, (tat, added) in buckets.items():
+        # If nobody else has touched the bucket, the stored time plus what we added is just ours. If they have, both count
+        cur.execute("INSERT INTO cooldowns(bucket, tat) VALUES (?, ?) ON CONFLICT(bucket) DO UPDATE SET tat=max(tat + ?, excluded.tat) RETURNING tat",
+                    (bucket, tat, added))
+        ret[bucket] = cur.fetchone()[0]
+      cur.execute("DELETE FROM cooldowns WHERE tat <= ?", (now,))
+    return ret
+
+  def read_journal(self, after_seq: int = 0, until: Optional[int] = None) -> List[JournalEntry]:
+    cur: sqlite3.Cursor
+    with closing(self.db.cursor()) as cur:
+      cur.execute("SELECT seq, time, op, module_code, group_id, member_id, arg FROM journal WHERE seq > ? AND time <= ? ORDER BY seq",
+                  (after_seq, until if until is not None else 2**62))
+      return [JournalEntry(seq=i[0], time=i[1], op=JournalOp(i[2]), module_code=i[3], group_id=i[4], member_id=i[5], arg=i[6]) for i in cur.fetchall()]
+
+  def get_module_stats(self, module_code: Optional[str] = None) -> Dict[str, ModuleStats]:
+    cur: sqlite3.Cursor
+    with closing(self.db.cursor()) as cur:
+      if module_code is None:
+        cur.execute("SELECT module_code, queue_length, group_count, member_count, allocations, total_wait FROM module_stats")
+      else:
+        cur.execute("SELECT module_code, queue_length, group_count, member_count, allocations, total_wait FROM module_stats WHERE module_code=?",
+                    (module_code,))
+      res = cur.fetchall()
+
+      now = int(self.clock())
+      ret: Dict[str, ModuleStats] = {}
+      for i in res:
+        median_wait: Optional[int] = None
+        if i[1] > 0:
+          # This walks half of the module's index range, which is fine for any queue we could reasonably expect
+          cur.execute("SELECT time FROM study_group_queue WHERE module_code=? ORDER BY time LIMIT 1 OFFSET ?", (i[0], i[1] // 2))
+          if (median := cur.fetchone()) is not None:
+            median_wait = max(0, now - int(median[0]))
+        ret[i[0]] = ModuleStats(module_code=i[0], queue_length=i[1], group_count=i[2], member_count=i[3],
+                                allocations=i[4], total_wait=i[5], median_wait=median_wait)
+      return ret
+
+  VACUUM_PAGES = 2000
+  """The most pages `maintain` frees at once, so that it doesn't hold the lock for too long."""
+
+  def maintain(self) -> MaintenanceReport:
+    report = MaintenanceReport()
+    cur: sqlite3.Cursor
+    with closing(self.db.cursor()) as cur:
+      # Only look at part of each index, so this stays quick however big the tables get
+      cur.execute("PRAGMA analysis_limit = 1000")
+      cur.execute("ANALYZE")
       self.db.commit()
+      # This one tells us how much was copied, as the log is empty by the time TRUNCATE reports back
+      cur.execute("PRAGMA wal_checkpoint(PASSIVE)")
+      report.checkpointed_pages = max(0, cur.fetchone()[2])
+      # Then shrink the log file. This gives up (rather than waiting) if someone is reading, which is fine as we'll be back
+      cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+      report.checkpoint_blocked = cur.fetchone()[0] != 0
+      cur.execute("PRAGMA freelist_count")
+      free_before = cur.fetchone()[0]
+      # Each step of this frees one page, but it returns no rows, so execute() would only take the first step
+      cur.executescript(f"PRAGMA incremental_vacuum({int(self.VACUUM_PAGES)})")
+      cur.execute("PRAGMA freelist_count")
+      report.free_pages = cur.fetchone()[0]
+      report.freed_pages = free_before - report.free_pages
+    return report
+
+  @property
+  def archive_path(self) -> str:
+    """Where archived groups and queue entries go. This is a separate file, so the live one stays small."""
+    return self.path + ".archive"
 
-  def peek_queue_for_study_group(self, module_code: str, limit: int = 1) -> List[QueuedStudyGroupInfo]:
+  def archive_batch(self, before: int, limit: int = 500) -> Tuple[int, int]:
     cur: sqlite3.Cursor
     with closing(self.db.cursor()) as cur:
-      cur.execute("SELECT module_code, member_id, time FROM study_group_queue WHERE module_code=? LIMIT ?", (module_code, limit))
-      return [QueuedStudyGroupInfo(module_code = res[0], member_id=res[1], time=datetime.datetime.utcfromtimestamp(res[2])) for res in cur.fetchall()]
+      # This can't be done in a transaction
+      cur.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+      try:
+        cur.execute("CREATE TABLE IF NOT EXISTS archive.study_groups ("
+                    "id INTEGER NOT NULL PRIMARY KEY,"
+                    "module_code TEXT NOT NULL,"
+                    "date_created INTEGER NOT NULL,"
+                    "members TEXT NOT NULL,"
+                    "invite_only BOOL NOT NULL,"
+                    "archived INTEGER NOT NULL"
+                    ")")
+        cur.execute("CREATE TABLE IF NOT EXISTS archive.study_group_queue ("
+                    "module_code TEXT NOT NULL,"
+                    "member_id INTEGER NOT NULL,"
+                    "time INTEGER NOT NULL,"
+                    "archived INTEGER NOT NULL"
+                    ")")
+        now = int(self.clock())
+        with self.db:
+          cur.execute("BEGIN IMMEDIATE")
+          # The ids go through as a JSON array, so that the batch can be any size
+          cur.execute("SELECT id FROM main.study_groups WHERE date_created < ? ORDER BY id LIMIT ?", (before, limit))
+          group_ids = json.dumps([i[0] for i in cur.fetchall()])
+          cur.execute("INSERT INTO archive.study_groups(id, module_code, date_created, members, invite_only, archived) "
+                      "SELECT id, module_code, date_created, members, invite_only, ? FROM main.study_groups WHERE id IN (SELECT value FROM json_each(?))",
+                      (now, group_ids))
+          cur.execute("INSERT INTO main.journal(time, op, module_code, group_id) "
+                      "SELECT ?, ?, module_code, id FROM main.study_groups WHERE id IN (SELECT value FROM json_each(?))",
+                      (now, int(JournalOp.GROUP_ARCHIVED), group_ids))
+          cur.execute("DELETE FROM main.study_groups WHERE id IN (SELECT value FROM json_each(?))", (group_ids,))
+          groups = cur.rowcount
+
+          cur.execute("SELECT id FROM main.study_group_queue WHERE time < ? ORDER BY id LIMIT ?", (before, limit))
+          queue_ids = json.dumps([i[0] for i in cur.fetchall()])
+          cur.execute("INSERT INTO archive.study_group_queue(module_code, member_id, time, archived) "
+                      "SELECT module_code, member_id, time, ? FROM main.study_group_queue WHERE id IN (SELECT value FROM json_each(?))",
+                      (now, queue_ids))
+          cur.execute("INSERT INTO main.journal(time, op, module_code, member_id) "
+                      "SELECT ?, ?, module_code, member_id FROM main.study_group_queue WHERE id IN (SELECT value FROM json_each(?))",
+                      (now, int(JournalOp.QUEUE_ARCHIVED), queue_ids))
+          cur.execute("DELETE FROM main.study_group_queue WHERE id IN (SELECT value FROM json_each(?))", (queue_ids,))
+          queued = cur.rowcount
+      finally:
+        cur.execute("DETACH DATABASE archive")
+    return groups, queued
+
+  # The number of members in a comma separated `members` column, without having to split it up
+  MEMBER_COUNT_SQL = "(length({0}) - length(replace({0}, ',', '')) + ({0} != ''))"
+
+  @classmethod
+  def rebuild_stats(cls, cur: sqlite3.Cursor) -> None:
+    """Recalculates the counts in module_stats from scratch. The triggers keep them right after this."""
+    cur.execute("INSERT INTO module_stats(module_code) SELECT code FROM modules WHERE true ON CONFLICT DO NOTHING")
+    cur.execute("DELETE FROM module_stats WHERE module_code NOT IN (SELECT code FROM modules)")
+    cur.execute("UPDATE module_stats SET "
+                "queue_length=(SELECT count(*) FROM study_group_queue q WHERE q.module_code=module_stats.module_code),"
+                "group_count=(SELECT count(*) FROM study_groups g WHERE g.module_code=module_stats.module_code),"
+                f"member_count=(SELECT coalesce(sum({cls.MEMBER_COUNT_SQL.format('g.members')}), 0) FROM study_groups g WHERE g.module_code=module_stats.module_code)")
+
+  QUEUE_TABLE_SQL = ("CREATE TABLE {} ("
+                     "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,"
+                     "module_code TEXT NOT NULL,"
+                     "member_id INTEGER NOT NULL,"
+                     "time INTEGER NOT NULL,"
+                     ""
+                     "UNIQUE (module_code, member_id),"
+                     "FOREIGN KEY (module_code) REFERENCES modules(code)"
+                     ")")
+
+  # The queue as version 1 left it. Its migration has to keep making exactly this, so that version 3's still applies after it
+  QUEUE_TABLE_SQL_V1 = ("CREATE TABLE {} ("
+                        "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,"
+                        "module_code TEXT NOT NULL,"
+                        "member_id TEXT NOT NULL,"
+                        "time BIGINT NOT NULL,"
+                        ""
+                        "UNIQUE (module_code, member_id),"
+                        "FOREIGN KEY (module_code) REFERENCES modules(code)"
+                        ")")
+
+  def seed_journal(self, cur: sqlite3.Cursor) -> None:
+    """
+    Records everything already in the database at the start of a new journal, so that replaying it gives the same state.
+
+    Modules have no creation time, so they go at the very start. Everything else goes at the time it was made.
+    """
+    cur.execute("INSERT INTO journal(time, op, module_code, arg) SELECT 0, ?, code, name FROM modules ORDER BY code",
+                (int(JournalOp.MODULE_ADDED),))
+    cur.execute("INSERT INTO journal(time, op, module_code, group_id, arg) "
+                "SELECT date_created, ?, module_code, id, CASE WHEN invite_only THEN '1' ELSE '0' END FROM study_groups ORDER BY id",
+                (int(JournalOp.GROUP_CREATED),))
+    cur.execute(f"{self.MEMBERSHIP_CTE} INSERT INTO journal(time, op, module_code, group_id, member_id) "
+                "SELECT g.date_created, ?, m.module_code, m.group_id, m.member_id FROM membership m JOIN study_groups g ON g.id=m.group_id "
+                "ORDER BY m.group_id", (int(JournalOp.MEMBER_ADDED),))
+    cur.execute("INSERT INTO journal(time, op, module_code, member_id) SELECT time, ?, module_code, member_id FROM study_group_queue "
+                "ORDER BY time, id", (int(JournalOp.QUEUED),))
+
+  SCHEMA_VERSION = 3
+  """Bump this, and add a step to migrate_db, whenever an existing table needs to change."""
+
+  def migrate_db(self, cur: sqlite3.Cursor) -> None:
+    """Brings tables created by older versions up to date. Tables that didn't exist are already created in the latest form."""
+    cur.execute("PRAGMA user_version")
+    version = cur.fetchone()[0]
+    if version >= self.SCHEMA_VERSION:
+      return
+    print(f"Migrating database from version {version} to {self.SCHEMA_VERSION}")
+
+    if version < 1:
+      # The queue used to only let each user queue for one module at a time.
+      #
+      # sqlite can't change constraints, so we have to copy the table
+      cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='study_group_queue'")
+      if "member_id TEXT NOT NULL UNIQUE" in cur.fetchone()[0]:
+        cur.execute(self.QUEUE_TABLE_SQL_V1.format("study_group_queue_new"))
+        cur.execute("INSERT INTO study_group_queue_new(id, module_code, member_id, time) SELECT id, module_code, member_id, time FROM study_group_queue")
+        cur.execute("DROP TABLE study_group_queue")
+        cur.execute("ALTER TABLE study_group_queue_new RENAME TO study_group_queue")
+
+    if version < 2:
+      # Let `maintain` give unused pages back bit by bit. This only takes effect after a full VACUUM, which can't be in a transaction
+      cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+      self.db.commit()
+      cur.execute("VACUUM")
+
+    if version < 3:
+      # Queued member ids used to be TEXT, and times fractional, so every read had to convert them back.
+      #
+      # As with version 1, sqlite can't change a column's type, so we have to copy the table
+      cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='study_group_queue'")
+      if "member_id TEXT" in cur.fetchone()[0]:
+        # Do the whole copy in one transaction, so a crash halfway doesn't leave the new table behind
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(self.QUEUE_TABLE_SQL.format("study_group_queue_new"))
+        cur.execute("INSERT INTO study_group_queue_new(id, module_code, member_id, time) "
+                    "SELECT id, module_code, CAST(member_id AS INTEGER), CAST(time AS INTEGER) FROM study_group_queue")
+        cur.execute("DROP TABLE study_group_queue")
+        cur.execute("ALTER TABLE study_group_queue_new RENAME TO study_group_queue")
+
+    # PRAGMAs can't take parameters, but this is our own constant
+    cur.execute(f"PRAGMA user_version = {int(self.SCHEMA_VERSION)}")
+    self.db.commit()
 
   def init_db(self):
     cur: sqlite3.Cursor
     with closing(self.db.cursor()) as cur:
+      # A brand new database gets every table in its latest form, so has nothing to migrate
+      cur.execute("SELECT NOT EXISTS (SELECT 1 FROM sqlite_master WHERE type='table' AND name='modules')")
+      if cur.fetchone()[0]:
+        cur.execute(f"PRAGMA user_version = {int(self.SCHEMA_VERSION)}")
       cur.execute("CREATE TABLE IF NOT EXISTS modules ("
                   "code TEXT NOT NULL PRIMARY KEY UNIQUE,"
                   "name TEXT NOT NULL"
@@ -374,40 +1380,200 @@ class SqliteDatabaseDriver(DatabaseDriver):
                   ""
                   "FOREIGN KEY (module_code) REFERENCES modules(code)"
                   ")")
-      cur.execute("CREATE TABLE IF NOT EXISTS study_group_queue ("
-                  "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,"
-                  "module_code TEXT NOT NULL,"
-                  "member_id TEXT NOT NULL UNIQUE,"
-                  "time BIGINT NOT NULL,"
-                  ""
-                  "FOREIGN KEY (module_code) REFERENCES modules(code)"
+      cur.execute(self.QUEUE_TABLE_SQL.format("IF NOT EXISTS study_group_queue"))
+      self.migrate_db(cur)
+      cur.execute("SELECT NOT EXISTS (SELECT 1 FROM sqlite_master WHERE type='table' AND name='journal')")
+      journal_missing = cur.fetchone()[0]
+      if journal_missing:
+        # Make and seed the journal together, so that a crash in between can't leave it missing what was already here
+        cur.execute("BEGIN IMMEDIATE")
+      # Append only: there are deliberately no foreign keys, so that history outlives the things it describes
+      cur.execute("CREATE TABLE IF NOT EXISTS journal ("
+                  "seq INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
+                  "time INTEGER NOT NULL,"
+                  "op INTEGER NOT NULL,"
+                  "module_code TEXT,"
+                  "group_id INTEGER,"
+                  "member_id INTEGER,"
+                  "arg TEXT"
+                  ")")
+      if journal_missing:
+        self.seed_journal(cur)
+        self.db.commit()
+      cur.execute("CREATE TABLE IF NOT EXISTS availability ("
+                  "member_id INTEGER NOT NULL PRIMARY KEY,"
+                  "slots BLOB NOT NULL"
+                  ")")
+      # No foreign key, so that we still know about the threads of deleted groups, and can clean them up
+      cur.execute("CREATE TABLE IF NOT EXISTS group_threads ("
+                  "group_id INTEGER NOT NULL PRIMARY KEY,"
+                  "thread_id INTEGER NOT NULL"
+                  ")")
+      # Each bucket is just the time it will be full again, see cauch_e.cooldown
+      cur.execute("CREATE TABLE IF NOT EXISTS cooldowns ("
+                  "bucket TEXT NOT NULL PRIMARY KEY,"
+                  "tat REAL NOT NULL"
+                  ") WITHOUT ROWID")
+      cur.execute("CREATE INDEX IF NOT EXISTS study_group_queue_by_time ON study_group_queue(module_code, time)")
+      cur.execute("CREATE INDEX IF NOT EXISTS study_groups_by_module ON study_groups(module_code, id)")
+
+      # Per-module counters, so that stats don't need to scan everything.
+      #
+      # The counts are kept up to date by the triggers below, and the wait times by add_to_study_group
+      cur.execute("CREATE TABLE IF NOT EXISTS module_stats ("
+                  "module_code TEXT NOT NULL PRIMARY KEY,"
+                  "queue_length INTEGER NOT NULL DEFAULT 0,"
+                  "group_count INTEGER NOT NULL DEFAULT 0,"
+                  "member_count INTEGER NOT NULL DEFAULT 0,"
+                  "allocations INTEGER NOT NULL DEFAULT 0,"
+                  "total_wait INTEGER NOT NULL DEFAULT 0"
                   ")")
-  def __init__(self, path: str):
+      new_count = self.MEMBER_COUNT_SQL.format("NEW.members")
+      old_count = self.MEMBER_COUNT_SQL.format("OLD.members")
+      cur.execute("CREATE TRIGGER IF NOT EXISTS module_stats_module_insert AFTER INSERT ON modules BEGIN "
+                  "INSERT INTO module_stats(module_code) VALUES (NEW.code) ON CONFLICT DO NOTHING; END")
+      cur.execute("CREATE TRIGGER IF NOT EXISTS module_stats_module_delete AFTER DELETE ON modules BEGIN "
+                  "DELETE FROM module_stats WHERE module_code=OLD.code; END")
+      cur.execute("CREATE TRIGGER IF NOT EXISTS module_stats_group_insert AFTER INSERT ON study_groups BEGIN "
+                  f"UPDATE module_stats SET group_count=group_count+1, member_count=member_count+{new_count} WHERE module_code=NEW.module_code; END")
+      cur.execute("CREATE TRIGGER IF NOT EXISTS module_stats_group_delete AFTER DELETE ON study_groups BEGIN "
+                  f"UPDATE module_stats SET group_count=group_count-1, member_count=member_count-{old_count} WHERE module_code=OLD.module_code; END")
+      cur.execute("CREATE TRIGGER IF NOT EXISTS module_stats_group_update AFTER UPDATE OF members, module_code ON study_groups BEGIN "
+                  f"UPDATE module_stats SET group_count=group_count-1, member_count=member_count-{old_count} WHERE module_code=OLD.module_code; "
+                  f"UPDATE module_stats SET group_count=group_count+1, member_count=member_count+{new_count} WHERE module_code=NEW.module_code; END")
+      cur.execute("CREATE TRIGGER IF NOT EXISTS module_stats_queue_insert AFTER INSERT ON study_group_queue BEGIN "
+                  "UPDATE module_stats SET queue_length=queue_length+1 WHERE module_code=NEW.module_code; END")
+      cur.execute("CREATE TRIGGER IF NOT EXISTS module_stats_queue_delete AFTER DELETE ON study_group_queue BEGIN "
+                  "UPDATE module_stats SET queue_length=queue_length-1 WHERE module_code=OLD.module_code; END")
+      cur.execute("CREATE TRIGGER IF NOT EXISTS module_stats_queue_update AFTER UPDATE OF module_code ON study_group_queue BEGIN "
+                  "UPDATE module_stats SET queue_length=queue_length-1 WHERE module_code=OLD.module_code; "
+                  "UPDATE module_stats SET queue_length=queue_length+1 WHERE module_code=NEW.module_code; END")
+
+      # This is the one full scan, so that the counters are right even for databases from before they existed
+      self.rebuild_stats(cur)
+    self.db.commit()
+  def __init__(self, path: str, on_use: Optional[Callable[[], None]] = None, clock: Callable[[], float] = time.time,
+               read_only: bool = False):
     super().__init__()
-    self.db = sqlite3.connect(path)
+    self.module_listeners = []
+    self.path = path
+    self.on_use = on_use
+    self.clock = clock
+    self.read_only = read_only
+    # The connection is opened on first use, and again whenever it is used after being closed
+    self._db = None
+    self._replica = None
+    self._replica_copied = None
+    self._replica_replaced = False
 
+    # Replicas are copies of an initialised database, and can't be written to anyway
+    if not read_only:
+      # It's easier not to check, and just run the initialisation from scratch
+      #
+      # XXX: If this function ends up wiping things, then PLEASE DO THE CHECK FIRST
+      self.init_db()
 
-    cur: sqlite3.Cursor
-    with closing(self.db.cursor()) as cur:
-      cur.execute("PRAGMA foreign_keys = ON")
+class GuildDrivers:
+  """Each server's own database, opened when it is used and closed again once it is among the least recently used.
+
+  As every server has its own file, writes in one never wait on another's lock.
+  """
+  path_template: str
+  """The path of each database, with {guild_id} in place of the server's id."""
+
+  max_open: int
+  """How many databases can be open at once."""
+
+  drivers: Dict[int, SqliteDatabaseDriver]
+  """Every driver we have made, indexed by server id. These are kept even when closed, so their listeners stay put."""
+
+  open: "collections.OrderedDict[int, None]"
+  """The servers whose databases are open, least recently used first."""
+
+  def path(self, guild_id: int) -> str:
+    return self.path_template.format(guild_id=guild_id)
 
-    # It's easier not to check, and just run the initialisation from scratch
-    #
-    # XXX: If this function ends up wiping things, then PLEASE DO THE CHECK FIRST
-    self.init_db()
+  def existing(self) -> List[str]:
+    """:return: The paths of the databases that have been made so far."""
+    return glob.glob(glob.escape(self.path_template).replace("{guild_id}", "[0-9]*"))
+
+  def get(self, guild_id: int) -> SqliteDatabaseDriver:
+    ret = self.drivers.get(guild_id)
+    if ret is None:
+      ret = SqliteDatabaseDriver(self.path(guild_id), on_use=lambda: self.used(guild_id))
+      self.drivers[guild_id] = ret
+    return ret
+
+  def used(self, guild_id: int) -> None:
+    self.open[guild_id] = None
+    self.open.move_to_end(guild_id)
+    while len(self.open) > self.max_open:
+      oldest, _ = self.open.popitem(last=False)
+      self.drivers[oldest].close()
+
+  def __init__(self, path_template: str, max_open: int):
+    self.path_template = path_template
+    self.max_open = max_open
+    self.drivers = {}
+    self.open = collections.OrderedDict()
 
 driver: DatabaseDriver
-def load_db():
-  global driver
+"""The shared database, used for every server unless they are partitioned, and outside of servers regardless."""
+
+guild_drivers: Optional[GuildDrivers] = None
+"""Each server's own database, if they are partitioned."""
 
-  driver_type_l = cauch_e.config.obj["db"]
-  if len(driver_type_l) != 1:
-    print("Invalid config: there must be exactly one database driver specified")
+def for_guild(guild_id: Optional[int]) -> DatabaseDriver:
+  """
+  Gets the database for a server.
+  :param guild_id: The id of the server, or None if we aren't in one.
+  :return: The server's own database if they are partitioned, otherwise the shared one.
+  """
+  if guild_drivers is None or guild_id is None:
+    return driver
+  return guild_drivers.get(guild_id)
+
+def partitions(guild_ids: Iterable[int]) -> Dict[Optional[int], DatabaseDriver]:
+  """
+  Gets the distinct databases for some servers, for background work that needs to go through each of them once.
+  :param guild_ids: The servers the bot is in.
+  :return: The databases, indexed by server id, or just the shared database under None if they aren't partitioned.
+  """
+  if guild_drivers is None:
+    return {None: driver}
+  return {guild_id: guild_drivers.get(guild_id) for guild_id in guild_ids}
+
+def split_shared(guild_id: int) -> bool:
+  """
+  Copies the shared database into a server's own database, for when `guild_path` is set on a bot that is already in use.
+  Otherwise, the server starts from an empty database, and everything in the shared one is left behind.
+
+  The shared database doesn't know which server its modules, groups and queues are for, so everything is copied.
+  Only do this for the server they belong to.
+  :param guild_id: The server to copy the shared database to.
+  :return: Whether it was copied. It isn't if the server already has its own database.
+  """
+  path = guild_drivers.path(guild_id)
+  if os.path.exists(path):
+    return False
+  driver.copy_to(path)
+  return True
+
+def load_db():
+  global driver, guild_drivers
 
-  driver_type = next(iter(driver_type_l))
-  db_conf = cauch_e.config.obj["db"][driver_type]
+  # The config has already been validated, so we don't need to check the shape of this
+  db_conf = cauch_e.config.typed.db
 
-  match driver_type:
-    case "sqlite": driver = SqliteDatabaseDriver(db_conf["path"])
+  match db_conf.driver:
+    case "sqlite":
+      driver = SqliteDatabaseDriver(db_conf.path)
+      if db_conf.guild_path is not None:
+        guild_drivers = GuildDrivers(db_conf.guild_path, db_conf.max_open)
+        # The first time we partition, every server would quietly start from scratch
+        if len(guild_drivers.existing()) == 0 and next(driver.iter_modules(limit=1), None) is not None:
+          print(f"WARNING: db.sqlite.guild_path is set, so each server gets its own database, but the modules, groups and queues "
+                f"in '{db_conf.path}' won't be moved into them. To keep them, stop the bot and run "
+                f"'python -m cauch_e --split-guild <server id>' for the server they belong to first.")
     case _:
-      raise cauch_e.config.BadConfig(f"Unknown driver type {driver_type}")
+      raise cauch_e.config.BadConfig(f"Unknown driver type {db_conf.driver}")
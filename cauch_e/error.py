@@ -1,22 +1,88 @@
+import asyncio
+import dataclasses
 import datetime
-import json
-import sys
+import hashlib
+import logging
+import logging.handlers
+import re
 import traceback
-from typing import Optional, Any
+from typing import Optional, Any, Dict, List
 
 import discord
 import cauch_e.config
 import discord.ext.commands
 
-async def report_error(bot: discord.ext.commands.Bot, interaction: discord.Interaction, message: Optional[str] = "", exn: Optional[Exception] = None):
+LOG_PATH = "cauch-e-errors.log"
+"""Where full error details are written. Rotated at LOG_MAX_BYTES, keeping LOG_BACKUPS old files."""
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 5
+
+SUMMARY_INTERVAL = 5 * 60
+"""How often (in seconds) repeated errors are summarised in the report channel."""
+MAX_REPORTS_PER_INTERVAL = 5
+"""How many new errors we post in full per interval before folding them into the summary too."""
+MAX_FINGERPRINTS = 1000
+"""How many distinct errors we keep counts for before lumping the rest together."""
+
+@dataclasses.dataclass
+class _ErrorRecord:
+  fingerprint: str
+  message: str
+  stack: traceback.StackSummary
+  time: datetime.datetime
+  interaction: Optional[discord.Interaction]
+
+@dataclasses.dataclass
+class _ErrorCounts:
+  first: _ErrorRecord
+  """The first time we saw this error, which is the one we describe in full."""
+
+  total: int = 1
+  """How many times we have seen this error since startup."""
+
+  unreported: int = 0
+  """How many repeats there have been since the last summary."""
+
+_counts: Dict[str, _ErrorCounts] = {}
+_pending: List[_ErrorRecord] = []
+# This doesn't belong to an event loop until something waits on it, so it is safe to make at import time.
+# Making it here means errors from before `run_reporter` starts still wake it as soon as it does
+_wakeup = asyncio.Event()
+_logger: Optional[logging.Logger] = None
+
+def _get_logger() -> logging.Logger:
+  global _logger
+  if _logger is None:
+    _logger = logging.getLogger("cauch_e.error")
+    _logger.propagate = False
+    _logger.setLevel(logging.ERROR)
+    try:
+      handler = logging.handlers.RotatingFileHandler(LOG_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+      handler.setFormatter(logging.Formatter("%(message)s"))
+      _logger.addHandler(handler)
+    except OSError:
+      print(f"Cannot open error log '{LOG_PATH}', critical errors will only be printed")
+  return _logger
+
+def _fingerprint(message: str, stack: traceback.StackSummary) -> str:
+  # Ids and counts end up in messages, so strip numbers out: "user 123 is in groups [4, 5]" is the same fault for everyone
+  digest = hashlib.sha1(re.sub(r"\d+", "#", message).encode())
+  for frame in stack:
+    digest.update(f"{frame.filename}:{frame.lineno}:{frame.name}\n".encode())
+  return digest.hexdigest()[:12]
+
+async def report_error(bot: discord.ext.commands.Bot, interaction: Optional[discord.Interaction], message: Optional[str] = "", exn: Optional[Exception] = None):
   """
     This should *only* be used to report *very* bad things happening, such as DB inconsistency,
     not things like "module couldn't be found".
 
     If you don't follow this rule, people will ignore all error messages, and that will be bad.
 
-    :param bot The bot object, used for the various fallback reporting methods
-    :param interaction The interaction that caused this error.
+    This never waits on Discord: the error is logged and queued, and `run_reporter` posts it later.
+    Repeats of the same error (same stack and message, ignoring numbers) are counted and summarised rather than reposted.
+
+    :param bot The bot object. Unused, kept for compatibility with older callers.
+    :param interaction The interaction that caused this error, or None for background jobs.
     :param message A human-readable description of what went wrong.
     :param exn An exception that we grab the stack from instead of the call site
   """
@@ -27,60 +93,168 @@ async def report_error(bot: discord.ext.commands.Bot, interaction: discord.Inter
   try:
     stack: traceback.StackSummary
     if exn is None:
-      stack = traceback.extract_stack()
+      # Skip our own frame
+      stack = traceback.StackSummary.from_list(traceback.extract_stack()[:-1])
     else:
       stack = traceback.TracebackException.from_exception(exn).stack
 
-    # Before we do anything, print the error out
-    print('-' * 80)
-    print(f"Encountered critical error at {datetime.datetime.now()}")
-    traceback.print_list(stack)
-    print(message)
-    print(f"{interaction.data}")
-    # Do this last, as this may fail (because python), and we want to make sure that something gets posted.
-    print(interaction.user)
-    print('-' * 80)
+    record = _ErrorRecord(fingerprint=_fingerprint(message, stack), message=message, stack=stack,
+                          time=datetime.datetime.now(), interaction=interaction)
 
-    try:
-      channel_id = cauch_e.config.obj["discord"]["report_channel"]
-      channel = interaction.guild.get_channel(channel_id)
-      admin_role_id = cauch_e.config.obj["discord"]["admin_role"]
-      admin_role = interaction.guild.get_role(admin_role_id)
-      if channel is None or admin_role is None or not channel.permissions_for(interaction.guild.me).send_messages:
-        raise Exception("Cannot message report channel")
+    counts = _counts.get(record.fingerprint)
+    if counts is not None:
+      counts.total += 1
+      counts.unreported += 1
+    elif len(_counts) >= MAX_FINGERPRINTS:
+      record.fingerprint = "overflow"
+      counts = _counts.setdefault("overflow", _ErrorCounts(first=record, total=0))
+      counts.total += 1
+      counts.unreported += 1
+    else:
+      _counts[record.fingerprint] = _ErrorCounts(first=record)
+      _pending.append(record)
+      _wakeup.set()
 
-      try:
-        embed = discord.Embed(color=discord.Color.red(), title="Critical Cauch-E error!", type="image",
-                              description=f"{admin_role.mention} Something *really* bad has happened, and you need to get someone who knows what they're doing to fix it.")
-        embed.add_field(name="Message", value=message, inline=True)
-        embed.add_field(name="User", value=interaction.user, inline=True)
-        embed.add_field(name="Backtrace", value=''.join(traceback.format_list(stack)[-4:-1]), inline=True)
-        embed.add_field(name="Interaction", value=interaction.data, inline=True)
+    # Full details go to the log every time, but we only shout about the first one
+    details = [
+      '-' * 80,
+      f"Encountered critical error {record.fingerprint} (#{_counts[record.fingerprint].total}) at {record.time}",
+      ''.join(traceback.format_list(stack)).rstrip(),
+      message,
+    ]
+    if interaction is not None:
+      details.append(f"{interaction.data}")
+      details.append(f"{interaction.user}")
+    details.append('-' * 80)
+    _get_logger().error('\n'.join(details))
+    print(f"Critical error {record.fingerprint}: {message}")
+  except:
+    # Don't let reporting an error become an error itself
+    traceback.print_exc()
+
+async def _post_report(channel: discord.abc.Messageable, admin_role: discord.Role, record: _ErrorRecord):
+  try:
+    embed = discord.Embed(color=discord.Color.red(), title="Critical Cauch-E error!", type="image",
+                          description=f"{admin_role.mention} Something *really* bad has happened, and you need to get someone who knows what they're doing to fix it.")
+    embed.add_field(name="Message", value=record.message, inline=True)
+    embed.add_field(name="Fingerprint", value=record.fingerprint, inline=True)
+    if record.interaction is not None:
+      embed.add_field(name="User", value=record.interaction.user, inline=True)
+    embed.add_field(name="Backtrace", value=''.join(traceback.format_list(record.stack)[-4:-1]) or "(none)", inline=True)
+    if record.interaction is not None:
+      embed.add_field(name="Interaction", value=record.interaction.data, inline=True)
+
+    await channel.send(embed=embed)
+
+  except discord.HTTPException:
+    # If we cannot report it properly, just spam everyone, including the channel and the user who triggered it
+    await channel.send(f"FATAL Cauch-E error {record.fingerprint}! Something went so badly wrong the bot literally cannot describe it. Check {LOG_PATH}.")
+    raise
 
-        await channel.send(embed=embed)
+async def _post_summary(channel: discord.abc.Messageable, folded: List[_ErrorRecord]):
+  lines = []
+  for fingerprint, counts in _counts.items():
+    if counts.unreported > 0:
+      lines.append(f"`{fingerprint}` x{counts.unreported} ({counts.total} total): {counts.first.message[:100]}")
+      counts.unreported = 0
+  for record in folded:
+    lines.append(f"`{record.fingerprint}` (new, not posted in full): {record.message[:100]}")
+  if len(lines) == 0:
+    return
 
-      except:
-        # If we cannot report it properly, just spam everyone, including the channel and the user who triggered it
-        await channel.send(f"FATAL Cauch-E error! Something went so badly wrong the bot literally cannot describe it.")
-        raise
+  header = f"Critical errors in the last {SUMMARY_INTERVAL // 60} minutes:\n"
+  # Stay well clear of the 2000 character limit
+  body = ""
+  for i, line in enumerate(lines):
+    if len(header) + len(body) + len(line) > 1800:
+      body += f"... and {len(lines) - i} more. Check {LOG_PATH}."
+      break
+    body += line + "\n"
+  await channel.send(header + body)
 
+async def _panic(bot: discord.ext.commands.Bot, records: List[_ErrorRecord]):
+  # If we can't even report the error, we are in deeeeep trouble
+  try:
+    await bot.change_presence(status=discord.Status.do_not_disturb, activity=discord.Activity(type=discord.ActivityType.playing, name="BOT FAILURE! SPAM THE COMMITTEE TO FIX IT!"))
+  except:
+    traceback.print_exc()
+  # Try begging the users for help. Do this last, because it will probably fail at this point.
+  for record in records:
+    if record.interaction is None:
+      continue
+    # Making it ephemeral means we don't accidentally leak confidential information, and may need less perms idk
+    msg = "You must immediately contact the committee, as a severe fault has been detected in the bot!"
+    try:
+      try:
+        await record.interaction.response.send_message(msg, ephemeral=True)
+      # Handle the case where we already responded to it
+      except discord.InteractionResponded:
+        await record.interaction.followup.send(msg, ephemeral=True)
     except:
       traceback.print_exc()
-      # If we can't even report the error, we are in deeeeep trouble
-      await bot.change_presence(status=discord.Status.do_not_disturb, activity=discord.Activity(type=discord.ActivityType.playing, name="BOT FAILURE! SPAM THE COMMITTEE TO FIX IT!"))
-      # Try begging the user for help. Do this last, because it will probably fail at this point.
-      if interaction is not None:
-        # Making it ephemeral means we don't accidentally leak confidential information, and may need less perms idk
-        msg = "You must immediately contact the committee, as a severe fault has been detected in the bot!"
+
+async def run_reporter(bot: discord.ext.commands.Bot):
+  """
+  Posts queued errors to the report channel, and periodically summarises repeats.
+
+  Runs forever, so should be started as a task on the bot's event loop.
+  """
+  await bot.wait_until_ready()
+
+  next_summary = asyncio.get_running_loop().time() + SUMMARY_INTERVAL
+  posted_this_interval = 0
+  folded: List[_ErrorRecord] = []
+
+  while True:
+    try:
+      await asyncio.wait_for(_wakeup.wait(), timeout=max(0., next_summary - asyncio.get_running_loop().time()))
+    except asyncio.TimeoutError:
+      pass
+    _wakeup.clear()
+
+    records = _pending.copy()
+    _pending.clear()
+    # How many of `records` have been posted or folded, so none get lost if something goes wrong
+    handled = 0
+    try:
+      channel = bot.get_channel(cauch_e.config.typed.discord.report_channel)
+      if channel is None or not channel.permissions_for(channel.guild.me).send_messages:
+        raise Exception("Cannot message report channel")
+      admin_role = channel.guild.get_role(cauch_e.config.typed.discord.admin_role)
+      if admin_role is None:
+        raise Exception("Cannot find admin role")
+
+      unposted: List[_ErrorRecord] = []
+      for record in records:
+        handled += 1
+        # Don't let a burst of distinct errors flood the channel either
+        if posted_this_interval >= MAX_REPORTS_PER_INTERVAL:
+          folded.append(record)
+          continue
+        posted_this_interval += 1
         try:
-          await interaction.response.send_message(msg, ephemeral=True)
-        # Handle the case where we already responded to it
-        except discord.InteractionResponded:
-          await interaction.followup.send(msg, ephemeral=True)
-      return
-  except:
-    traceback.print_exc()
-    # If we screw up *this* badly, we almost certainly cannot do anything. Something is deeply screwed at the logic level.
-    # In addition, the only way to get attention is to exit, which we will do after complaining.
-    print("Bot assumed contradictory axioms, and is therefore screwed.")
-    sys.exit(1)
\ No newline at end of file
+          await _post_report(channel, admin_role, record)
+        except asyncio.CancelledError:
+          raise
+        except:
+          # Carry on with the rest, and mention this one in the summary instead
+          traceback.print_exc()
+          unposted.append(record)
+      if len(unposted) > 0:
+        folded += unposted
+        await _panic(bot, unposted)
+
+      if asyncio.get_running_loop().time() >= next_summary:
+        await _post_summary(channel, folded)
+        folded.clear()
+        posted_this_interval = 0
+        next_summary = asyncio.get_running_loop().time() + SUMMARY_INTERVAL
+    except asyncio.CancelledError:
+      raise
+    except:
+      traceback.print_exc()
+      # Whatever we didn't get to goes in the next summary that makes it through
+      folded += records[handled:]
+      await _panic(bot, records[handled:])
+      # Don't spin if the channel is gone
+      next_summary = asyncio.get_running_loop().time() + SUMMARY_INTERVAL
@@ -0,0 +1,119 @@
+"""Tracking for long-running background work, like stirring every group
+
+Discord only gives us 3 seconds to respond to an interaction, so anything slower should defer, run as a job, and
+use `follow` to keep the user updated.
+"""
+import asyncio
+import dataclasses
+import datetime
+import itertools
+import traceback
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import discord
+
+import cauch_e.error
+
+KEEP_FINISHED = 20
+"""How many finished jobs we remember for /jobs."""
+
+@dataclasses.dataclass
+class Job:
+  id: int
+  """A unique id, for telling jobs apart in /jobs."""
+
+  name: str
+  """What the job is doing."""
+
+  started_by: Optional[str]
+  """Who started the job, or None if it was scheduled."""
+
+  started: datetime.datetime
+  """When the job started."""
+
+  progress: Dict[str, int] = dataclasses.field(default_factory=dict)
+  """Counters of things that have been done so far, like "groups created"."""
+
+  totals: Dict[str, int] = dataclasses.field(default_factory=dict)
+  """How many of each counter there will be in total, if known."""
+
+  finished: Optional[datetime.datetime] = None
+  """When the job finished, or None if it is still running."""
+
+  error: Optional[str] = None
+  """What went wrong, if the job failed."""
+
+  task: Optional[asyncio.Task] = None
+
+  def increment(self, counter: str, amount: int = 1) -> None:
+    self.progress[counter] = self.progress.get(counter, 0) + amount
+
+  def describe(self) -> str:
+    if self.finished is None:
+      status = f"running for {datetime.datetime.now() - self.started}"
+    elif self.error is not None:
+      status = f"failed after {self.finished - self.started}: {self.error}"
+    else:
+      status = f"finished in {self.finished - self.started}"
+
+    counters = ", ".join(f"{counter} {count}" + (f"/{self.totals[counter]}" if counter in self.totals else "")
+                         for counter, count in self.progress.items())
+    return f"#{self.id} {self.name}" + (f" (by {self.started_by})" if self.started_by else "") + f": {status}" + (f". {counters}" if counters else "")
+
+jobs: Dict[int, Job] = {}
+_ids = itertools.count(1)
+
+def start_job(name: str, f: Callable[[Job], Awaitable[Any]], started_by: Optional[str] = None) -> Job:
+  """
+  Runs something as a tracked job in the background.
+  :param name: What the job is doing.
+  :param f: The work to do. It is given the job, so it can update the progress.
+  :param started_by: Who started the job, or None if it was scheduled.
+  :return: The job, which has already started.
+  """
+  job = Job(id=next(_ids), name=name, started_by=started_by, started=datetime.datetime.now())
+
+  async def run():
+    try:
+      await f(job)
+    except Exception as exn:
+      job.error = str(exn) or type(exn).__name__
+      traceback.print_exc()
+      # Nobody may be waiting on the task, so don't re-raise: that would just log "Task exception was never retrieved" too
+      await cauch_e.error.report_error(bot=None, interaction=None, message=f"Job #{job.id} {name} failed", exn=exn)
+    finally:
+      job.finished = datetime.datetime.now()
+      # Forget the oldest finished jobs
+      finished = [i for i in jobs.values() if i.finished is not None]
+      for i in finished[:-KEEP_FINISHED]:
+        del jobs[i.id]
+
+  jobs[job.id] = job
+  job.task = asyncio.create_task(run(), name=f"job:{name}")
+  return job
+
+async def follow(interaction: discord.Interaction, job: Job, interval: float = 2) -> None:
+  """
+  Keeps a deferred interaction's response up to date with the progress of a job, until it finishes.
+  :param interaction: The interaction, which must already have been deferred.
+  :param job: The job to follow.
+  :param interval: How often (in seconds) to update the response.
+  """
+  # Interaction tokens only last 15 minutes, after which we can't edit the response any more
+  deadline = asyncio.get_running_loop().time() + 14 * 60
+  last = None
+  while True:
+    try:
+      await asyncio.wait_for(asyncio.shield(job.task), timeout=interval)
+    except asyncio.TimeoutError:
+      pass
+
+    text = job.describe()
+    if text != last:
+      try:
+        await interaction.edit_original_response(content=text)
+      except discord.HTTPException:
+        return
+      last = text
+    if job.finished is not None or asyncio.get_running_loop().time() > deadline:
+      return
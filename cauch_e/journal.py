@@ -0,0 +1,208 @@
+"""Tools for working with the journal of study group changes
+
+The journal is written by the database driver in the same transaction as each change, so replaying it from the start
+gives exactly the state of the database at any point in time. This is useful for recovering from a bad stir,
+and for getting real arrival patterns to test group allocation against.
+
+Run `python -m cauch_e.journal --help` for the command line tool.
+"""
+import argparse
+import csv
+import dataclasses
+import datetime
+import sqlite3
+import sys
+from contextlib import closing
+from typing import Dict, Iterable, List, Optional, Set, Tuple, TextIO
+
+from cauch_e.db import JournalEntry, JournalOp, SqliteDatabaseDriver
+
+@dataclasses.dataclass
+class ReplayedGroup:
+  module_code: str
+  date_created: int
+  members: Set[int] = dataclasses.field(default_factory=set)
+  invite_only: bool = False
+
+@dataclasses.dataclass
+class ReplayedState:
+  seq: int = 0
+  """The sequence number of the last entry applied."""
+
+  modules: Dict[str, str] = dataclasses.field(default_factory=dict)
+  """Module names, indexed by code."""
+
+  groups: Dict[int, ReplayedGroup] = dataclasses.field(default_factory=dict)
+  """Study groups, indexed by id."""
+
+  queue: Dict[Tuple[str, int], int] = dataclasses.field(default_factory=dict)
+  """When each user queued, indexed by (module code, member id)."""
+
+@dataclasses.dataclass
+class TraceEvent:
+  time: int
+  """The unix time of the event."""
+
+  module_code: str
+  """The module the event was for."""
+
+  member_id: int
+  """The user the event was for."""
+
+  kind: str
+  """One of "queue" (joined the queue), "cancel" (left the queue without a group), or "leave" (left their group)."""
+
+def replay(entries: Iterable[JournalEntry], state: Optional[ReplayedState] = None) -> ReplayedState:
+  """
+  Applies journal entries to a state.
+
+  Databases that had a journal before it was seeded with what was already there (see `SqliteDatabaseDriver.seed_journal`)
+  can refer to groups that it never saw created. Those are made up as they turn up, so at least their later members are right.
+  :param entries: The entries to apply, oldest first.
+  :param state: The state to start from. Defaults to an empty database.
+  :return: The state after all the entries have been applied.
+  """
+  if state is None:
+    state = ReplayedState()
+
+  for entry in entries:
+    match entry.op:
+      case JournalOp.MODULE_ADDED:
+        state.modules[entry.module_code] = entry.arg
+      case JournalOp.MODULE_DELETED:
+        state.modules.pop(entry.module_code, None)
+      case JournalOp.MODULE_RENAMED:
+        # Journals from before seeding may not have seen the module added, but its groups and queue entries still move
+        if (name := state.modules.pop(entry.module_code, None)) is not None:
+          state.modules[entry.arg] = name
+        for group in state.groups.values():
+          if group.module_code == entry.module_code:
+            group.module_code = entry.arg
+        state.queue = {(entry.arg if module_code == entry.module_code else module_code, member_id): queue_time
+                       for (module_code, member_id), queue_time in state.queue.items()}
+      case JournalOp.GROUP_CREATED:
+        state.groups[entry.group_id] = ReplayedGroup(module_code=entry.module_code, date_created=entry.time,
+                                                     invite_only=entry.arg == "1")
+      case JournalOp.GROUP_DELETED | JournalOp.GROUP_ARCHIVED:
+        state.groups.pop(entry.group_id, None)
+      case JournalOp.MEMBER_ADDED:
+        state.groups.setdefault(entry.group_id, ReplayedGroup(module_code=entry.module_code, date_created=entry.time)).members.add(entry.member_id)
+      case JournalOp.MEMBER_REMOVED:
+        if (group := state.groups.get(entry.group_id)) is not None:
+          group.members.discard(entry.member_id)
+      case JournalOp.GROUP_MODIFIED:
+        state.groups.setdefault(entry.group_id, ReplayedGroup(module_code=entry.module_code, date_created=entry.time)).invite_only = entry.arg == "1"
+      case JournalOp.QUEUED:
+        state.queue[(entry.module_code, entry.member_id)] = entry.time
+      case JournalOp.UNQUEUED | JournalOp.QUEUE_ARCHIVED:
+        state.queue.pop((entry.module_code, entry.member_id), None)
+    state.seq = entry.seq
+  return state
+
+def restore(state: ReplayedState, driver: SqliteDatabaseDriver) -> None:
+  """
+  Writes a replayed state into an empty database, keeping the original group ids.
+
+  The old journal is not copied, as it is no longer true for the restored database. Instead, its journal starts with
+  what was restored, like a database that was upgraded to have a journal, so that replaying it gives the same state.
+  :param state: The state to write.
+  :param driver: The driver for the new database. This must be empty.
+  """
+  with driver.db, closing(driver.db.cursor()) as cur:
+    cur.execute("SELECT (SELECT count(*) FROM modules) + (SELECT count(*) FROM study_groups) + (SELECT count(*) FROM study_group_queue)")
+    if cur.fetchone()[0] != 0:
+      raise ValueError("Refusing to restore into a non-empty database")
+    cur.executemany("INSERT INTO modules(code, name) VALUES (?, ?)", state.modules.items())
+    cur.executemany("INSERT INTO study_groups(id, module_code, date_created, members, invite_only) VALUES (?, ?, ?, ?, ?)",
+                    ((group_id, group.module_code, group.date_created, driver.serialise_members(group.members), group.invite_only)
+                     for group_id, group in state.groups.items()))
+    cur.executemany("INSERT INTO study_group_queue(module_code, member_id, time) VALUES (?, ?, ?)",
+                    ((module_code, member_id, queue_time) for (module_code, member_id), queue_time in sorted(state.queue.items(), key=lambda i: i[1])))
+    driver.seed_journal(cur)
+
+def arrival_trace(entries: Iterable[JournalEntry], module_code: Optional[str] = None) -> List[TraceEvent]:
+  """
+  Extracts the things users did themselves from the journal, ignoring what the bot did in response.
+
+  This is the input for simulating group allocation.
+  :param entries: The entries to read, oldest first.
+  :param module_code: If set, only events for this module are returned.
+  :return: The events, oldest first.
+  """
+  trace: List[TraceEvent] = []
+  # Allocation adds the user to a group *then* unqueues them, so we need to know who is already in a group to tell
+  # an allocation apart from someone giving up
+  in_group: Set[Tuple[str, int]] = set()
+  for entry in entries:
+    if module_code is not None and entry.module_code != module_code:
+      continue
+    key = (entry.module_code, entry.member_id)
+    match entry.op:
+      case JournalOp.QUEUED:
+        trace.append(TraceEvent(time=entry.time, module_code=entry.module_code, member_id=entry.member_id, kind="queue"))
+      case JournalOp.UNQUEUED | JournalOp.QUEUE_ARCHIVED:
+        # Archived entries were never allocated, so as far as a simulation is concerned they gave up
+        if key not in in_group:
+          trace.append(TraceEvent(time=entry.time, module_code=entry.module_code, member_id=entry.member_id, kind="cancel"))
+      case JournalOp.MEMBER_ADDED:
+        in_group.add(key)
+      case JournalOp.MEMBER_REMOVED:
+        in_group.discard(key)
+        trace.append(TraceEvent(time=entry.time, module_code=entry.module_code, member_id=entry.member_id, kind="leave"))
+  return trace
+
+def write_trace(trace: Iterable[TraceEvent], file: TextIO) -> None:
+  writer = csv.writer(file)
+  writer.writerow(["time", "module_code", "member_id", "kind"])
+  for event in trace:
+    writer.writerow([event.time, event.module_code, event.member_id, event.kind])
+
+def read_trace(file: TextIO) -> List[TraceEvent]:
+  return [TraceEvent(time=int(row["time"]), module_code=row["module_code"], member_id=int(row["member_id"]), kind=row["kind"])
+          for row in csv.DictReader(file)]
+
+def parse_time(value: str) -> int:
+  """Accepts either a unix time or an ISO 8601 date, for the command line."""
+  try:
+    return int(value)
+  except ValueError:
+    return int(datetime.datetime.fromisoformat(value).timestamp())
+
+def main() -> int:
+  parser = argparse.ArgumentParser(
+    prog = "cauch-e-journal",
+    description = "Replays the study group journal of a cauch-e database",
+  )
+  parser.add_argument("db", help="The sqlite database to read the journal from. Its .replica works too, and keeps out of the bot's way")
+  parser.add_argument("--at", type=parse_time, help="Replay up to this time (unix time or ISO 8601). Defaults to now.")
+  parser.add_argument("--restore", metavar="PATH", help="Write the replayed state into a new database at PATH")
+  parser.add_argument("--trace", metavar="PATH", help="Write the user arrival trace as CSV to PATH ('-' for stdout)")
+  parser.add_argument("--module", help="Only include this module in the trace")
+
+  args = parser.parse_args()
+
+  # Don't let the tooling touch the live database by accident
+  source = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+  with closing(source), closing(source.cursor()) as cur:
+    cur.execute("SELECT seq, time, op, module_code, group_id, member_id, arg FROM journal WHERE time <= ? ORDER BY seq",
+                (args.at if args.at is not None else 2**62,))
+    entries = [JournalEntry(seq=i[0], time=i[1], op=JournalOp(i[2]), module_code=i[3], group_id=i[4], member_id=i[5], arg=i[6]) for i in cur.fetchall()]
+
+  state = replay(entries)
+  print(f"Replayed {len(entries)} entries: {len(state.modules)} modules, {len(state.groups)} groups, {len(state.queue)} queued", file=sys.stderr)
+
+  if args.restore is not None:
+    restore(state, SqliteDatabaseDriver(args.restore))
+    print(f"Restored into '{args.restore}'", file=sys.stderr)
+
+  if args.trace is not None:
+    trace = arrival_trace(entries, args.module)
+    if args.trace == "-":
+      write_trace(trace, sys.stdout)
+    else:
+      with open(args.trace, "w", newline="") as file:
+        write_trace(trace, file)
+
+  return 0
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,69 @@
+"""Keeping the databases small and quick
+
+Once a day, when hardly anyone is about, `maintenance_loop` refreshes each database's query statistics and tidies up its
+files. At the end of term, admins use `end_of_term` to move old groups and queue entries out into each database's archive,
+so that the tables we scan all the time only hold the current term.
+"""
+import asyncio
+import datetime
+from typing import Dict, Optional
+
+from discord.ext import commands
+
+import cauch_e.db
+import cauch_e.jobs
+
+MAINTENANCE_HOUR = 4
+"""The hour (in local time) that maintenance runs each day."""
+
+ARCHIVE_BATCH = 500
+"""How many groups and queue entries are archived per transaction. Everything else gets a go in between batches."""
+
+async def maintain(dbs: Dict[Optional[int], cauch_e.db.DatabaseDriver], job: cauch_e.jobs.Job) -> None:
+  """
+  Runs maintenance on some databases, one at a time.
+  :param dbs: The databases, indexed by server id, as from `cauch_e.db.partitions`.
+  :param job: Progress is recorded here.
+  """
+  job.totals["databases"] = len(dbs)
+  job.progress["databases"] = 0
+  for guild_id, db in dbs.items():
+    report = db.maintain()
+    print(f"Maintenance" + (f" for server {guild_id}" if guild_id is not None else "") + f": {report.summary()}")
+    job.increment("databases")
+    job.increment("pages freed", report.freed_pages)
+    await asyncio.sleep(0)
+
+async def end_of_term(db: cauch_e.db.DatabaseDriver, before: int, job: cauch_e.jobs.Job) -> None:
+  """
+  Archives every group created, and queue entry made, before a time.
+  :param db: The database to archive from.
+  :param before: The unix time to archive things from before.
+  :param job: Progress is recorded here.
+  """
+  job.progress["groups archived"] = 0
+  job.progress["queue entries archived"] = 0
+  while (moved := db.archive_batch(before, ARCHIVE_BATCH)) != (0, 0):
+    job.increment("groups archived", moved[0])
+    job.increment("queue entries archived", moved[1])
+    await asyncio.sleep(0)
+
+def seconds_until(hour: int) -> float:
+  """How long it is until the next time it is `hour` o'clock."""
+  now = datetime.datetime.now()
+  next_time = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+  if next_time <= now:
+    next_time += datetime.timedelta(days=1)
+  return (next_time - now).total_seconds()
+
+async def maintenance_loop(bot: commands.Bot) -> None:
+  await bot.wait_until_ready()
+  while True:
+    await asyncio.sleep(seconds_until(MAINTENANCE_HOUR))
+    dbs = cauch_e.db.partitions(i.id for i in bot.guilds)
+    # The job reports its own errors, and we want to try again tomorrow either way
+    await cauch_e.jobs.start_job("database maintenance", lambda job: maintain(dbs, job)).task
+
+def start(bot: commands.Bot) -> None:
+  """Starts the daily maintenance on the running event loop."""
+  asyncio.create_task(maintenance_loop(bot))
@@ -0,0 +1,184 @@
+"""Matching queued users into groups by their weekly availability
+
+Availability is a bitmask of the 168 hours in a week (bit `day * 24 + hour`, Monday is day 0), stored as MASK_BYTES bytes.
+Users who haven't registered any availability are treated as always free, so they fit anywhere. Users who share fewer than
+`min_overlap` free hours with a group are kept out of it, until they have waited long enough that any group will do.
+
+The scoring is vectorised with numpy, which is an optional dependency. Without it, users are just matched in queue order.
+"""
+import re
+from typing import List, Optional, Sequence
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+SLOTS = len(DAYS) * 24
+MASK_BYTES = SLOTS // 8
+ALWAYS_FREE = b"\xff" * MASK_BYTES
+
+def parse_availability(spec: str) -> bytes:
+  """
+  Parses a human-written availability, like "mon-fri 9-17, sat 10-12".
+  :param spec: Comma separated entries of a day (or range of days) and an hour range. Hours are 0-24, end exclusive.
+  :returns: The availability mask.
+  :raises ValueError: if the spec is malformed.
+  """
+  bits = 0
+  for entry in filter(None, (i.strip() for i in re.split(r"[,;]", spec.lower()))):
+    match = re.fullmatch(r"([a-z]{3})[a-z]*(?:\s*-\s*([a-z]{3})[a-z]*)?\s+(\d{1,2})\s*-\s*(\d{1,2})", entry)
+    if match is None:
+      raise ValueError(f"Couldn't understand '{entry}'. Try something like 'mon-fri 9-17'.")
+    first_day, last_day, start, end = match.group(1), match.group(2) or match.group(1), int(match.group(3)), int(match.group(4))
+    if first_day not in DAYS or last_day not in DAYS:
+      raise ValueError(f"Unknown day in '{entry}'")
+    if not 0 <= start < end <= 24:
+      raise ValueError(f"Invalid hours in '{entry}'")
+    for day in range(DAYS.index(first_day), DAYS.index(last_day) + 1):
+      for hour in range(start, end):
+        bits |= 1 << (day * 24 + hour)
+  if bits == 0:
+    raise ValueError("No times given")
+  return bits.to_bytes(MASK_BYTES, "little")
+
+def format_availability(mask: bytes) -> str:
+  """The inverse of parse_availability, although it won't merge days into ranges."""
+  bits = int.from_bytes(mask, "little")
+  entries = []
+  for day, day_name in enumerate(DAYS):
+    hour = 0
+    while hour < 24:
+      if bits >> (day * 24 + hour) & 1:
+        start = hour
+        while hour < 24 and bits >> (day * 24 + hour) & 1:
+          hour += 1
+        entries.append(f"{day_name} {start}-{hour}")
+      hour += 1
+  return ", ".join(entries)
+
+def _popcount_rows(words):
+  # Each row is 3 uint64 words
+  if hasattr(numpy, "bitwise_count"):
+    return numpy.bitwise_count(words).sum(axis=1, dtype=numpy.int32)
+  return _POPCOUNT_TABLE[words.view(numpy.uint8)].sum(axis=1, dtype=numpy.int32)
+
+if numpy is not None:
+  _POPCOUNT_TABLE = numpy.array([bin(i).count("1") for i in range(256)], dtype=numpy.uint8)
+
+class Matcher:
+  """Hands out queued users, picking whoever shares the most free time with a group.
+
+  Users must be given in queue order: ties are broken in favour of whoever has waited longest,
+  and new groups are started with the longest-waiting user who can fill one, so the queue stays as fair as it can.
+  """
+  taken: List[bool]
+  """Whether each user has been given a group."""
+
+  min_overlap: int
+  """How many free hours a week a user must share with a group to be put in it."""
+
+  def take_best(self, members: Sequence[Optional[bytes]], allowed: Optional[Sequence[bool]] = None) -> Optional[int]:
+    """
+    Takes the user who best fits an existing group.
+    :param members: The availability of the group's members.
+    :param allowed: If set, only users with True here can be chosen.
+    :returns: The index of the chosen user in the queue, or None if there are none left who fit.
+    """
+    common = None
+    if self.avail is not None:
+      common = self.pack([ALWAYS_FREE])[0]
+      for i in self.pack(members):
+        common &= i
+    return self._take(common, allowed)
+
+  def take_group(self, size: int, allowed: Optional[Sequence[bool]] = None) -> Optional[List[int]]:
+    """
+    Takes the longest-waiting user, and the `size - 1` users who fit best with them.
+    :param size: The size of the group.
+    :param allowed: If set, only users with True here can be chosen.
+    :returns: The indices of the chosen users in the queue, or None (having taken no one) if there are not enough left who fit.
+    """
+    if self.remaining(allowed) < size:
+      return None
+    if self.avail is None:
+      return [self._take(None, allowed) for _ in range(size)]
+
+    # If the longest-waiting user can't fill a group, they may still fit into someone else's later
+    for first in numpy.flatnonzero(self._candidates(allowed)):
+      chosen = [int(first)]
+      self._set_taken(chosen[0], True)
+      common = self.avail[chosen[0]].copy()
+      while len(chosen) < size and (index := self._take(common, allowed)) is not None:
+        chosen.append(index)
+        common &= self.avail[index]
+      if len(chosen) == size:
+        return chosen
+      for i in chosen:
+        self._set_taken(i, False)
+    return None
+
+  def remaining(self, allowed: Optional[Sequence[bool]] = None) -> int:
+    """How many users are left to give groups to."""
+    if self.avail is not None:
+      return int(self._candidates(allowed).sum())
+    return sum(1 for i, taken in enumerate(self.taken) if not taken and (allowed is None or allowed[i]))
+
+  @staticmethod
+  def pack(masks: Sequence[Optional[bytes]]):
+    # Pad each mask out to 3 whole uint64 words, so that we can AND and popcount a whole row at a time
+    padding = b"\0" * (24 - MASK_BYTES)
+    return numpy.frombuffer(b"".join((ALWAYS_FREE if i is None else i) + padding for i in masks), dtype=numpy.uint64).reshape(-1, 3).copy()
+
+  def _candidates(self, allowed: Optional[Sequence[bool]]):
+    candidates = ~self.taken_array
+    if allowed is not None:
+      candidates &= numpy.asarray(allowed, dtype=bool)
+    return candidates
+
+  def _set_taken(self, index: int, taken: bool) -> None:
+    self.taken[index] = taken
+    self.taken_array[index] = taken
+
+  def _take(self, common, allowed: Optional[Sequence[bool]]) -> Optional[int]:
+    if self.avail is None:
+      # Queue order
+      for i, taken in enumerate(self.taken):
+        if not taken and (allowed is None or allowed[i]):
+          self.taken[i] = True
+          return i
+      return None
+
+    indices = numpy.flatnonzero(self._candidates(allowed))
+    if len(indices) == 0:
+      return None
+    if common is None:
+      chosen = int(indices[0])
+    else:
+      scores = _popcount_rows(self.avail[indices] & common)
+      # Users who have waited long enough go anywhere, but never ahead of someone who fits
+      fits = (scores >= self.min_overlap) | self.waited[indices]
+      if not fits.any():
+        return None
+      # argmax picks the first of any ties, which is the longest waiting
+      chosen = int(indices[numpy.argmax(numpy.where(fits, scores, -1))])
+    self._set_taken(chosen, True)
+    return chosen
+
+  def __init__(self, queue: Sequence[Optional[bytes]], min_overlap: int = 0, waited: Optional[Sequence[bool]] = None):
+    """
+    :param queue: The availability of each queued user, in queue order. None if they haven't registered any.
+    :param min_overlap: How many free hours a week a user must share with a group to be put in it.
+    :param waited: If set, users with True here have waited max_time, so can be put in groups they don't share
+                   min_overlap hours with.
+    """
+    self.taken = [False] * len(queue)
+    self.min_overlap = min_overlap
+    # Without numpy, or if no one has told us when they're free, there's nothing to match on
+    if numpy is None or all(i is None for i in queue):
+      self.avail = None
+    else:
+      self.avail = self.pack(queue)
+      self.taken_array = numpy.zeros(len(queue), dtype=bool)
+      self.waited = numpy.zeros(len(queue), dtype=bool) if waited is None else numpy.asarray(waited, dtype=bool)
@@ -0,0 +1,138 @@
+"""A low-overhead sampling profiler for the live bot
+
+Rather than hooking every function call like cProfile, a helper thread peeks at the event loop thread's stack every few
+milliseconds. This costs next to nothing when it isn't running, and very little when it is, so it is safe to use in production.
+"""
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Counter, Dict, List, Optional, Tuple
+
+def describe_frame(frame, line: bool = False) -> str:
+  """
+  :param line: Whether to give the line being run, rather than the line the function starts on. Samples of a function
+               only add up if this is off.
+  """
+  code = frame.f_code
+  return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno if line else code.co_firstlineno})"
+
+def thread_stack(thread_id: int, line: bool = False) -> Optional[List[str]]:
+  """
+  Describes what another thread is running right now.
+  :param thread_id: The thread to look at.
+  :param line: Passed on to `describe_frame`.
+  :return: The thread's stack, outermost frame first, or None if there is no such thread.
+  """
+  frame = sys._current_frames().get(thread_id)
+  if frame is None:
+    return None
+  stack = []
+  while frame is not None:
+    stack.append(describe_frame(frame, line))
+    frame = frame.f_back
+  stack.reverse()
+  return stack
+
+class SamplingProfiler:
+  thread_id: int
+  """The thread being profiled."""
+
+  interval: float
+  """How long (in seconds) to wait between samples."""
+
+  samples: Counter[Tuple[str, ...]]
+  """How many times each stack was seen, outermost frame first."""
+
+  def _run(self) -> None:
+    while not self._stop.is_set():
+      stack = thread_stack(self.thread_id)
+      if stack is not None:
+        self.samples[tuple(stack)] += 1
+      time.sleep(self.interval)
+
+  def start(self) -> None:
+    self._thread = threading.Thread(target=self._run, name="cauch-e-profiler", daemon=True)
+    self._thread.start()
+
+  def stop(self) -> None:
+    self._stop.set()
+    self._thread.join()
+
+  def collapsed(self) -> str:
+    """The samples in collapsed stack format, for flamegraph.pl, speedscope, etc."""
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.samples.most_common())
+
+  def top(self, n: int = 30) -> str:
+    """A human-readable summary of the functions that took the most time."""
+    total = sum(self.samples.values())
+    if total == 0:
+      return "No samples taken.\n"
+    own: Counter[str] = collections.Counter()
+    inclusive: Counter[str] = collections.Counter()
+    for stack, count in self.samples.items():
+      own[stack[-1]] += count
+      # Don't count recursive functions more than once
+      for frame in set(stack):
+        inclusive[frame] += count
+
+    lines = [f"{total} samples, every {self.interval * 1000:g}ms", "", "Self time:"]
+    lines += [f"{count / total:7.1%}  {frame}" for frame, count in own.most_common(n)]
+    lines += ["", "Inclusive time:"]
+    lines += [f"{count / total:7.1%}  {frame}" for frame, count in inclusive.most_common(n)]
+    return "\n".join(lines) + "\n"
+
+  def __init__(self, thread_id: Optional[int] = None, interval: float = 0.005):
+    """
+    :param thread_id: The thread to profile. Defaults to the current thread.
+    :param interval: How long (in seconds) to wait between samples.
+    """
+    self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+    self.interval = interval
+    self.samples = collections.Counter()
+    self._stop = threading.Event()
+
+async def profile(seconds: float, trace_memory: bool = False, interval: float = 0.005) -> Dict[str, str]:
+  """
+  Profiles the event loop thread while the bot carries on as normal.
+  :param seconds: How long to profile for.
+  :param trace_memory: Whether to also record where memory was allocated, with tracemalloc. This is *much* more expensive.
+  :param interval: How long (in seconds) to wait between samples.
+  :return: The reports, indexed by file name.
+  """
+  # We are running on the event loop, so this is the thread we want to watch
+  profiler = SamplingProfiler(interval=interval)
+
+  started_tracing = False
+  before: Optional[tracemalloc.Snapshot] = None
+  if trace_memory:
+    if not tracemalloc.is_tracing():
+      tracemalloc.start(25)
+      started_tracing = True
+    before = tracemalloc.take_snapshot()
+
+  profiler.start()
+  try:
+    await asyncio.sleep(seconds)
+  finally:
+    profiler.stop()
+    if trace_memory:
+      after = tracemalloc.take_snapshot()
+      if started_tracing:
+        tracemalloc.stop()
+
+  reports = {"profile.txt": profiler.top(), "profile.collapsed": profiler.collapsed()}
+  if trace_memory:
+    # Hide the profiler's own allocations
+    ignore = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, threading.__file__)]
+    before = before.filter_traces(ignore)
+    after = after.filter_traces(ignore)
+    lines = ["Biggest changes in allocated memory:"]
+    lines += [str(i) for i in after.compare_to(before, "lineno")[:30]]
+    lines += ["", "Biggest live allocations (only those made while tracing, unless it was already on):"]
+    lines += [str(i) for i in after.statistics("lineno")[:30]]
+    reports["memory.txt"] = "\n".join(lines) + "\n"
+  return reports
@@ -0,0 +1,178 @@
+"""Private Discord threads for study groups
+
+If `study_group.thread_channel` is set, each study group gets a private thread in that channel, containing just its members.
+The database is the source of truth: every task here works out what the thread should look like from the DB when it runs,
+so tasks can be repeated or run late without doing any harm, and `reconcile` can fix anything that got missed.
+
+The channel belongs to one server, so if each server has its own database, only that server's groups get threads.
+"""
+import asyncio
+import dataclasses
+from typing import Dict, List, Optional, Set
+
+import discord
+from discord.ext import commands
+
+import cauch_e.config
+import cauch_e.db
+import cauch_e.jobs
+import cauch_e.stats
+from cauch_e.scheduler import Scheduler
+
+@dataclasses.dataclass
+class PendingSync:
+  """What has been asked of a group's next sync. Asking again before it runs adds to this, rather than queueing another."""
+  db: cauch_e.db.DatabaseDriver
+  module_code: str
+  full: bool
+  jobs: List[cauch_e.jobs.Job] = dataclasses.field(default_factory=list)
+
+class Provisioner:
+  bot: commands.Bot
+  scheduler: Scheduler
+
+  pending_syncs: Dict[int, PendingSync]
+  """The syncs that haven't started yet, indexed by group id."""
+
+  def channel(self) -> Optional[discord.TextChannel]:
+    """The channel that threads are made in, or None if threads are turned off."""
+    channel_id = cauch_e.config.typed.study_group.thread_channel
+    if channel_id is None:
+      return None
+    channel = self.bot.get_channel(channel_id)
+    return channel if isinstance(channel, discord.TextChannel) else None
+
+  def database(self) -> Optional[cauch_e.db.DatabaseDriver]:
+    """The database for the server that threads are made in, or None if threads are turned off."""
+    channel = self.channel()
+    return cauch_e.db.for_guild(channel.guild.id) if channel is not None else None
+
+  def sync_group(self, db: cauch_e.db.DatabaseDriver, module_code: str, group_id: int, full: bool = False,
+                 job: Optional[cauch_e.jobs.Job] = None) -> None:
+    """
+    Queues making sure a group's thread exists and contains its members, or is archived if the group is gone.
+    :param db: The database the group is in. Nothing happens unless this is the thread channel's server's.
+    :param module_code: The module the group is for.
+    :param group_id: The id of the group.
+    :param full: Whether to also remove anyone from the thread who isn't in the group. This costs an extra API call.
+    :param job: If set, progress is recorded here.
+    """
+    if db is not self.database():
+      return
+    request = self.pending_syncs.get(group_id)
+    if request is None:
+      request = self.pending_syncs[group_id] = PendingSync(db=db, module_code=module_code, full=full)
+    else:
+      request.full = request.full or full
+      # Threads of deleted groups are synced with no module, and renamed modules change it, so keep the latest real one
+      request.module_code = module_code or request.module_code
+    if job is not None:
+      request.jobs.append(job)
+    # One key per group, so a group is never synced twice at once (which could make two threads for it)
+    self.scheduler.submit(("sync", group_id), lambda: self._run_sync(group_id))
+
+  def remove_member(self, db: cauch_e.db.DatabaseDriver, group_id: int, member_id: int) -> None:
+    """Queues taking someone who has left a group out of its thread."""
+    if db is self.database():
+      self.scheduler.submit(("remove", group_id, member_id), lambda: self._remove_member(db, group_id, member_id))
+
+  async def reconcile(self, job: Optional[cauch_e.jobs.Job] = None) -> None:
+    """Makes every thread match the DB, and waits for it to finish."""
+    if (db := self.database()) is None:
+      return
+    threads = db.get_group_threads()
+    seen: Set[int] = set()
+    for module_code in [i.module_code for i in db.iter_modules()]:
+      for group in db.iter_study_groups(module_code):
+        seen.add(group.id)
+        self.sync_group(db, module_code, group.id, full=True, job=job)
+      await asyncio.sleep(0)
+    # Threads for groups that no longer exist. The module doesn't matter, as the group won't be found either way
+    for group_id in threads.keys() - seen:
+      self.sync_group(db, "", group_id, full=True, job=job)
+    if job is not None:
+      job.totals["groups"] = len(seen | threads.keys())
+      job.progress.setdefault("groups", 0)
+    await self.scheduler.join()
+
+  async def _get_thread(self, thread_id: int) -> Optional[discord.Thread]:
+    channel = self.channel()
+    thread = channel.guild.get_thread(thread_id)
+    if thread is not None:
+      return thread
+    # Archived threads aren't cached
+    try:
+      thread = await self.scheduler.call(lambda: self.bot.fetch_channel(thread_id))
+    except (discord.NotFound, discord.Forbidden):
+      return None
+    return thread if isinstance(thread, discord.Thread) else None
+
+  async def _run_sync(self, group_id: int) -> None:
+    # Anything asked for from here on needs a sync of its own, as this one may already have read the group
+    request = self.pending_syncs.pop(group_id)
+    await self._sync_group(request.db, request.module_code, group_id, request.full)
+    for job in request.jobs:
+      job.increment("groups")
+
+  async def _sync_group(self, db: cauch_e.db.DatabaseDriver, module_code: str, group_id: int, full: bool) -> None:
+    channel = self.channel()
+    if channel is None:
+      return
+    group = db.get_study_group(module_code, group_id)
+    thread_id = db.get_group_thread(group_id)
+    thread = await self._get_thread(thread_id) if thread_id is not None else None
+
+    if group is None:
+      if thread is not None and not (thread.archived and thread.locked):
+        await self.scheduler.call(lambda: thread.edit(archived=True, locked=True))
+      if thread_id is not None:
+        db.set_group_thread(group_id, None)
+    else:
+      in_thread: Set[int] = set()
+      name = f"{group.module_code} study group {group.id}"
+      if thread is None:
+        thread = await self.scheduler.call(lambda: channel.create_thread(name=name, type=discord.ChannelType.private_thread, invitable=False))
+        db.set_group_thread(group_id, thread.id)
+      else:
+        # The name changes if the module is renamed
+        if thread.archived or thread.name != name:
+          await self.scheduler.call(lambda: thread.edit(archived=False, name=name))
+        if full:
+          in_thread = {i.id for i in await self.scheduler.call(thread.fetch_members)}
+          for member_id in in_thread.difference(group.members, {self.bot.user.id}):
+            await self.scheduler.call(lambda: thread.remove_user(discord.Object(member_id)))
+      # Adding someone who is already there is harmless, so without a full sync we just add everyone
+      for member_id in set(group.members) - in_thread:
+        await self.scheduler.call(lambda: thread.add_user(discord.Object(member_id)))
+
+  async def _remove_member(self, db: cauch_e.db.DatabaseDriver, group_id: int, member_id: int) -> None:
+    thread_id = db.get_group_thread(group_id)
+    if thread_id is None or (thread := await self._get_thread(thread_id)) is None:
+      return
+    try:
+      await self.scheduler.call(lambda: thread.remove_user(discord.Object(member_id)))
+    except discord.NotFound:
+      pass
+
+  async def reconcile_loop(self):
+    await self.bot.wait_until_ready()
+    while True:
+      # The job reports its own errors, and we want to try again next time either way
+      await cauch_e.jobs.start_job("reconcile threads", self.reconcile).task
+      await asyncio.sleep(60 * 60)
+
+  def __init__(self, bot: commands.Bot):
+    self.bot = bot
+    self.scheduler = Scheduler()
+    self.pending_syncs = {}
+
+provisioner: Optional[Provisioner] = None
+
+def start(bot: commands.Bot) -> None:
+  """Sets up `provisioner`, and starts its background tasks on the running event loop."""
+  global provisioner
+  provisioner = Provisioner(bot)
+  provisioner.scheduler.start()
+  cauch_e.stats.register("thread provisioning", lambda: {"pending": len(provisioner.scheduler.pending),
+                                                         "failures": provisioner.scheduler.failures})
+  asyncio.create_task(provisioner.reconcile_loop())
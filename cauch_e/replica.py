@@ -0,0 +1,74 @@
+"""Read-only snapshots of the databases, for reporting
+
+Stats, the consistency check's first look, and offline tools like `cauch_e.journal` can read a lot of rows, which would
+otherwise compete with commands for the same connection. `refresh_loop` copies each database into its replica every
+REFRESH_INTERVAL seconds using sqlite's online backup, in a thread so the event loop carries on, and those reads go to
+`DatabaseDriver.replica` instead. Anything read from a replica may be up to REFRESH_INTERVAL out of date.
+"""
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+from discord.ext import commands
+
+import cauch_e.db
+import cauch_e.stats
+
+REFRESH_INTERVAL = 5 * 60
+"""How often (in seconds) the replicas are brought up to date."""
+
+class RefreshStats:
+  refreshed: int
+  """How many snapshots have been copied."""
+
+  skipped: int
+  """How many refreshes were skipped, because there had been no writes since the last one."""
+
+  failed: int
+  """How many refreshes went wrong."""
+
+  last_duration: Optional[float]
+  """How long (in seconds) the last copy took."""
+
+  def stats(self) -> Dict[str, Any]:
+    return {"refreshed": self.refreshed, "skipped": self.skipped, "failed": self.failed,
+            "last copy": "-" if self.last_duration is None else f"{self.last_duration * 1000:.1f}ms"}
+
+  def __init__(self):
+    self.refreshed = 0
+    self.skipped = 0
+    self.failed = 0
+    self.last_duration = None
+
+refresh_stats = RefreshStats()
+cauch_e.stats.register("replicas", refresh_stats.stats)
+
+async def refresh(dbs: Dict[Optional[int], cauch_e.db.DatabaseDriver]) -> None:
+  """
+  Refreshes the replicas of some databases, one at a time.
+  :param dbs: The databases, indexed by server id, as from `cauch_e.db.partitions`.
+  """
+  for guild_id, db in dbs.items():
+    start = time.perf_counter()
+    try:
+      copied = await asyncio.to_thread(db.refresh_replica)
+    except Exception as exn:
+      # Reports just read a slightly older snapshot until next time
+      refresh_stats.failed += 1
+      print(f"Failed to refresh the replica" + (f" for server {guild_id}" if guild_id is not None else "") + f": {exn}")
+      continue
+    if copied:
+      refresh_stats.refreshed += 1
+      refresh_stats.last_duration = time.perf_counter() - start
+    else:
+      refresh_stats.skipped += 1
+
+async def refresh_loop(bot: commands.Bot) -> None:
+  await bot.wait_until_ready()
+  while True:
+    await refresh(cauch_e.db.partitions(i.id for i in bot.guilds))
+    await asyncio.sleep(REFRESH_INTERVAL)
+
+def start(bot: commands.Bot) -> None:
+  """Starts refreshing the replicas on the running event loop."""
+  asyncio.create_task(refresh_loop(bot))
@@ -0,0 +1,127 @@
+"""Pacing bulk Discord API work so that it doesn't trip the rate limits
+
+discord.py already waits out rate limits when it hits them, but hitting the global limit stalls *everything* the bot does,
+including responding to commands. Anything that makes lots of calls in bulk should go through a Scheduler instead.
+"""
+import asyncio
+import traceback
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set
+
+import discord
+
+class Scheduler:
+  """Runs queued tasks with bounded concurrency, and paces their API calls with a token bucket.
+
+  Tasks are identified by a key, and submitting a task whose key is already waiting is a no-op. This means tasks should
+  work out what to do when they run, rather than when they are submitted, so that they can be repeated safely.
+  Tasks with the same key never run at once: one submitted while another is running waits for it to finish.
+  """
+  rate: float
+  """How many API calls we make per second, on average."""
+
+  burst: int
+  """How many API calls we can make at once after a quiet period."""
+
+  tokens: float
+  last_refill: float
+
+  queue: "asyncio.Queue[Hashable]"
+  pending: Dict[Hashable, Callable[[], Awaitable[Any]]]
+  """The tasks waiting to run, indexed by key."""
+
+  running: Set[Hashable]
+  """The keys of the tasks running right now."""
+
+  deferred: Set[Hashable]
+  """Keys that came up while a task with the same key was running. They are queued again once it finishes."""
+
+  failures: int
+  """How many tasks have failed, for stats."""
+
+  async def call(self, f: Callable[[], Awaitable[Any]], retries: int = 3) -> Any:
+    """
+    Makes an API call once we are allowed to.
+    :param f: Makes the call. This is called again if we get rate limited anyway.
+    :param retries: How many times to retry after being rate limited.
+    :return: Whatever the call returns.
+    """
+    for attempt in range(retries + 1):
+      await self._take_token()
+      try:
+        return await f()
+      except discord.HTTPException as exn:
+        if exn.status != 429 or attempt == retries:
+          raise
+        # Someone else used up the limit: back off for a bit
+        await asyncio.sleep(2 ** attempt)
+
+  def submit(self, key: Hashable, f: Callable[[], Awaitable[Any]]) -> None:
+    """
+    Queues a task, unless one with the same key is already waiting.
+    :param key: Identifies the task, like ("sync group", 42).
+    :param f: The task. This should use `call` for each API call it makes.
+    """
+    if key in self.pending:
+      return
+    self.pending[key] = f
+    self.queue.put_nowait(key)
+
+  async def join(self) -> None:
+    """Waits for everything that has been submitted so far to finish."""
+    await self.queue.join()
+
+  async def _take_token(self) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+      now = loop.time()
+      self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+      self.last_refill = now
+      if self.tokens >= 1:
+        self.tokens -= 1
+        return
+      await asyncio.sleep((1 - self.tokens) / self.rate)
+
+  async def _worker(self) -> None:
+    while True:
+      key = await self.queue.get()
+      if key in self.running:
+        # Two runs at once could both act on the same stale state (like both making a thread), so leave it in pending
+        # until the current run is done
+        self.deferred.add(key)
+        self.queue.task_done()
+        continue
+      # Take it out of pending *before* running it, so that anything submitted while it runs gets run again afterwards
+      f = self.pending.pop(key)
+      self.running.add(key)
+      try:
+        await f()
+      except asyncio.CancelledError:
+        raise
+      except Exception:
+        self.failures += 1
+        print(f"Scheduled task {key} failed:")
+        traceback.print_exc()
+      finally:
+        self.running.discard(key)
+        if key in self.deferred:
+          self.deferred.discard(key)
+          # Queue it before marking this one done, so `join` doesn't return in between
+          self.queue.put_nowait(key)
+        self.queue.task_done()
+
+  def start(self) -> None:
+    """Starts the workers on the running event loop."""
+    for _ in range(self.concurrency):
+      asyncio.create_task(self._worker())
+
+  def __init__(self, rate: float = 5, burst: int = 5, concurrency: int = 4):
+    self.rate = rate
+    self.burst = burst
+    self.concurrency = concurrency
+    self.tokens = burst
+    self.last_refill = 0
+    self.queue = asyncio.Queue()
+    self.pending = {}
+    self.running = set()
+    self.deferred = set()
+    self.failures = 0
@@ -0,0 +1,228 @@
+"""What-if simulation of study group allocation
+
+Picking the study group bounds is guesswork without this. The simulator replays a trace of users queueing, giving up and
+leaving groups (recorded with `python -m cauch_e.journal --trace`, or made up on the spot) through `cauch_e.allocation`,
+the same code `/group stir` uses, against an in-memory database with a fake clock. Each combination of bounds is
+simulated in its own process, so a whole grid of them takes seconds.
+
+Run `python -m cauch_e.simulate --help` for the command line tool.
+"""
+import argparse
+import collections
+import concurrent.futures
+import dataclasses
+import itertools
+import random
+import sys
+import time
+from typing import Dict, List, Optional
+
+import cauch_e.allocation
+from cauch_e.config import StudyGroupConfig
+from cauch_e.db import ModuleInfo, QueueResult, SqliteDatabaseDriver
+from cauch_e.journal import TraceEvent, read_trace
+
+STIR_INTERVAL = 60 * 60
+"""How often (in seconds) the bot stirs every module. This should match `GroupCommands.stir_loop`."""
+
+SYNTHETIC_START = 1_700_000_000
+"""When synthetic traces start, in unix time. The exact value doesn't matter, as long as it is well after 1970."""
+
+@dataclasses.dataclass
+class SimulationResult:
+  config: StudyGroupConfig
+  """The bounds that were simulated."""
+
+  allocated: int
+  """How many users were put into groups from the queue."""
+
+  total_wait: int
+  """How long (in seconds) those users waited in total."""
+
+  still_queued: int
+  """How many users were still queued at the end, even after waiting out max_time."""
+
+  gave_up: int
+  """How many users left the queue without a group."""
+
+  group_sizes: Dict[int, int]
+  """How many groups of each size there were at the end, indexed by size."""
+
+  elapsed: float
+  """How long (in seconds) the simulation took to run."""
+
+  def mean_wait(self) -> Optional[float]:
+    return self.total_wait / self.allocated if self.allocated > 0 else None
+
+  def undersized(self) -> int:
+    """:return: How many groups ended up smaller than target_size."""
+    return sum(count for size, count in self.group_sizes.items() if size < self.config.target_size)
+
+class Clock:
+  """Simulated unix time, which only moves when we move it."""
+  now: float
+
+  def __call__(self) -> float:
+    return self.now
+
+  def __init__(self, now: float):
+    self.now = now
+
+def simulate(trace: List[TraceEvent], config: StudyGroupConfig, stir_interval: int = STIR_INTERVAL) -> SimulationResult:
+  """
+  Runs a trace through group allocation, stirring like the bot does.
+
+  Modules are stirred when someone queues for them, like `/group find` does, as well as every `stir_interval`.
+  Once the trace runs out, the clock keeps going until everyone left in the queue has waited max_time.
+  :param trace: The events to replay, oldest first.
+  :param config: The group bounds to simulate.
+  :param stir_interval: How often (in seconds) every module is stirred.
+  """
+  started = time.perf_counter()
+  clock = Clock(trace[0].time if len(trace) > 0 else SYNTHETIC_START)
+  db = SqliteDatabaseDriver(":memory:", clock=clock)
+  modules = sorted({event.module_code for event in trace})
+  for module_code in modules:
+    db.add_module(ModuleInfo(module_code=module_code, module_name=module_code))
+  gave_up = 0
+
+  def stir(*module_codes: str) -> None:
+    time_bound = int(clock.now) - config.max_time * 3600
+    for module_code in module_codes:
+      cauch_e.allocation.allocate(db, module_code, config, time_bound)
+
+  def run_until(until: float) -> None:
+    nonlocal next_stir
+    while next_stir <= until:
+      clock.now = next_stir
+      stir(*modules)
+      next_stir += stir_interval
+
+  next_stir = clock.now + stir_interval
+  for event in trace:
+    run_until(event.time)
+    clock.now = max(clock.now, event.time)
+    match event.kind:
+      case "queue":
+        if db.queue_for_study_groups([event.module_code], event.member_id)[event.module_code] == QueueResult.QUEUED:
+          stir(event.module_code)
+      case "cancel":
+        # They may have been given a group since, in which case they stay in it
+        if db.find_member_study_group(event.module_code, event.member_id) is None:
+          db.unqueue_from_study_group(event.module_code, event.member_id)
+          gave_up += 1
+      case "leave":
+        # This is what `/group leave` does
+        group = db.find_member_study_group(event.module_code, event.member_id)
+        if group is not None:
+          db.remove_from_study_group(module_code=event.module_code, member=event.member_id, group_id=group.id)
+          if len(group.members) <= 1:
+            db.delete_study_group(module_code=event.module_code, group_id=group.id)
+  run_until(clock.now + config.max_time * 3600 + stir_interval)
+
+  stats = db.get_module_stats().values()
+  group_sizes: Dict[int, int] = collections.Counter(group.member_count for module_code in modules for group in db.iter_study_groups(module_code))
+  return SimulationResult(config=config, allocated=sum(i.allocations for i in stats), total_wait=sum(i.total_wait for i in stats),
+                          still_queued=sum(i.queue_length for i in stats), gave_up=gave_up, group_sizes=dict(group_sizes),
+                          elapsed=time.perf_counter() - started)
+
+def synthetic_trace(users: int, modules: int, days: float, cancel_rate: float, leave_rate: float, seed: Optional[int] = None) -> List[TraceEvent]:
+  """
+  Makes up a trace that looks roughly like the start of term.
+  :param users: How many users queue. Each queues for one module.
+  :param modules: How many modules there are. A few are far more popular than the rest, like big first year modules.
+  :param days: How long the trace covers. Most users turn up in the first quarter of it.
+  :param cancel_rate: The chance that a user gives up at some point if they haven't been given a group.
+  :param leave_rate: The chance that a user leaves their group at some point.
+  :param seed: The random seed, for repeatable traces.
+  :return: The events, oldest first.
+  """
+  rng = random.Random(seed)
+  duration = days * 24 * 3600
+  module_codes = [f"SIM{i + 100}" for i in range(modules)]
+  weights = [1 / (i + 1) for i in range(modules)]
+  trace: List[TraceEvent] = []
+  for member_id, module_code in enumerate(rng.choices(module_codes, weights, k=users), start=1):
+    arrival = min(rng.expovariate(4 / duration), duration)
+    trace.append(TraceEvent(time=SYNTHETIC_START + int(arrival), module_code=module_code, member_id=member_id, kind="queue"))
+    if rng.random() < cancel_rate:
+      trace.append(TraceEvent(time=SYNTHETIC_START + int(arrival + rng.uniform(0, duration / 2)), module_code=module_code, member_id=member_id, kind="cancel"))
+    elif rng.random() < leave_rate:
+      trace.append(TraceEvent(time=SYNTHETIC_START + int(arrival + rng.uniform(0, duration)), module_code=module_code, member_id=member_id, kind="leave"))
+  trace.sort(key=lambda event: event.time)
+  return trace
+
+# Each worker gets the trace once when it starts, rather than once per configuration
+_trace: List[TraceEvent] = []
+
+def _set_trace(trace: List[TraceEvent]) -> None:
+  global _trace
+  _trace = trace
+
+def _simulate(config: StudyGroupConfig, stir_interval: int) -> SimulationResult:
+  return simulate(_trace, config, stir_interval)
+
+def grid(lower_bounds: List[int], target_sizes: List[int], upper_bounds: List[int], max_times: List[int]) -> List[StudyGroupConfig]:
+  """:return: Every combination of the bounds, skipping those where lower_bound <= target_size <= upper_bound doesn't hold."""
+  return [StudyGroupConfig(lower_bound=lower, target_size=target, upper_bound=upper, max_time=max_time)
+          for lower, target, upper, max_time in itertools.product(lower_bounds, target_sizes, upper_bounds, max_times)
+          if lower <= target <= upper]
+
+def format_results(results: List[SimulationResult]) -> str:
+  def hours(seconds: Optional[float]) -> str:
+    return "-" if seconds is None else f"{seconds / 3600:.1f}h"
+
+  lines = [f"{'Lower':>5} {'Target':>6} {'Upper':>5} {'Max time':>8} {'Mean wait':>9} {'Groups':>6} {'Undersized':>10} "
+           f"{'Queued':>6} {'Gave up':>7}  Sizes"]
+  # Show the shortest waits first
+  for i in sorted(results, key=lambda i: (i.mean_wait() is None, i.mean_wait() or 0, i.undersized())):
+    sizes = " ".join(f"{size}:{count}" for size, count in sorted(i.group_sizes.items()))
+    lines.append(f"{i.config.lower_bound:>5} {i.config.target_size:>6} {i.config.upper_bound:>5} {f'{i.config.max_time}h':>8} "
+                 f"{hours(i.mean_wait()):>9} {sum(i.group_sizes.values()):>6} {i.undersized():>10} {i.still_queued:>6} {i.gave_up:>7}  {sizes}")
+  return "\n".join(lines)
+
+def int_list(value: str) -> List[int]:
+  """Parses a comma separated list of ints, for the command line."""
+  return [int(i) for i in value.split(",")]
+
+def main() -> int:
+  parser = argparse.ArgumentParser(
+    prog = "cauch-e-simulate",
+    description = "Simulates study group allocation over a grid of bounds",
+    epilog = "Sizes are shown as size:count. Times are in hours, like in the config.",
+  )
+  parser.add_argument("--trace", metavar="PATH", help="Replay a CSV trace from `python -m cauch_e.journal --trace`. Defaults to a synthetic trace.")
+  parser.add_argument("--users", type=int, default=1000, help="Synthetic trace: how many users queue")
+  parser.add_argument("--modules", type=int, default=20, help="Synthetic trace: how many modules there are")
+  parser.add_argument("--days", type=float, default=14, help="Synthetic trace: how many days it covers")
+  parser.add_argument("--cancel-rate", type=float, default=0.1, help="Synthetic trace: the chance that a user gives up waiting")
+  parser.add_argument("--leave-rate", type=float, default=0.1, help="Synthetic trace: the chance that a user leaves their group")
+  parser.add_argument("--seed", type=int, help="Synthetic trace: the random seed")
+  parser.add_argument("--lower-bound", type=int_list, default=[2, 3], help="Comma separated lower_bounds to try")
+  parser.add_argument("--target-size", type=int_list, default=[4, 5], help="Comma separated target_sizes to try")
+  parser.add_argument("--upper-bound", type=int_list, default=[5, 6], help="Comma separated upper_bounds to try")
+  parser.add_argument("--max-time", type=int_list, default=[24, 72], help="Comma separated max_times (in hours) to try")
+  parser.add_argument("--stir-interval", type=int, default=STIR_INTERVAL, help="How often (in seconds) every module is stirred")
+  parser.add_argument("--workers", type=int, help="How many processes to use. Defaults to one per core.")
+
+  args = parser.parse_args()
+
+  if args.trace is not None:
+    with open(args.trace, newline="") as file:
+      trace = read_trace(file)
+  else:
+    trace = synthetic_trace(args.users, args.modules, args.days, args.cancel_rate, args.leave_rate, args.seed)
+  configs = grid(args.lower_bound, args.target_size, args.upper_bound, args.max_time)
+  if len(configs) == 0:
+    print("No valid combinations of bounds: each needs lower_bound <= target_size <= upper_bound", file=sys.stderr)
+    return 1
+
+  started = time.perf_counter()
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=_set_trace, initargs=(trace,)) as executor:
+    results = list(executor.map(_simulate, configs, itertools.repeat(args.stir_interval)))
+  print(format_results(results))
+  print(f"Simulated {len(configs)} configurations of {len(trace)} events in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
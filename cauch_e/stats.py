@@ -0,0 +1,31 @@
+"""A registry of runtime statistics, so that they can all be shown together by /debug stats"""
+import traceback
+from typing import Any, Callable, Dict
+
+_sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+def register(name: str, f: Callable[[], Dict[str, Any]]) -> None:
+  """
+  Adds a source of statistics.
+  :param name: The heading for these stats.
+  :param f: Returns the current values, indexed by name. This is called every time the stats are shown, so should be cheap.
+  """
+  _sources[name] = f
+
+def collect() -> Dict[str, Dict[str, Any]]:
+  """Gets the current values of every registered source, indexed by heading."""
+  ret: Dict[str, Dict[str, Any]] = {}
+  for name, f in _sources.items():
+    try:
+      ret[name] = f()
+    except Exception:
+      traceback.print_exc()
+      ret[name] = {"error": "failed to collect"}
+  return ret
+
+def format_stats() -> str:
+  lines = []
+  for name, values in collect().items():
+    lines.append(f"{name}:")
+    lines += [f"  {key}: {value}" for key, value in values.items()]
+  return "\n".join(lines)
@@ -0,0 +1,104 @@
+"""Spotting when something blocks the event loop
+
+DB calls and the critical sections in `stir_groups` run synchronously on the event loop, so a slow query freezes the
+whole bot. `LagWatchdog` keeps a histogram of how late the loop wakes up, and if it stops waking up for longer than
+`debug.lag_threshold`, a helper thread grabs the loop thread's stack so we can see what was blocking it.
+"""
+import asyncio
+import bisect
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import cauch_e.config
+import cauch_e.profiling
+import cauch_e.stats
+
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+"""The upper bounds (in seconds) of the lag histogram buckets. Anything longer goes in a final overflow bucket."""
+
+class LagWatchdog:
+  interval: float
+  """How often (in seconds) we check the loop's lag."""
+
+  counts: List[int]
+  """How many checks fell into each bucket of `BUCKETS`, plus the overflow bucket."""
+
+  max_lag: float
+  """The worst lag we have seen, in seconds."""
+
+  stalls: int
+  """How many times the loop was blocked for longer than the threshold."""
+
+  heartbeat: float
+  """When (in `time.monotonic` seconds) the loop last woke up for us."""
+
+  def record(self, lag: float) -> None:
+    self.counts[bisect.bisect_left(BUCKETS, lag)] += 1
+    self.max_lag = max(self.max_lag, lag)
+
+  def stats(self) -> Dict[str, Any]:
+    ret: Dict[str, Any] = {}
+    for bound, count in zip(BUCKETS, self.counts):
+      ret[f"<= {bound * 1000:g}ms"] = count
+    ret[f"> {BUCKETS[-1] * 1000:g}ms"] = self.counts[-1]
+    ret["max"] = f"{self.max_lag * 1000:.1f}ms"
+    ret["stalls"] = self.stalls
+    return ret
+
+  async def monitor(self) -> None:
+    """Measures the loop's lag forever. This must run on the loop being watched."""
+    loop = asyncio.get_running_loop()
+    self._loop = loop
+    self._loop_thread = threading.get_ident()
+    self.heartbeat = time.monotonic()
+    threading.Thread(target=self._watch, name="cauch-e-watchdog", daemon=True).start()
+    while True:
+      expected = loop.time() + self.interval
+      await asyncio.sleep(self.interval)
+      self.record(max(0.0, loop.time() - expected))
+      self.heartbeat = time.monotonic()
+
+  def _stall_report(self, blocked_for: float) -> str:
+    stack = cauch_e.profiling.thread_stack(self._loop_thread, line=True) or []
+
+    # Commands are run in tasks named after them (see `bot.Tree`), so this tells us which command is to blame
+    try:
+      task = asyncio.current_task(self._loop)
+    except RuntimeError:
+      task = None
+    task_name = task.get_name() if task is not None else "none"
+    return f"Event loop blocked for {blocked_for:.2f}s in task '{task_name}', most recent call last:\n" + "\n".join(f"  {i}" for i in stack)
+
+  def _watch(self) -> None:
+    reported: Optional[float] = None
+    while True:
+      time.sleep(self.interval / 2)
+      heartbeat = self.heartbeat
+      blocked_for = time.monotonic() - heartbeat - self.interval
+      # Reload the threshold every time, so it can be changed without restarting
+      if blocked_for > cauch_e.config.typed.debug.lag_threshold and reported != heartbeat:
+        # Only report each stall once, however long it goes on for
+        reported = heartbeat
+        self.stalls += 1
+        print(self._stall_report(blocked_for))
+
+  def __init__(self, interval: float = 0.1):
+    """
+    :param interval: How often (in seconds) to check the loop's lag. Lags shorter than this may be missed by the helper thread,
+                     but still show up in the histogram.
+    """
+    self.interval = interval
+    self.counts = [0] * (len(BUCKETS) + 1)
+    self.max_lag = 0
+    self.stalls = 0
+    self.heartbeat = time.monotonic()
+
+watchdog: Optional[LagWatchdog] = None
+
+def start() -> None:
+  """Sets up `watchdog`, and starts watching the running event loop."""
+  global watchdog
+  watchdog = LagWatchdog()
+  cauch_e.stats.register("event loop lag", watchdog.stats)
+  asyncio.create_task(watchdog.monitor(), name="lag watchdog")